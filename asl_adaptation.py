@@ -0,0 +1,122 @@
+""" adaptation of trained word models to newly recorded training sequences
+
+An update folds new sequences of a word into its model without running the model selector again.  The
+default 'em' method runs a few EM iterations over all of the word's data starting from the current
+parameters; the 'map' method moves only the state means towards the new data (MAP adaptation with a
+relevance factor), which needs a single pass over the new sequences.  The selector is rerun for a word only
+when it has no model yet, or, with recheck_drop set, when the new data fits the adapted model worse per frame
+than the old data did by more than recheck_drop, a sign that the state count no longer suits the word.
+
+For example, to fold in the words of newly recorded videos:
+    adaptive = AdaptiveModels(models, training.get_all_sequences(), training.get_all_Xlengths())
+    asl.append_videos(new_hands_df, new_speakers_df)
+    adaptive.update_all(asl.build_training(features_ground, new_words_csv))
+    bank = ModelBank.from_models(adaptive.models)
+"""
+import warnings
+
+import numpy as np
+
+from asl_data import WordsData
+from asl_fit_cache import model_from_params, model_params
+from my_model_selectors import SelectorConstant
+
+
+class AdaptiveModels(object):
+    """ word models with the training data they were fitted on, updatable one word at a time """
+
+    def __init__(self, models: dict, all_word_sequences: dict, all_word_Xlengths: dict, method='em', n_iter=5,
+                 tol=0.01, relevance=16.0, recheck_drop=None, selector=SelectorConstant, **selector_kwargs):
+        """
+        :param models: dict of GaussianHMM objects or None keyed by word, e.g. as returned by train_all_words
+        :param all_word_sequences: dict as returned by WordsData.get_all_sequences, the data of models
+        :param all_word_Xlengths: dict as returned by WordsData.get_all_Xlengths
+        :param method: str, 'em' for warm-started EM over all of a word's data or 'map' for MAP adaptation of
+            the means to the new sequences only
+        :param n_iter: int maximum EM iterations of an 'em' update
+        :param tol: float EM convergence threshold of an 'em' update
+        :param relevance: float MAP relevance factor; the number of frames at which a state's new data
+            weighs as much as its current mean
+        :param recheck_drop: float or None
+            per-frame log-likelihood drop of the new data against the old data, under the adapted model, above
+            which the word's model is selected again from scratch; None never reselects an existing model
+        :param selector: ModelSelector class used for new words and rechecks
+        :param selector_kwargs: arguments of the selector, e.g. min_n_components
+        """
+        if method not in ('em', 'map'):
+            raise ValueError("unknown adaptation method {}".format(method))
+        self.models = dict(models)
+        self.sequences = {word: list(seqs) for word, seqs in all_word_sequences.items()}
+        self.Xlengths = dict(all_word_Xlengths)
+        self.method = method
+        self.n_iter = n_iter
+        self.tol = tol
+        self.relevance = relevance
+        self.recheck_drop = recheck_drop
+        self.selector = selector
+        self.selector_kwargs = selector_kwargs
+        # words whose model was selected again from scratch by an update
+        self.reselected = []
+
+    def update(self, word, new_sequences):
+        """ adds new training sequences of word and adapts its model to them
+
+        :param word: str, a new word is trained with the selector
+        :param new_sequences: list of float arrays (frames, features)
+        :return: GaussianHMM object, or None if no model could be fitted
+        """
+        warnings.filterwarnings("ignore", category=DeprecationWarning)
+        new_sequences = [np.asarray(seq) for seq in new_sequences if len(seq) > 0]
+        if not new_sequences:
+            return self.models.get(word)
+        old = self.Xlengths.get(word)
+        self.sequences[word] = self.sequences.get(word, []) + new_sequences
+        new_X = np.concatenate(new_sequences)
+        new_lengths = [len(seq) for seq in new_sequences]
+        if old is None:
+            self.Xlengths[word] = new_X, new_lengths
+        else:
+            self.Xlengths[word] = np.concatenate([old[0], new_X.astype(old[0].dtype)]), list(old[1]) + new_lengths
+
+        model = self.models.get(word)
+        if model is None:
+            return self._reselect(word)
+        try:
+            if self.method == 'em':
+                X, lengths = self.Xlengths[word]
+                adapted = model_from_params(model_params(model), init_params='', n_iter=self.n_iter, tol=self.tol,
+                                            random_state=getattr(model, 'random_state', None))
+                adapted.fit(X, lengths)
+            else:
+                adapted = self._map_adapt(model, new_X, new_lengths)
+            if self.recheck_drop is not None and old is not None:
+                old_rate = adapted.score(old[0], old[1]) / len(old[0])
+                new_rate = adapted.score(new_X, new_lengths) / len(new_X)
+                if old_rate - new_rate > self.recheck_drop:
+                    return self._reselect(word)
+        except Exception:
+            return self._reselect(word)
+        self.models[word] = adapted
+        return adapted
+
+    def update_all(self, training: WordsData):
+        """ updates every word of a training set of new sequences
+
+        :param training: WordsData object of the new data only
+        :return: dict of the updated models keyed by word
+        """
+        return {word: self.update(word, training.get_word_sequences(word)) for word in training.words}
+
+    def _map_adapt(self, model, X, lengths):
+        """ model with its means moved towards the posterior-weighted means of the new frames """
+        posteriors = model.predict_proba(X, lengths)
+        counts = posteriors.sum(axis=0)[:, None]
+        params = model_params(model)
+        params['means'] = (self.relevance * params['means'] + posteriors.T.dot(X)) / (self.relevance + counts)
+        return model_from_params(params, random_state=getattr(model, 'random_state', None))
+
+    def _reselect(self, word):
+        model = self.selector(self.sequences, self.Xlengths, word, **self.selector_kwargs).select()
+        self.models[word] = model
+        self.reselected.append(word)
+        return model
@@ -0,0 +1,286 @@
+""" Baum-Welch training of many diagonal-covariance GaussianHMMs at once
+
+Every (word, n_states) job is initialized exactly like GaussianHMM.fit (start and transition probabilities
+drawn from the same seeded Dirichlet distributions as hmmlearn >= 0.3, or uniform for older releases, k-means
+means and the data covariance) and then all jobs run EM together.  Their parameters are padded
+to the largest state count and their sequences are stacked in one frame array, longest sequence first, so
+that at every time step the sequences still running are a prefix of the stack.  One forward-backward pass
+over the stack then computes the expected counts of every job with a few array operations per time step.
+Padded states have zero start and transition probability and never receive any posterior mass.
+
+A job stops when its log-likelihood improves by less than tol, as hmmlearn's ConvergenceMonitor does, and
+leaves the batch; the models agree with GaussianHMM.fit on the same data within floating point differences.
+Batched fits are still kept under their own fit cache keys, so a selector never gets a batched model back in
+place of one fitted by hmmlearn.
+
+For example, to train the SelectorConstant model of every word:
+    models = train_all_words_batched(training)
+or to fill the fit cache with every DIC candidate before SelectorDIC.select_all:
+    fit_batch(training.get_all_Xlengths(), [(w, n) for w in training.words for n in range(2, 11)])
+"""
+import math
+import warnings
+
+import hmmlearn
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.utils import check_random_state
+
+from asl_data import WordsData
+from asl_fit_cache import model_from_params
+from asl_scoring import _logsumexp
+
+# GaussianHMM defaults of the parameters the model selectors leave unset
+MIN_COVAR = 1e-3
+COVARS_PRIOR = 1e-2
+# hmmlearn 0.3 draws the initial start and transition probabilities from a Dirichlet distribution, earlier
+# releases start them uniform
+DIRICHLET_INIT = tuple(int(part) for part in hmmlearn.__version__.split('.')[:2] if part.isdigit()) >= (0, 3)
+# fit cache marker of batched fits, in place of the warm start digest of selector fits
+BATCH_CACHE_INIT = 'batch-baum-welch'
+
+
+def hmm_hyperparameters(num_states, n_iter=1000, tol=0.01, random_state=14):
+    """ GaussianHMM constructor arguments of a fit, the same as ModelSelector.hmm_hyperparameters """
+    return dict(n_components=num_states, covariance_type="diag", n_iter=n_iter,
+                random_state=random_state, verbose=False, tol=tol)
+
+
+def fit_batch(Xlengths: dict, jobs, n_iter=1000, tol=0.01, random_state=14, fit_cache=None):
+    """ fits a GaussianHMM for every (word, n_states) job with batched Baum-Welch
+
+    :param Xlengths: dict of (X, lengths) tuples keyed by word, as returned by WordsData.get_all_Xlengths
+    :param jobs: iterable of (word, n_states) tuples
+    :param n_iter: int maximum number of EM iterations
+    :param tol: float EM convergence threshold on the log-likelihood gain
+    :param random_state: int seed of the k-means initialization
+    :param fit_cache: FitCache object or None; cached batched fits are reused and new ones are stored, under
+        keys that selector fits never use
+    :return: dict of GaussianHMM objects keyed by (word, n_states), None where initialization failed,
+        e.g. for fewer frames than states
+    """
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    results = {}
+    pending = []
+    for word, num_states in jobs:
+        X, lengths = Xlengths[word]
+        hyperparameters = hmm_hyperparameters(num_states, n_iter, tol, random_state)
+        key = None
+        if fit_cache is not None:
+            key = fit_cache.key(X, lengths, init=BATCH_CACHE_INIT, **hyperparameters)
+            params = fit_cache.get(key)
+            if params is not None:
+                results[(word, num_states)] = model_from_params(params, **hyperparameters)
+                continue
+        try:
+            params = initial_params(X, num_states, random_state)
+        except ValueError:
+            results[(word, num_states)] = None
+            continue
+        pending.append(_Job(word, num_states, X, lengths, params, hyperparameters, key))
+
+    iteration = 0
+    active = pending
+    while active and iteration < n_iter:
+        # the batch is rebuilt without the converged jobs whenever some converge
+        batch = _Batch(active)
+        while True:
+            logprob, stats = batch.expectations()
+            batch.maximize(stats)
+            iteration += 1
+            for j, job in enumerate(batch.jobs):
+                job.report(logprob[j], iteration == n_iter)
+            if iteration == n_iter or any(job.converged for job in batch.jobs):
+                break
+        batch.store()
+        active = [job for job in active if not job.converged]
+
+    for job in pending:
+        model = model_from_params(job.params, **job.hyperparameters)
+        if fit_cache is not None:
+            fit_cache.put(job.key, job.params)
+        results[(job.word, job.num_states)] = model
+    return results
+
+
+def train_all_words_batched(training: WordsData, n_constant=3, **kwargs):
+    """ train all words with n_constant states in one batch, the models of train_all_words(training,
+    SelectorConstant)
+
+    :param training: WordsData object (training set)
+    :param n_constant: int number of states
+    :param kwargs: fit_batch arguments (n_iter, tol, random_state, fit_cache)
+    :return: dict of models keyed by word
+    """
+    models = fit_batch(training.get_all_Xlengths(), [(word, n_constant) for word in training.words], **kwargs)
+    return {word: models[(word, n_constant)] for word in training.words}
+
+
+def initial_params(X, num_states, random_state=14):
+    """ GaussianHMM.fit initialization: seeded Dirichlet (hmmlearn >= 0.3) or uniform probabilities, k-means
+    means and the data covariance, drawn in the same order as hmmlearn
+
+    :return: dict as returned by asl_fit_cache.model_params; raises ValueError if k-means cannot run
+    """
+    if DIRICHLET_INIT:
+        rng = check_random_state(random_state)
+        alpha = np.full(num_states, 1.0 / num_states)
+        startprob = rng.dirichlet(alpha)
+        transmat = rng.dirichlet(alpha, size=num_states)
+    else:
+        startprob = np.full(num_states, 1.0 / num_states)
+        transmat = np.full((num_states, num_states), 1.0 / num_states)
+    kmeans = KMeans(n_clusters=num_states, random_state=random_state, n_init=10)
+    kmeans.fit(X)
+    X = np.asarray(X, dtype=np.float64)
+    cv = np.cov(X.T) + MIN_COVAR * np.eye(X.shape[1])
+    if not cv.shape:
+        cv.shape = (1, 1)
+    return {
+        'startprob': startprob,
+        'transmat': transmat,
+        'means': np.asarray(kmeans.cluster_centers_, dtype=np.float64),
+        'covars': np.tile(np.diag(cv), (num_states, 1)),
+    }
+
+
+class _Job(object):
+    """ one (word, n_states) fit: its data, current parameters and convergence state """
+
+    def __init__(self, word, num_states, X, lengths, params, hyperparameters, key):
+        self.word = word
+        self.num_states = num_states
+        self.X = np.asarray(X, dtype=np.float64)
+        self.lengths = list(lengths)
+        self.params = params
+        self.hyperparameters = hyperparameters
+        self.key = key
+        self.tol = hyperparameters['tol']
+        self.previous = None
+        self.converged = False
+
+    def report(self, logprob, last_iteration):
+        # a log-likelihood that is no longer finite cannot improve either, so the job stops instead of
+        # running to n_iter
+        self.converged = (last_iteration or not np.isfinite(logprob)
+                          or (self.previous is not None and logprob - self.previous < self.tol))
+        self.previous = logprob
+
+
+class _Batch(object):
+    """ padded parameters and stacked sequences of a set of jobs """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        J = len(jobs)
+        S = max(job.num_states for job in jobs)
+        D = jobs[0].X.shape[1]
+        self.n_states = np.array([job.num_states for job in jobs])
+        self.state_mask = np.arange(S)[None, :] < self.n_states[:, None]
+        self.startprob = np.zeros((J, S))
+        self.transmat = np.zeros((J, S, S))
+        self.means = np.zeros((J, S, D))
+        self.covars = np.ones((J, S, D))
+        for j, job in enumerate(jobs):
+            n = job.num_states
+            self.startprob[j, :n] = job.params['startprob']
+            self.transmat[j, :n, :n] = job.params['transmat']
+            self.means[j, :n] = job.params['means']
+            self.covars[j, :n] = job.params['covars']
+
+        # frames of every job in job order, and the sequences sorted longest first
+        self.X = np.concatenate([job.X for job in jobs])
+        job_frames = np.array([len(job.X) for job in jobs])
+        self.job_starts = np.concatenate(([0], np.cumsum(job_frames)[:-1]))
+        self.frame_job = np.repeat(np.arange(J), job_frames)
+        lengths = np.concatenate([job.lengths for job in jobs]).astype(np.int64)
+        seq_job = np.repeat(np.arange(J), [len(job.lengths) for job in jobs])
+        seq_start = np.concatenate([self.job_starts[j] + np.concatenate(([0], np.cumsum(job.lengths)[:-1]))
+                                    for j, job in enumerate(jobs)]).astype(np.int64)
+        order = np.argsort(-lengths, kind='stable')
+        self.seq_len, self.seq_job, self.seq_start = lengths[order], seq_job[order], seq_start[order]
+        self.frame_seq = np.empty(len(self.X), dtype=np.int64)
+        self.frame_seq[np.repeat(self.seq_start, self.seq_len)
+                       + _ranges(self.seq_len)] = np.repeat(np.arange(len(order)), self.seq_len)
+        # number of sequences with more than t frames, for every t
+        self.running = np.searchsorted(-self.seq_len, -np.arange(self.seq_len.max()), side='left')
+
+    def expectations(self):
+        """ forward-backward over all stacked sequences
+
+        :return: (float array (J,), dict) log-likelihood of every job and its expected counts
+        """
+        J, S = self.startprob.shape
+        with np.errstate(divide='ignore'):
+            log_start = np.log(self.startprob)
+            log_A = np.log(self.transmat)
+        diff = self.X[:, None, :] - self.means[self.frame_job]
+        covars = self.covars[self.frame_job]
+        log_b = -0.5 * (self.X.shape[1] * math.log(2 * math.pi) + np.log(covars).sum(axis=2)
+                        + (diff ** 2 / covars).sum(axis=2))
+        seq_log_A = log_A[self.seq_job]
+
+        alpha = np.empty_like(log_b)
+        idx = self.seq_start
+        alpha[idx] = log_start[self.seq_job] + log_b[idx]
+        for t in range(1, len(self.running)):
+            n = self.running[t]
+            prev, idx = self.seq_start[:n] + t - 1, self.seq_start[:n] + t
+            alpha[idx] = _logsumexp(alpha[prev][:, :, None] + seq_log_A[:n], axis=1) + log_b[idx]
+        seq_logL = _logsumexp(alpha[self.seq_start + self.seq_len - 1], axis=1)
+
+        beta = np.zeros_like(log_b)
+        trans = np.zeros((len(self.seq_len), S, S))
+        for t in range(len(self.running) - 2, -1, -1):
+            n = self.running[t + 1]
+            idx, nxt = self.seq_start[:n] + t, self.seq_start[:n] + t + 1
+            ahead = (log_b[nxt] + beta[nxt])[:, None, :]
+            beta[idx] = _logsumexp(seq_log_A[:n] + ahead, axis=2)
+            with np.errstate(invalid='ignore'):
+                trans[:n] += np.exp(alpha[idx][:, :, None] + seq_log_A[:n] + ahead - seq_logL[:n, None, None])
+
+        with np.errstate(invalid='ignore'):
+            posteriors = np.exp(alpha + beta - seq_logL[self.frame_seq][:, None])
+        stats = {
+            'start': np.zeros((J, S)),
+            'trans': np.zeros((J, S, S)),
+            'post': np.add.reduceat(posteriors, self.job_starts, axis=0),
+            'obs': np.add.reduceat(posteriors[:, :, None] * self.X[:, None, :], self.job_starts, axis=0),
+            'obs**2': np.add.reduceat(posteriors[:, :, None] * self.X[:, None, :] ** 2, self.job_starts, axis=0),
+        }
+        np.add.at(stats['start'], self.seq_job, posteriors[self.seq_start])
+        np.add.at(stats['trans'], self.seq_job, trans)
+        logprob = np.bincount(self.seq_job, weights=seq_logL, minlength=J)
+        return logprob, stats
+
+    def maximize(self, stats):
+        """ the GaussianHMM M-step with its default priors, for every job at once """
+        self.startprob = _normalize(np.where(self.startprob == 0.0, self.startprob, stats['start']))
+        self.transmat = _normalize(np.where(self.transmat == 0.0, self.transmat, stats['trans']))
+        denom = stats['post'][:, :, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = stats['obs'] / denom
+            cv_num = stats['obs**2'] - 2 * means * stats['obs'] + means ** 2 * denom
+            covars = (COVARS_PRIOR + cv_num) / np.maximum(denom, 1e-5)
+        mask = self.state_mask[:, :, None]
+        self.means = np.where(mask, means, 0.0)
+        self.covars = np.where(mask, covars, 1.0)
+
+    def store(self):
+        """ copies the padded parameters back to the jobs """
+        for j, job in enumerate(self.jobs):
+            n = job.num_states
+            job.params = {'startprob': self.startprob[j, :n].copy(), 'transmat': self.transmat[j, :n, :n].copy(),
+                          'means': self.means[j, :n].copy(), 'covars': self.covars[j, :n].copy()}
+
+
+def _normalize(a):
+    """ hmmlearn's normalize along the last axis: rows summing to zero are left as they are """
+    total = a.sum(axis=-1, keepdims=True)
+    total[total == 0] = 1
+    return a / total
+
+
+def _ranges(lengths):
+    """ 0..n-1 for every n of lengths, concatenated """
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
@@ -0,0 +1,239 @@
+""" offline benchmarks of the load, feature, selection, training and recognition stages
+
+Every stage records its wall time, its peak traced Python memory (tracemalloc) and, for model selection, the
+number of GaussianHMM fits per second.  Memory tracing slows hmmlearn down several times over, so wall times
+come from an untraced run and peak memory from a second, traced run of the same stage.  Results are written
+to a json file and compared with a saved baseline, so that performance regressions show up as a non-zero exit
+status.
+
+For example, to save a baseline and later check the current tree against it:
+    python asl_benchmark.py --save-baseline
+    python asl_benchmark.py --words 50
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from functools import partial
+
+from asl_data import AslDb, FEATURE_SETS
+from asl_fit_cache import FitCache
+from asl_utils import train_all_words
+from my_model_selectors import SelectorConstant, SelectorBIC, SelectorDIC, SelectorCV
+from my_recognizer import recognize
+
+SELECTORS = [SelectorConstant, SelectorBIC, SelectorDIC, SelectorCV]
+STAGES = ['load', 'features', 'select', 'train', 'recognize']
+RESULTS_FN = os.path.join('data', 'benchmark', 'results.json')
+BASELINE_FN = os.path.join('data', 'benchmark', 'baseline.json')
+
+
+def measure(fn, *args, memory=True, repeat=1, **kwargs):
+    """ times fn and, with memory, runs it a second time while tracing memory
+
+    :param memory: bool, also measure the peak traced memory
+    :param repeat: int, untraced runs of which the fastest is kept
+    :return: (result of the last untraced run, dict with wall_time in seconds and peak_memory in bytes or None)
+    """
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        wall_times.append(time.perf_counter() - start)
+    stats = {'wall_time': min(wall_times), 'peak_memory': None}
+    if memory:
+        tracemalloc.start()
+        try:
+            fn(*args, **kwargs)
+            stats['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+
+def run_benchmarks(stages=None, num_words=None, feature_set='ground', n_jobs=1, memory=True, repeat=3,
+                   verbose=True):
+    """ times the requested stages on the bundled data
+
+    :param stages: list of names from STAGES, or None for all of them
+    :param num_words: int or None
+        number of vocabulary words used for selection and training; None uses the full vocabulary
+    :param feature_set: str key of FEATURE_SETS used for selection, training and recognition
+    :param n_jobs: int or None, worker processes of the train stage (see train_all_words); tracemalloc only
+        sees this process, so with workers the train stage's peak memory is marked as parent-only
+    :param memory: bool, measure peak memory with an extra traced run of every stage
+    :param repeat: int, untraced runs of the load, feature and recognize stages of which the fastest is kept
+    :param verbose: bool, prints each stage as it finishes
+    :return: dict of stage results keyed by stage name
+    """
+    stages = STAGES if stages is None else stages
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    logging.getLogger('hmmlearn').setLevel(logging.ERROR)
+    run = partial(measure, memory=memory)
+    run_fast = partial(measure, memory=memory, repeat=repeat)
+    results = {}
+
+    def record(name, stats, fits=None):
+        if fits is not None:
+            stats['fits'] = fits
+            stats['fits_per_second'] = fits / stats['wall_time'] if stats['wall_time'] > 0 else None
+        results[name] = stats
+        if verbose:
+            print("{:32} {:9.3f}s {:>12}{}".format(
+                name, stats['wall_time'],
+                '' if stats['peak_memory'] is None else "{:.1f}MB".format(stats['peak_memory'] / 2 ** 20),
+                '' if fits is None else " {:8.1f} fits/s".format(stats['fits_per_second'] or 0)))
+
+    if 'load' in stages:
+        _, stats = run_fast(AslDb, cache_dir=None)
+        record('load/csv', stats)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            AslDb(cache_dir=cache_dir)
+            _, stats = run_fast(AslDb, cache_dir=cache_dir)
+            record('load/cached', stats)
+
+    asl = AslDb()
+    if 'features' in stages:
+        for name, features in sorted(FEATURE_SETS.items()):
+            _, stats = run_fast(_build_uncached, asl, asl.build_training, features)
+            record('build_training/' + name, stats)
+            _, stats = run_fast(_build_uncached, asl, asl.build_test, features)
+            record('build_test/' + name, stats)
+
+    training = asl.build_training(FEATURE_SETS[feature_set])
+    words = training.words if num_words is None else training.words[:num_words]
+    sequences = training.get_all_sequences()
+    Xlengths = training.get_all_Xlengths()
+
+    if 'select' in stages:
+        for selector in SELECTORS:
+            fits, stats = run(_select_words, selector, sequences, Xlengths, words)
+            record('select/' + selector.__name__, stats, fits=fits)
+
+    models = None
+    if 'train' in stages or 'recognize' in stages:
+        subset = copy.copy(training)
+        subset.words = words
+        models, stats = run(train_all_words, subset, partial(SelectorBIC, fit_cache=None), n_jobs=n_jobs)
+        if 'train' in stages:
+            if n_jobs != 1:
+                stats['peak_memory_scope'] = 'parent'
+            record('train_all_words/SelectorBIC', stats)
+
+    if 'recognize' in stages:
+        test_set = asl.build_test(FEATURE_SETS[feature_set])
+        _, stats = run_fast(recognize, models, test_set)
+        record('recognize', stats)
+    return results
+
+
+def _build_uncached(asl, build, features):
+    """ build(features) with the memoized feature values dropped first, so every run computes them """
+    asl.clear_features()
+    return build(features)
+
+
+def _select_words(selector, sequences, Xlengths, words):
+    """ selects a model for every word with a fresh fit cache, so that nothing is reused between runs
+
+    :return: int number of fits performed
+    """
+    fit_cache = FitCache()
+    for word in words:
+        selector(sequences, Xlengths, word, n_constant=3, fit_cache=fit_cache).select()
+    return fit_cache.misses
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.01):
+    """ stages whose wall time or peak memory grew by more than tolerance relative to the baseline
+
+    :param results: dict of stage results as returned by run_benchmarks
+    :param baseline: dict of stage results
+    :param tolerance: float, allowed relative increase
+    :param min_seconds: float, wall time increases below this are timer noise and never regressions
+    :return: list of str, one per regression
+    """
+    regressions = []
+    for name, stats in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in ('wall_time', 'peak_memory'):
+            before, after = baseline[name].get(metric), stats.get(metric)
+            if metric == 'wall_time' and after is not None and before is not None and after - before < min_seconds:
+                continue
+            if before and after is not None and after > before * (1 + tolerance):
+                regressions.append("{} {}: {:.4g} -> {:.4g} (+{:.0%})".format(
+                    name, metric, before, after, after / before - 1))
+    return regressions
+
+
+def write_results(fn, results, **settings):
+    """ writes stage results with the settings and environment they were measured in """
+    dirname = os.path.dirname(fn)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': settings,
+        'stages': results,
+    }
+    with open(fn, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def read_results(fn):
+    """ stage results of a file written by write_results
+
+    :return: dict of stage results, or None when there is no such file
+    """
+    try:
+        with open(fn) as f:
+            return json.load(f)['stages']
+    except FileNotFoundError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--words', type=int, default=None, help='vocabulary size; the full vocabulary by default')
+    parser.add_argument('--features', choices=sorted(FEATURE_SETS), default='ground')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='train_all_words worker processes; peak memory then covers the parent process only')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced runs measuring peak memory')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of the fast stages')
+    parser.add_argument('--output', default=RESULTS_FN)
+    parser.add_argument('--baseline', default=BASELINE_FN)
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    settings = {'words': args.words, 'features': args.features, 'jobs': args.jobs}
+    results = run_benchmarks(args.stages, args.words, args.features, args.jobs,
+                             memory=not args.no_memory, repeat=args.repeat)
+    write_results(args.output, results, **settings)
+    if args.save_baseline:
+        write_results(args.baseline, results, **settings)
+        return 0
+    baseline = read_results(args.baseline)
+    if baseline is None:
+        print("no baseline at {}; run with --save-baseline to create one".format(args.baseline))
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,15 @@
+import hashlib
+import json
 import os
+import warnings
 
 import numpy as np
 import pandas as pd
 
+# dtype of feature values and of the WordsData/SinglesData sequence buffers in the default compact data mode;
+# integer positions and ids below 2**24 are exact in float32
+FEATURE_DTYPE = np.float32
+
 
 class AslDb(object):
     """ American Sign Language database drawn from the RWTH-BOSTON-104 frame positional data
@@ -23,6 +30,8 @@ class AslDb(object):
     def __init__(self,
                  hands_fn=os.path.join('data', 'hands_condensed.csv'),
                  speakers_fn=os.path.join('data', 'speaker.csv'),
+                 cache_dir=os.path.join('data', 'cache'),
+                 dtype=FEATURE_DTYPE,
                  ):
         """ loads ASL database from csv files with hand position information by frame, and speaker information
 
@@ -32,6 +41,12 @@ class AslDb(object):
         :param speakers_fn:
             filename of video speaker csv mapping with expected format:
                 video,speaker
+        :param cache_dir: str or None
+            directory for the binary columnar cache of the merged frame table; the cache is built on first use,
+            rebuilt when either csv file changes, and memory-mapped afterwards.  None always parses the csv files
+        :param dtype: numpy float dtype
+            dtype of feature values and sequence buffers; np.float64 for full precision.  The frame table always
+            holds its integer columns and video/frame ids in the smallest safe integer types
 
         Instance variables:
             df: pandas dataframe
@@ -43,13 +58,171 @@ class AslDb(object):
                   2         149     181      170      175     161      62  woman-1
 
         """
-        self.df = pd.read_csv(hands_fn).merge(pd.read_csv(speakers_fn),on='video')
-        self.df.set_index(['video','frame'], inplace=True)
+        self.df = load_frame_table(hands_fn, speakers_fn, cache_dir)
+        self.dtype = np.dtype(dtype)
+        self.features = dict(STANDARD_FEATURES)
+        self.store = None
+        self._feature_values = {}
+        self._group_codes = {}
+        self._speaker_stats = None
+
+    @classmethod
+    def from_store(cls, store, dtype=FEATURE_DTYPE):
+        """ database over a VideoStore on disk that loads frames only for the videos a data set needs
+
+        df starts empty.  build_training, build_test and working_set read the videos they use from the store,
+        so peak memory follows the working set rather than the corpus.  Speaker statistics of the norm
+        features come from the whole store; other grouped features, e.g. norm-polar-rr, are computed over
+        the videos of the working set.
+
+        :param store: VideoStore object or str directory written by VideoStore.build
+        :param dtype: numpy float dtype, see __init__
+        :return: AslDb object
+        """
+        asl = cls.__new__(cls)
+        asl.store = VideoStore(store) if isinstance(store, str) else store
+        asl.df = asl.store.frame_table([])
+        asl.dtype = np.dtype(dtype)
+        asl.features = dict(STANDARD_FEATURES)
+        asl._feature_values = {}
+        asl._group_codes = {}
+        asl._speaker_stats = None
+        return asl
+
+    def working_set(self, videos):
+        """ database holding the frames of the given videos: self when df already holds every frame, else a new
+        AslDb over the videos read from the store, sharing this one's features and speaker statistics
+
+        :param videos: iterable of int video numbers
+        :return: AslDb object
+        """
+        if self.store is None:
+            return self
+        asl = AslDb.from_store(self.store, self.dtype)
+        asl.store = None
+        asl.df = self.store.frame_table(videos)
+        asl.features = self.features
+        asl._speaker_stats = self.speaker_stats
+        return asl
+
+    @property
+    def speaker_stats(self):
+        """ SpeakerStats of the position columns of df, or of the whole store, built on first use and updated
+        by append_videos """
+        if self._speaker_stats is None:
+            if self.store is not None:
+                self._speaker_stats = self.store.speaker_stats()
+            else:
+                columns = [c for c in self.df.columns if pd.api.types.is_numeric_dtype(self.df[c])]
+                self._speaker_stats = SpeakerStats(columns)
+                self._speaker_stats.update(self.df['speaker'].values, self.df[columns].values)
+        return self._speaker_stats
+
+    @speaker_stats.setter
+    def speaker_stats(self, stats):
+        self._speaker_stats = stats
+        self.clear_features()
+
+    def append_videos(self, hands_df, speakers_df):
+        """ adds the frames of new videos to df; speaker statistics are updated from the new frames only
+
+        :param hands_df: pandas dataframe or str filename with the columns of hands_condensed.csv
+        :param speakers_df: pandas dataframe or str filename with the columns of speaker.csv
+        """
+        if self.store is not None:
+            raise ValueError("videos cannot be appended to a store-backed AslDb; build a new VideoStore")
+        if isinstance(hands_df, str):
+            hands_df = pd.read_csv(hands_df)
+        if isinstance(speakers_df, str):
+            speakers_df = pd.read_csv(speakers_df)
+        frames = hands_df.merge(speakers_df, on='video').set_index(['video', 'frame'])
+        frames = compact_frame_table(frames[list(self.df.columns)])
+        if len(frames) < len(hands_df):
+            raise ValueError("videos without a speaker: {}".format(
+                sorted(set(hands_df['video']) - set(speakers_df['video']))))
+        existing = set(frames.index.get_level_values('video')) & set(self.df.index.get_level_values('video'))
+        if existing:
+            raise ValueError("videos already in the database: {}".format(sorted(existing)))
+        if self._speaker_stats is not None:
+            columns = self._speaker_stats.columns
+            self._speaker_stats.update(frames['speaker'].values, frames[columns].values)
+        self.df = pd.concat([self.df, frames])
+        self.clear_features()
+
+    def register_feature(self, name, inputs, compute):
+        """ declares a derived feature that build_training/build_test compute on demand
+
+        :param name: str feature label
+        :param inputs: list of str labels of the df columns or registered features it is computed from
+        :param compute: function(asl, *input_arrays) returning a numpy array with one value per df row
+        """
+        self.features[name] = Feature(name, inputs, compute)
+        self.clear_features()
+
+    def feature_values(self, name):
+        """ values of a df column or registered feature, one per df row; derived features are computed with
+        their dependencies the first time they are requested and memoized
+
+        A memoized feature is recomputed when one of its inputs has been reassigned since, e.g. after
+        asl.df['right-x'] += 5.  Changes made in place, e.g. through asl.df.loc, need clear_features().
+
+        :param name: str feature label
+        :return: numpy array, of self.dtype for numeric values
+        """
+        if name in self.df.columns:
+            values = self.df[name].values
+            if not pd.api.types.is_numeric_dtype(self.df[name]):
+                return values
+            return _numeric_values(values, self.dtype)
+        if name not in self.features:
+            raise KeyError("unknown feature {}".format(name))
+        feature = self.features[name]
+        # the arrays the feature is computed from; memoizing them also keeps their buffers from being reused
+        sources = [self._source_values(input_name) for input_name in feature.inputs]
+        memo = self._feature_values.get(name)
+        if memo is None or not all(_same_buffer(a, b) for a, b in zip(memo[1], sources)):
+            inputs = [self.feature_values(input_name) for input_name in feature.inputs]
+            values = _numeric_values(np.asarray(feature.compute(self, *inputs)), self.dtype)
+            self._feature_values[name] = memo = (values, sources)
+        return memo[0]
+
+    def _source_values(self, name):
+        """ uncast df column or memoized feature values of name, whose buffer identifies its current version """
+        if name in self.df.columns:
+            return self.df[name].values
+        return self.feature_values(name)
+
+    def feature_table(self, feature_list):
+        """ frame table of the requested features, indexed like df
+
+        :param feature_list: list of str feature labels
+        :return: pandas dataframe
+        """
+        return pd.DataFrame({name: self.feature_values(name) for name in feature_list},
+                            index=self.df.index, columns=list(feature_list))
+
+    def clear_features(self):
+        """ drops memoized feature values, e.g. after df has changed """
+        self._feature_values = {}
+        self._group_codes = {}
+
+    def group_codes(self, level):
+        """ integer group code of every df row, by 'video' or 'speaker'
+
+        :return: (numpy array, numpy array) as codes, group labels
+        """
+        if level not in self._group_codes:
+            if level in self.df.columns:
+                values = self.df[level].values
+            else:
+                values = self.df.index.get_level_values(level).values
+            self._group_codes[level] = pd.factorize(values)
+        return self._group_codes[level]
 
     def build_training(self, feature_list, csvfilename =os.path.join('data', 'train_words.csv')):
         """ wrapper creates sequence data objects for training words suitable for hmmlearn library
 
-        :param feature_list: list of str label names
+        :param feature_list: list of str label names; df columns or features registered in self.features
         :param csvfilename: str
         :return: WordsData object
             dictionary of lists of feature list sequence lists for each word
@@ -60,7 +233,7 @@ class AslDb(object):
     def build_test(self, feature_method, csvfile=os.path.join('data', 'test_words.csv')):
         """ wrapper creates sequence data objects for individual test word items suitable for hmmlearn library
 
-        :param feature_method: Feature function
+        :param feature_method: list of str label names; df columns or features registered in self.features
         :param csvfile: str
         :return: SinglesData object
             dictionary of lists of feature list sequence lists for each indexed
@@ -83,43 +256,37 @@ class WordsData(object):
                 video,speaker,word,startframe,endframe
         :param feature_list: list of str feature labels
         """
-        self._data = self._load_data(asl, csvfile, feature_list)
-        self._hmm_data = create_hmmlearn_data(self._data)
+        self._X, self._lengths, keys = self._load_data(asl, csvfile, feature_list)
+        self._data, self._hmm_data = index_sequences(self._X, self._lengths, keys)
         self.num_items = len(self._data)
         self.words = list(self._data.keys())
+        self.dtype = self._X.dtype
 
     def _load_data(self, asl, fn, feature_list):
-        """ Consolidates sequenced feature data into a dictionary of words
+        """ Consolidates sequenced feature data into one contiguous buffer grouped by word
 
         :param asl: ASLdata object
         :param fn: str
             filename of csv file containing word training data
         :param feature_list: list of str
-        :return: dict
+        :return: (numpy array, list, list)
+            buffer of all frames, length of each sequence, and word of each sequence
         """
         tr_df = pd.read_csv(fn)
-        dict = {}
-        for i in range(len(tr_df)):
-            word = tr_df.ix[i,'word']
-            video = tr_df.ix[i,'video']
-            new_sequence = [] # list of sample lists for a sequence
-            for frame in range(tr_df.ix[i,'startframe'], tr_df.ix[i,'endframe']+1):
-                vid_frame = video, frame
-                sample = [asl.df.ix[vid_frame][f] for f in feature_list]
-                if len(sample) > 0:  # dont add if not found
-                    new_sequence.append(sample)
-            if word in dict:
-                dict[word].append(new_sequence) # list of sequences
-            else:
-                dict[word] = [new_sequence]
-        return dict
+        # stable sort by order of first appearance so that each word's sequences form one slice of the buffer
+        words = pd.Categorical(tr_df['word'], categories=pd.unique(tr_df['word']))
+        tr_df = tr_df.iloc[np.argsort(words.codes, kind='stable')]
+        asl = asl.working_set(tr_df['video'].unique())
+        X, lengths = load_frame_buffer(asl.feature_table(feature_list), tr_df, feature_list, asl.dtype)
+        return X, lengths, list(tr_df['word'])
 
     def get_all_sequences(self):
         """ getter for entire db of words as series of sequences of feature lists for each frame
 
         :return: dict
-            dictionary of lists of feature list sequence lists for each word
-                {'FRANK': [[[87, 225], [87, 225], ...], [[88, 219], [88, 219], ...]]],
+            dictionary of lists of sequence arrays for each word; each sequence is a view of the
+            contiguous data buffer
+                {'FRANK': [array([[87., 225.], [87., 225.], ...]), array([[88., 219.], [88., 219.], ...])],
                 ...}
         """
         return self._data
@@ -128,9 +295,9 @@ class WordsData(object):
         """ getter for entire db of words as (X, lengths) tuple for use with hmmlearn library
 
         :return: dict
-            dictionary of (X, lengths) tuple, where X is a numpy array of feature lists and lengths is
+            dictionary of (X, lengths) tuple, where X is a view of the contiguous data buffer and lengths is
             a list of lengths of sequences within X
-                {'FRANK': (array([[ 87, 225],[ 87, 225], ...  [ 87, 225,  62, 127], [ 87, 225,  65, 128]]), [14, 18]),
+                {'FRANK': (array([[ 87., 225.],[ 87., 225.], ...  [ 87., 225.], [ 87., 225.]]), [14, 18]),
                 ...}
         """
         return self._hmm_data
@@ -140,8 +307,8 @@ class WordsData(object):
 
         :param word: str
         :return: list
-            lists of feature list sequence lists for given word
-                [[[87, 225], [87, 225], ...], [[88, 219], [88, 219], ...]]]
+            list of sequence arrays for given word, each a view of the contiguous data buffer
+                [array([[87., 225.], [87., 225.], ...]), array([[88., 219.], [88., 219.], ...])]
         """
         return self._data[word]
 
@@ -150,9 +317,9 @@ class WordsData(object):
 
         :param word:
         :return: (list, list)
-            (X, lengths) tuple, where X is a numpy array of feature lists and lengths is
+            (X, lengths) tuple, where X is a view of the contiguous data buffer and lengths is
             a list of lengths of sequences within X
-                (array([[ 87, 225],[ 87, 225], ...  [ 87, 225,  62, 127], [ 87, 225,  65, 128]]), [14, 18])
+                (array([[ 87., 225.],[ 87., 225.], ...  [ 87., 225.], [ 87., 225.]]), [14, 18])
         """
         return self._hmm_data[word]
 
@@ -174,37 +341,12 @@ class SinglesData(object):
         self.df = pd.read_csv(csvfile)
         self.wordlist = list(self.df['word'])
         self.sentences_index  = self._load_sentence_word_indices()
-        self._data = self._load_data(asl, feature_list)
-        self._hmm_data = create_hmmlearn_data(self._data)
+        asl = asl.working_set(self.df['video'].unique())
+        self._X, self._lengths = load_frame_buffer(asl.feature_table(feature_list), self.df, feature_list, asl.dtype)
+        self._data, self._hmm_data = index_sequences(self._X, self._lengths, range(len(self.df)))
         self.num_items = len(self._data)
         self.num_sentences = len(self.sentences_index)
-
-    # def _load_data(self, asl, fn, feature_method):
-    def _load_data(self, asl, feature_list):
-        """ Consolidates sequenced feature data into a dictionary of words and creates answer list of words in order
-        of index used for dictionary keys
-
-        :param asl: ASLdata object
-        :param fn: str
-            filename of csv file containing word training data
-        :param feature_method: Feature function
-        :return: dict
-        """
-        dict = {}
-        # for each word indexed in the DataFrame
-        for i in range(len(self.df)):
-            video = self.df.ix[i,'video']
-            new_sequence = [] # list of sample dictionaries for a sequence
-            for frame in range(self.df.ix[i,'startframe'], self.df.ix[i,'endframe']+1):
-                vid_frame = video, frame
-                sample = [asl.df.ix[vid_frame][f] for f in feature_list]
-                if len(sample) > 0:  # dont add if not found
-                    new_sequence.append(sample)
-            if i in dict:
-                dict[i].append(new_sequence) # list of sequences
-            else:
-                dict[i] = [new_sequence]
-        return dict
+        self.dtype = self._X.dtype
 
     def _load_sentence_word_indices(self):
         """ create dict of video sentence numbers with list of word indices as values
@@ -216,7 +358,7 @@ class SinglesData(object):
         working_df = self.df.copy()
         working_df['idx'] = working_df.index
         working_df.sort_values(by='startframe', inplace=True)
-        p = working_df.pivot('video', 'startframe', 'idx')
+        p = working_df.pivot(index='video', columns='startframe', values='idx')
         p.fillna(-1, inplace=True)
         p = p.transpose()
         dict = {}
@@ -228,8 +370,9 @@ class SinglesData(object):
         """ getter for entire db of items as series of sequences of feature lists for each frame
 
         :return: dict
-            dictionary of lists of feature list sequence lists for each indexed item
-                {3: [[[87, 225], [87, 225], ...], [[88, 219], [88, 219], ...]]],
+            dictionary of lists of sequence arrays for each indexed item; each sequence is a view of the
+            contiguous data buffer
+                {3: [array([[87., 225.], [87., 225.], ...])],
                 ...}
         """
         return self._data
@@ -238,9 +381,9 @@ class SinglesData(object):
         """ getter for entire db of items as (X, lengths) tuple for use with hmmlearn library
 
         :return: dict
-            dictionary of (X, lengths) tuple, where X is a numpy array of feature lists and lengths is
+            dictionary of (X, lengths) tuple, where X is a view of the contiguous data buffer and lengths is
             a list of lengths of sequences within X; should always have only one item in lengths
-                {3: (array([[ 87, 225],[ 87, 225], ...  [ 87, 225,  62, 127], [ 87, 225,  65, 128]]), [14]),
+                {3: (array([[ 87., 225.],[ 87., 225.], ...  [ 87., 225.], [ 87., 225.]]), [14]),
                 ...}
         """
         return self._hmm_data
@@ -250,8 +393,8 @@ class SinglesData(object):
 
         :param word: str
         :return: list
-            lists of feature list sequence lists for given word
-                [[[87, 225], [87, 225], ...]]]
+            list holding the sequence array for given item, a view of the contiguous data buffer
+                [array([[87., 225.], [87., 225.], ...])]
         """
         return self._data[item]
 
@@ -260,38 +403,693 @@ class SinglesData(object):
 
         :param word:
         :return: (list, list)
-            (X, lengths) tuple, where X is a numpy array of feature lists and lengths is
+            (X, lengths) tuple, where X is a view of the contiguous data buffer and lengths is
             a list of lengths of sequences within X; lengths should always contain one item
-                (array([[ 87, 225],[ 87, 225], ...  [ 87, 225,  62, 127], [ 87, 225,  65, 128]]), [14])
+                (array([[ 87., 225.],[ 87., 225.], ...  [ 87., 225.], [ 87., 225.]]), [14])
         """
         return self._hmm_data[item]
 
 
-def combine_sequences(sequences):
-    '''
-    concatenates sequences and return tuple of the new list and lengths
-    :param sequences:
-    :return: (list, list)
-    '''
-    sequence_cat = []
-    sequence_lengths = []
-    # print("num of sequences in {} = {}".format(key, len(sequences)))
-    for sequence in sequences:
-        sequence_cat += sequence
-        num_frames = len(sequence)
-        sequence_lengths.append(num_frames)
-    return sequence_cat, sequence_lengths
-
-def create_hmmlearn_data(dict):
-    seq_len_dict = {}
-    for key in dict:
-        sequences = dict[key]
-        sequence_cat, sequence_lengths = combine_sequences(sequences)
-        seq_len_dict[key] = np.array(sequence_cat), sequence_lengths
-    return seq_len_dict
+class Feature(object):
+    """ declaration of a derived feature: the columns it is computed from and a vectorized function computing it
+
+    compute is called as compute(asl, *input_arrays) with one array per input, aligned with the rows of
+    asl.df, and returns the feature value of every row.  Grouped computations use asl.group_codes.
+    """
+
+    def __init__(self, name, inputs, compute):
+        self.name = name
+        self.inputs = list(inputs)
+        self.compute = compute
+
+
+def speaker_normalized(asl, values):
+    """ z-score of values using the mean and standard deviation of each row's speaker
+
+    :param asl: AslDb object
+    :param values: numpy array with one value per df row
+    :return: numpy array
+    """
+    codes, _ = asl.group_codes('speaker')
+    mean, std = grouped_mean_std(values, codes)
+    return (values - mean[codes]) / std[codes]
+
+
+def _speaker_stats_normalizer(column):
+    def compute(asl, values):
+        stats = asl.speaker_stats
+        if column not in stats.columns:
+            return speaker_normalized(asl, values)
+        codes, speakers = asl.group_codes('speaker')
+        mean, std = stats.statistics(speakers, [column])
+        return (values - mean[codes, 0]) / std[codes, 0]
+    return compute
+
+
+def speaker_centered(asl, values):
+    """ values minus the mean of each row's speaker """
+    codes, _ = asl.group_codes('speaker')
+    mean, _ = grouped_mean_std(values, codes)
+    return values - mean[codes]
+
+
+def grouped_mean_std(values, codes):
+    """ mean and sample standard deviation (ddof=1, as pandas) of values for every group code
+
+    :return: (numpy array, numpy array) indexed by group code
+    """
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.bincount(codes)
+    mean = np.bincount(codes, weights=values) / counts
+    deviations = values - mean[codes]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(np.bincount(codes, weights=deviations ** 2) / (counts - 1))
+    return mean, std
+
+
+def video_delta(asl, values):
+    """ difference to the previous frame of the same video, 0 on the first frame of each video
+
+    :param asl: AslDb object
+    :param values: numpy array with one value per df row
+    :return: numpy array
+    """
+    codes, _ = asl.group_codes('video')
+    frames = asl.df.index.get_level_values('frame').values
+    order = np.lexsort((frames, codes))
+    ordered = values[order]
+    delta = np.zeros_like(ordered)
+    delta[1:] = ordered[1:] - ordered[:-1]
+    delta[np.flatnonzero(np.diff(codes[order]) != 0) + 1] = 0
+    result = np.empty_like(delta)
+    result[order] = delta
+    return result
+
+
+class SpeakerStats(object):
+    """ running per-speaker count, mean and sum of squared deviations (Welford) of frame columns
+
+    Batches of frames are merged into the running statistics, so normalizing the frames of a new video costs
+    time in the number of new frames only.  A speaker with fewer than min_frames frames, e.g. one that has
+    never been seen, is normalized with the pooled statistics of all frames until enough of its own frames
+    have been added.  A column whose values have not varied yet for a speaker takes the pooled standard
+    deviation, so that z-scores stay finite.
+
+    For example, to keep the statistics between sessions:
+        asl.speaker_stats.save(os.path.join('data', 'speaker_stats.npz'))
+        asl.speaker_stats = SpeakerStats.load(os.path.join('data', 'speaker_stats.npz'))
+    """
+
+    def __init__(self, columns, min_frames=30):
+        """
+        :param columns: list of str column labels
+        :param min_frames: int
+            frames needed before a speaker's own statistics replace the pooled ones
+        """
+        self.columns = list(columns)
+        self.min_frames = min_frames
+        self.speakers = []
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros((0, len(self.columns)))
+        self.m2 = np.zeros((0, len(self.columns)))
+        self._rows = {}
+
+    def update(self, speakers, values):
+        """ merges a batch of frames into the statistics
+
+        :param speakers: array of the speaker label of every frame
+        :param values: array of shape (frames, len(columns))
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(len(speakers), len(self.columns))
+        if len(values) == 0:
+            return
+        codes, labels = pd.factorize(np.asarray(speakers))
+        counts = np.bincount(codes)
+        batch_mean = np.empty((len(labels), len(self.columns)))
+        batch_m2 = np.empty((len(labels), len(self.columns)))
+        for j in range(len(self.columns)):
+            batch_mean[:, j] = np.bincount(codes, weights=values[:, j]) / counts
+            batch_m2[:, j] = np.bincount(codes, weights=(values[:, j] - batch_mean[codes, j]) ** 2)
+        rows = np.array([self._row(label) for label in labels])
+        count = self.count[rows]
+        total = count + counts
+        delta = batch_mean - self.mean[rows]
+        self.mean[rows] += delta * (counts / total)[:, None]
+        self.m2[rows] += batch_m2 + delta ** 2 * (count * counts / total)[:, None]
+        self.count[rows] = total
+
+    def statistics(self, speakers, columns=None):
+        """ mean and sample standard deviation (ddof=1) of each speaker, pooled for speakers with too few frames
+
+        :param speakers: list of speaker labels
+        :param columns: list of str column labels, or None for all columns
+        :return: (numpy array, numpy array) of shape (len(speakers), len(columns))
+        """
+        cols = slice(None) if columns is None else [self.columns.index(c) for c in columns]
+        pooled_mean, pooled_std = self.pooled()
+        mean = np.tile(pooled_mean[cols], (len(speakers), 1))
+        std = np.tile(pooled_std[cols], (len(speakers), 1))
+        for i, speaker in enumerate(speakers):
+            row = self._rows.get(speaker)
+            if row is not None and self.count[row] >= max(self.min_frames, 2):
+                mean[i] = self.mean[row, cols]
+                own_std = np.sqrt(self.m2[row, cols] / (self.count[row] - 1))
+                # rounding leaves constant columns a tiny nonzero deviation rather than exactly zero
+                std[i] = np.where(own_std > 1e-6 * std[i], own_std, std[i])
+        return mean, std
+
+    def pooled(self):
+        """ mean and sample standard deviation of all frames of all speakers
+
+        :return: (numpy array, numpy array) of shape (len(columns),)
+        """
+        total = self.count.sum()
+        if total < 2:
+            return np.zeros(len(self.columns)), np.ones(len(self.columns))
+        mean = (self.count[:, None] * self.mean).sum(axis=0) / total
+        m2 = self.m2.sum(axis=0) + (self.count[:, None] * (self.mean - mean) ** 2).sum(axis=0)
+        return mean, np.sqrt(m2 / (total - 1))
+
+    def normalize(self, speakers, values, columns=None):
+        """ z-scores of frames with the statistics of their speakers
+
+        :param speakers: array of the speaker label of every frame
+        :param values: array of shape (frames, len(columns))
+        :param columns: list of str column labels of values, or None for all columns
+        :return: numpy array
+        """
+        codes, labels = pd.factorize(np.asarray(speakers))
+        mean, std = self.statistics(labels, columns)
+        return (np.asarray(values, dtype=np.float64) - mean[codes]) / std[codes]
+
+    def save(self, fn):
+        """ writes the statistics to an .npz file """
+        tmp_fn = fn + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            np.savez(f, columns=np.array(self.columns, dtype=str), speakers=np.array(self.speakers, dtype=str),
+                     count=self.count, mean=self.mean, m2=self.m2, min_frames=self.min_frames)
+        os.replace(tmp_fn, fn)
+
+    @classmethod
+    def load(cls, fn):
+        """ reads statistics written by save
+
+        :return: SpeakerStats object
+        """
+        with np.load(fn) as data:
+            stats = cls(data['columns'].tolist(), int(data['min_frames']))
+            stats.speakers = data['speakers'].tolist()
+            stats.count = data['count']
+            stats.mean = data['mean']
+            stats.m2 = data['m2']
+        stats._rows = {speaker: row for row, speaker in enumerate(stats.speakers)}
+        return stats
+
+    def _row(self, speaker):
+        if speaker not in self._rows:
+            self._rows[speaker] = len(self.speakers)
+            self.speakers.append(speaker)
+            self.count = np.append(self.count, 0)
+            self.mean = np.vstack([self.mean, np.zeros(len(self.columns))])
+            self.m2 = np.vstack([self.m2, np.zeros(len(self.columns))])
+        return self._rows[speaker]
+
+
+def _difference(asl, a, b):
+    return a - b
+
+
+def _radius(asl, x, y):
+    return np.sqrt(x ** 2 + y ** 2)
+
+
+def _angle(asl, x, y):
+    return np.arctan2(x, y)
+
+
+def _standard_features():
+    features = {}
+    for side, hand in (('r', 'right'), ('l', 'left')):
+        for axis in ('x', 'y'):
+            raw = '{}-{}'.format(hand, axis)
+            suffix = side + axis
+            features['grnd-' + suffix] = Feature('grnd-' + suffix, [raw, 'nose-' + axis], _difference)
+            features['norm-' + suffix] = Feature('norm-' + suffix, [raw], _speaker_stats_normalizer(raw))
+            features['delta-' + suffix] = Feature('delta-' + suffix, [raw], video_delta)
+        grnd_x, grnd_y = 'grnd-{}x'.format(side), 'grnd-{}y'.format(side)
+        features['polar-{}r'.format(side)] = Feature('polar-{}r'.format(side), [grnd_x, grnd_y], _radius)
+        features['polar-{}theta'.format(side)] = Feature('polar-{}theta'.format(side), [grnd_x, grnd_y], _angle)
+        features['norm-polar-{}r'.format(side)] = Feature('norm-polar-{}r'.format(side),
+                                                          ['polar-{}r'.format(side)], speaker_centered)
+    return features
+
+
+# features every AslDb can compute on demand, as built by hand in the project notebook
+STANDARD_FEATURES = _standard_features()
+FEATURE_SETS = {
+    'ground': ['grnd-rx', 'grnd-ry', 'grnd-lx', 'grnd-ly'],
+    'norm': ['norm-rx', 'norm-ry', 'norm-lx', 'norm-ly'],
+    'polar': ['polar-rr', 'polar-rtheta', 'polar-lr', 'polar-ltheta'],
+    'delta': ['delta-rx', 'delta-ry', 'delta-lx', 'delta-ly'],
+    'custom': ['norm-polar-rr', 'norm-polar-lr', 'polar-rtheta', 'polar-ltheta'],
+}
+
+
+class VideoStore(object):
+    """ frame table partitioned by video on disk, for corpora that do not fit in memory
+
+    The store directory holds every numeric column as one memory-mapped (frames, columns) array sorted by
+    (video, frame), the frame numbers, and a video -> offset index with each video's speaker.  Reading a video
+    touches only its own rows, and building the store streams the csv files in chunks, so neither needs memory
+    in proportion to the corpus.
+
+    For example, to build a store once and train from it:
+        VideoStore.build(os.path.join('data', 'store'), os.path.join('data', 'hands_condensed.csv'),
+                         os.path.join('data', 'speaker.csv'))
+        asl = AslDb.from_store(os.path.join('data', 'store'))
+        training = asl.build_training(FEATURE_SETS['norm'])
+    """
+
+    def __init__(self, path):
+        """
+        :param path: str directory written by build
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.columns = meta['columns']
+        self.speakers = meta['speakers']
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self.frames = np.load(os.path.join(path, 'frames.npy'), mmap_mode='r')
+        self.videos = np.load(os.path.join(path, 'videos.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.video_speakers = np.load(os.path.join(path, 'video_speakers.npy'))
+        self._video_index = {int(video): i for i, video in enumerate(self.videos)}
+
+    @classmethod
+    def build(cls, path, hands_fn, speakers_fn, chunksize=1000000):
+        """ writes the frames of the hands csv file, with the speakers of speaker.csv, as a store
+
+        The csv file is read twice in chunks: once to count the frames of every video, and once to write each
+        chunk's rows at their videos' offsets.  Videos without a speaker are left out, as in AslDb.
+
+        :param path: str directory, created if needed
+        :param hands_fn: str filename with the columns of hands_condensed.csv
+        :param speakers_fn: str filename with the columns of speaker.csv
+        :param chunksize: int csv rows read at a time
+        :return: VideoStore object
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_fn = os.path.join(path, 'meta.json')
+        # speaker statistics saved by speaker_stats() describe the previous build
+        for fn in (meta_fn, os.path.join(path, 'speaker_stats.npz')):
+            if os.path.exists(fn):
+                os.remove(fn)
+        speaker_df = pd.read_csv(speakers_fn)
+        speaker_of = dict(zip(speaker_df['video'], speaker_df['speaker']))
+
+        counts = {}
+        columns = None
+        for chunk in pd.read_csv(hands_fn, chunksize=chunksize):
+            columns = [c for c in chunk.columns if c not in ('video', 'frame')]
+            chunk = chunk[chunk['video'].isin(speaker_of)]
+            for video, n in chunk['video'].value_counts().items():
+                counts[int(video)] = counts.get(int(video), 0) + int(n)
+        if columns is None:
+            raise ValueError("{} has no frames".format(hands_fn))
+        videos = np.array(sorted(counts), dtype=np.int64)
+        sizes = np.array([counts[v] for v in videos], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        speakers = list(dict.fromkeys(str(speaker_of[v]) for v in videos))
+        video_speakers = np.array([speakers.index(str(speaker_of[v])) for v in videos], dtype=np.int32)
+
+        values = np.lib.format.open_memmap(os.path.join(path, 'values.npy'), mode='w+', dtype=np.int32,
+                                           shape=(int(offsets[-1]), len(columns)))
+        frames = np.lib.format.open_memmap(os.path.join(path, 'frames.npy'), mode='w+', dtype=np.int32,
+                                           shape=(int(offsets[-1]),))
+        cursor = offsets[:-1].copy()
+        for chunk in pd.read_csv(hands_fn, chunksize=chunksize):
+            chunk = chunk[chunk['video'].isin(speaker_of)]
+            codes = np.searchsorted(videos, chunk['video'].values)
+            order = np.argsort(codes, kind='stable')
+            sorted_codes = codes[order]
+            group_starts = np.searchsorted(sorted_codes, sorted_codes, side='left')
+            positions = cursor[sorted_codes] + np.arange(len(order)) - group_starts
+            values[positions] = chunk[columns].values[order]
+            frames[positions] = chunk['frame'].values[order]
+            cursor += np.bincount(codes, minlength=len(videos))
+        # rows of a video can arrive in any order; sort each video's rows by frame
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            order = np.argsort(frames[start:end], kind='stable')
+            if np.any(order != np.arange(end - start)):
+                values[start:end] = values[start:end][order]
+                frames[start:end] = frames[start:end][order]
+        values.flush()
+        frames.flush()
+        del values, frames
+
+        _write_array(os.path.join(path, 'videos.npy'), videos)
+        _write_array(os.path.join(path, 'offsets.npy'), offsets)
+        _write_array(os.path.join(path, 'video_speakers.npy'), video_speakers)
+        # meta.json is written last so that a partially written store is never opened
+        _write_json(meta_fn, {'columns': columns, 'speakers': speakers,
+                              'sources': [os.path.abspath(hands_fn), os.path.abspath(speakers_fn)]})
+        return cls(path)
+
+    def frame_table(self, videos):
+        """ frame table of the given videos in the format of AslDb.df, read from disk
+
+        :param videos: iterable of int video numbers; unknown videos raise KeyError
+        :return: pandas dataframe indexed by (video, frame)
+        """
+        rows = [self._video_index[int(video)] for video in sorted(set(int(v) for v in videos))]
+        starts, ends = self.offsets[rows], self.offsets[np.array(rows, dtype=np.int64) + 1]
+        sizes = ends - starts
+        positions = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+        df = pd.DataFrame(np.asarray(self.values[positions]), columns=self.columns)
+        df['speaker'] = np.asarray(self.speakers, dtype=object)[np.repeat(self.video_speakers[rows], sizes)]
+        df.index = pd.MultiIndex.from_arrays([np.repeat(self.videos[rows], sizes), np.asarray(self.frames[positions])],
+                                             names=['video', 'frame'])
+        return compact_frame_table(df)
+
+    def iter_frame_tables(self, max_frames=1000000):
+        """ frame tables of consecutive groups of whole videos of at most about max_frames frames each """
+        start = 0
+        while start < len(self.videos):
+            end = start + 1
+            while end < len(self.videos) and self.offsets[end + 1] - self.offsets[start] <= max_frames:
+                end += 1
+            yield self.frame_table(self.videos[start:end])
+            start = end
+
+    def speaker_stats(self, max_frames=1000000):
+        """ SpeakerStats of the numeric columns of every frame, read one group of videos at a time; saved in
+        the store directory after the first call
+
+        :return: SpeakerStats object
+        """
+        fn = os.path.join(self.path, 'speaker_stats.npz')
+        if os.path.exists(fn):
+            return SpeakerStats.load(fn)
+        stats = SpeakerStats(self.columns)
+        for df in self.iter_frame_tables(max_frames):
+            stats.update(df['speaker'].values, df[self.columns].values)
+        try:
+            stats.save(fn)
+        except OSError as e:
+            warnings.warn("could not save speaker statistics to {}: {}".format(fn, e))
+        return stats
+
+
+def load_frame_table(hands_fn, speakers_fn, cache_dir=None):
+    """ merged hands/speaker frame table indexed by (video, frame), read through the binary cache when possible
+
+    The cache stores the index levels and each group of same-dtype columns as one .npy array, with the
+    speaker names stored as integer codes.  It is keyed by the source file paths and is valid as long as both
+    files keep their size and mtime, or failing that, their content hash.  Cached arrays are opened with
+    copy-on-write memory mapping, so processes loading the same corpus share the same pages.  Integer columns
+    and index levels are stored in the smallest safe integer types, see compact_frame_table.
+
+    :param hands_fn: str
+    :param speakers_fn: str
+    :param cache_dir: str or None
+    :return: pandas dataframe
+    """
+    if cache_dir is None:
+        return _parse_frame_table(hands_fn, speakers_fn)
+    sources = [hands_fn, speakers_fn]
+    path = os.path.join(cache_dir, _cache_key(sources))
+    df = _read_frame_cache(path, sources)
+    if df is None:
+        df = _parse_frame_table(hands_fn, speakers_fn)
+        try:
+            _write_frame_cache(path, sources, df)
+        except OSError as e:
+            warnings.warn("could not write frame cache to {}: {}".format(path, e))
+    # caches written before the compact integer types are converted on load
+    return compact_frame_table(df)
+
+
+def compact_frame_table(df):
+    """ frame table with int32 integer columns and the smallest integer types for the video and frame ids
+
+    Columns keep int32 rather than smaller types so that arithmetic on them, e.g. squaring a position, cannot
+    overflow; ids get a type whose range is at least twice their largest magnitude.
+
+    :param df: pandas dataframe indexed by (video, frame)
+    :return: pandas dataframe, df itself when it is already compact
+    """
+    columns = {col: np.int32 for col in df.columns
+               if pd.api.types.is_integer_dtype(df[col]) and df[col].dtype != np.int32
+               and _fits(df[col].values, np.int32)}
+    if columns:
+        df = df.astype(columns)
+    levels = [df.index.get_level_values(i).values for i in range(df.index.nlevels)]
+    compact = [values.astype(_smallest_int(values), copy=False) if values.dtype.kind in 'iu' else values
+               for values in levels]
+    if any(a.dtype != b.dtype for a, b in zip(levels, compact)):
+        df = df.set_axis(pd.MultiIndex.from_arrays(compact, names=df.index.names), axis=0)
+    return df
+
+
+def _fits(values, dtype):
+    """ whether values and twice their magnitude fit dtype """
+    if len(values) == 0:
+        return True
+    info = np.iinfo(dtype)
+    return 2 * int(values.max()) <= info.max and 2 * int(values.min()) >= info.min
+
+
+def _smallest_int(values):
+    for dtype in (np.int16, np.int32):
+        if _fits(values, dtype):
+            return dtype
+    return np.int64
+
+
+def _same_buffer(a, b):
+    """ whether two arrays are views of the same memory with the same layout """
+    if not isinstance(a, np.ndarray) or not isinstance(b, np.ndarray):
+        return a is b
+    return (a.shape == b.shape and a.dtype == b.dtype and a.strides == b.strides
+            and a.__array_interface__['data'][0] == b.__array_interface__['data'][0])
+
+
+def _numeric_values(values, dtype):
+    """ values cast to dtype if they are numeric, otherwise unchanged """
+    if values.dtype.kind in 'biuf':
+        return values.astype(dtype, copy=False)
+    return values
+
+
+def _parse_frame_table(hands_fn, speakers_fn):
+    df = pd.read_csv(hands_fn).merge(pd.read_csv(speakers_fn), on='video')
+    df.set_index(['video', 'frame'], inplace=True)
+    return compact_frame_table(df)
+
+
+def _cache_key(sources):
+    key = '|'.join(os.path.abspath(fn) for fn in sources)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def _file_hash(fn):
+    sha = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _file_signature(fn, with_hash=True):
+    stat = os.stat(fn)
+    signature = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        signature['sha1'] = _file_hash(fn)
+    return signature
+
+
+def _read_frame_cache(path, sources):
+    """ returns the cached frame table at path, or None if it is missing or stale """
+    meta_fn = os.path.join(path, 'meta.json')
+    try:
+        with open(meta_fn) as f:
+            meta = json.load(f)
+        stored = meta['sources']
+        if [s['path'] for s in stored] != [os.path.abspath(fn) for fn in sources]:
+            return None
+        refreshed = False
+        for fn, s in zip(sources, stored):
+            current = _file_signature(fn, with_hash=False)
+            if (current['size'], current['mtime_ns']) == (s['size'], s['mtime_ns']):
+                continue
+            # touched but possibly unchanged files are confirmed by their content hash
+            if current['size'] != s['size'] or _file_hash(fn) != s['sha1']:
+                return None
+            s.update(current)
+            refreshed = True
+
+        index = pd.MultiIndex.from_arrays(
+            [np.load(os.path.join(path, level['file'])) for level in meta['index']],
+            names=[level['name'] for level in meta['index']])
+        df = None
+        for block in meta['blocks']:
+            values = np.load(os.path.join(path, block['file']), mmap_mode='c')
+            part = pd.DataFrame(values, index=index, columns=block['columns'], copy=False)
+            if df is None:
+                df = part
+            else:
+                for col in block['columns']:
+                    df[col] = part[col]
+        for col in meta['objects']:
+            codes = np.load(os.path.join(path, col['file']))
+            values = np.asarray(col['categories'], dtype=object)[codes]
+            if df is None:
+                df = pd.DataFrame({col['name']: values}, index=index)
+            else:
+                df[col['name']] = values
+        if list(df.columns) != meta['columns']:
+            df = df[meta['columns']]
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if refreshed:
+        try:
+            _write_json(meta_fn, meta)
+        except OSError:
+            pass
+    return df
+
+
+def _write_frame_cache(path, sources, df):
+    os.makedirs(path, exist_ok=True)
+    meta_fn = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_fn):
+        os.remove(meta_fn)
+    meta = {
+        'sources': [dict(path=os.path.abspath(fn), **_file_signature(fn)) for fn in sources],
+        'columns': list(df.columns),
+        'index': [],
+        'blocks': [],
+        'objects': [],
+    }
+    for i, name in enumerate(df.index.names):
+        fn = 'index-{}.npy'.format(i)
+        _write_array(os.path.join(path, fn), df.index.get_level_values(i).values)
+        meta['index'].append({'name': name, 'file': fn})
+
+    numeric = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+    dtypes = []
+    for col in numeric:
+        if df[col].dtype not in dtypes:
+            dtypes.append(df[col].dtype)
+    for dtype in dtypes:
+        columns = [col for col in numeric if df[col].dtype == dtype]
+        fn = 'block-{}.npy'.format(dtype.name)
+        _write_array(os.path.join(path, fn), df[columns].to_numpy())
+        meta['blocks'].append({'columns': columns, 'file': fn})
+
+    for i, col in enumerate(c for c in df.columns if c not in numeric):
+        codes, categories = pd.factorize(df[col])
+        fn = 'object-{}.npy'.format(i)
+        _write_array(os.path.join(path, fn), codes)
+        meta['objects'].append({'name': col, 'file': fn, 'categories': [str(c) for c in categories]})
+
+    # meta.json is written last so that a partially written cache is never read
+    _write_json(meta_fn, meta)
+
+
+def _write_array(fn, values):
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        np.save(f, np.ascontiguousarray(values))
+    os.replace(tmp_fn, fn)
+
+
+def _write_json(fn, obj):
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_fn, fn)
+
+
+def _locate_frame_ranges(frames_df, ranges_df):
+    """ sorts the frame table once by (video, frame) and binary searches each (video, startframe, endframe) range
+
+    :return: (pandas dataframe, numpy array, numpy array)
+        sorted frame table, first row position and number of rows of each range
+    """
+    starts = ranges_df['startframe'].values.astype(np.int64)
+    ends = ranges_df['endframe'].values.astype(np.int64)
+    sorted_df = frames_df if frames_df.index.is_monotonic_increasing else frames_df.sort_index()
+    videos = sorted_df.index.get_level_values(0).values.astype(np.int64)
+    frames = sorted_df.index.get_level_values(1).values.astype(np.int64)
+
+    # a single integer key per (video, frame) keeps the lexicographic order of the sorted index
+    stride = max(frames.max(initial=0), ends.max(initial=0)) + 1
+    keys = videos * stride + frames
+    range_videos = ranges_df['video'].values.astype(np.int64)
+    lo = np.searchsorted(keys, range_videos * stride + starts, side='left')
+    hi = np.searchsorted(keys, range_videos * stride + ends, side='right')
+
+    counts = np.maximum(ends - starts + 1, 0)
+    missing = np.flatnonzero(np.maximum(hi - lo, 0) != counts)
+    if len(missing) > 0:
+        i = missing[0]
+        raise KeyError("frames {}-{} of video {} not found".format(starts[i], ends[i], range_videos[i]))
+    return sorted_df, lo, counts
+
+
+def load_frame_buffer(frames_df, ranges_df, feature_list, dtype=np.float64):
+    """ gathers every (video, startframe, endframe) range into one contiguous buffer
+
+    The frame table is sorted once by (video, frame) and every range is located with a binary search, so the
+    loading cost grows with the number of rows rather than with one index lookup per frame per feature.
+
+    :param frames_df: pandas dataframe indexed by (video, frame), e.g. AslDb.df
+    :param ranges_df: pandas dataframe with video, startframe and endframe columns (endframe inclusive)
+    :param feature_list: list of str feature labels
+    :param dtype: numpy dtype of the buffer
+    :return: (numpy array, list)
+        (num_frames, num_features) buffer with the ranges stacked in the order of ranges_df, and the
+        number of frames of each range
+    """
+    sorted_df, lo, counts = _locate_frame_ranges(frames_df, ranges_df)
+    positions = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    X = np.ascontiguousarray(sorted_df[feature_list].values[positions], dtype=dtype)
+    return X, [int(n) for n in counts]
+
+
+def index_sequences(X, lengths, keys):
+    """ builds the getter dictionaries as views of one contiguous buffer, without copying
+
+    :param X: numpy array of stacked sequences, where the sequences of each key are adjacent
+    :param lengths: list of sequence lengths within X
+    :param keys: word or item key of each sequence
+    :return: (dict, dict)
+        sequences as {key: [sequence view, ...]} and (X, lengths) tuples as {key: (X view, [length, ...])}
+    """
+    offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    sequences = {}
+    Xlengths = {}
+    first = {}
+    for i, key in enumerate(keys):
+        if key in sequences:
+            if i != first[key] + len(sequences[key]):
+                raise ValueError("sequences of {} are not adjacent in the buffer".format(key))
+            sequences[key].append(X[offsets[i]:offsets[i + 1]])
+        else:
+            sequences[key] = [X[offsets[i]:offsets[i + 1]]]
+            first[key] = i
+    for key, key_sequences in sequences.items():
+        start = first[key]
+        end = start + len(key_sequences)
+        Xlengths[key] = X[offsets[start]:offsets[end]], list(lengths[start:end])
+    return sequences, Xlengths
+
 
 if __name__ == '__main__':
     asl= AslDb()
-    print(asl.df.ix[98, 1])
+    print(asl.df.loc[(98, 1)])
 
 
@@ -0,0 +1,146 @@
+""" fit events of the model selectors and sinks that collect them
+
+A selector created with events=sink calls sink.record(event) once for every GaussianHMM fit it makes, including
+fits read from the fit cache and fits that raised.  Without a sink nothing is timed or recorded.
+
+For example, to see where training time goes:
+    collector = EventCollector()
+    models = {word: SelectorBIC(sequences, Xlengths, word, events=collector).select() for word in words}
+    collector.profile('word')
+"""
+import json
+import os
+from collections import OrderedDict
+
+
+class FitEvent(object):
+    """ one GaussianHMM fit of a model selector
+
+    Attributes:
+        selector: str selector class name
+        word: str
+        n_states: int
+        fold: int cross-validation fold, or None for fits on all of the word's data
+        iterations: int EM iterations used, or None when the fit came from the cache or raised
+        converged: bool, or None when unknown
+        wall_time: float seconds spent fitting, including cache lookups
+        logL: float log-likelihood the selector scored the fit with, else the final EM log-likelihood
+        criterion: str name of the selection score, e.g. 'BIC', or None for fits that were not scored
+        score: float criterion value of the fit
+        exception: str type name of the exception raised while fitting or scoring, or None
+        cached: bool, the parameters were read from the fit cache
+    """
+    FIELDS = ('selector', 'word', 'n_states', 'fold', 'iterations', 'converged', 'wall_time', 'logL',
+              'criterion', 'score', 'exception', 'cached')
+
+    def __init__(self, selector, word, n_states, fold=None, iterations=None, converged=None, wall_time=0.0,
+                 logL=None, criterion=None, score=None, exception=None, cached=False):
+        self.selector = selector
+        self.word = word
+        self.n_states = n_states
+        self.fold = fold
+        self.iterations = iterations
+        self.converged = converged
+        self.wall_time = wall_time
+        self.logL = logL
+        self.criterion = criterion
+        self.score = score
+        self.exception = exception
+        self.cached = cached
+
+    def as_dict(self):
+        return OrderedDict((field, _plain(getattr(self, field))) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{field: values.get(field) for field in cls.FIELDS})
+
+    def __repr__(self):
+        return 'FitEvent({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in self.as_dict().items()))
+
+
+class EventCollector(object):
+    """ keeps the events of the current process in memory """
+
+    def __init__(self):
+        self.events = []
+
+    def record(self, event: FitEvent):
+        self.events.append(event)
+
+    def profile(self, by='word'):
+        """ see profile """
+        return profile(self.events, by)
+
+    def clear(self):
+        self.events = []
+
+
+class JsonLinesSink(object):
+    """ appends every event as one json line to a file
+
+    Each line is written with a single append, so the workers of train_all_words can share one sink.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        dirname = os.path.dirname(fn)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def record(self, event: FitEvent):
+        line = json.dumps(event.as_dict()) + '\n'
+        with open(self.fn, 'a') as f:
+            f.write(line)
+
+    def read(self):
+        """ events written to the file so far
+
+        :return: list of FitEvent objects
+        """
+        return read_events(self.fn)
+
+    def profile(self, by='word'):
+        """ see profile """
+        return profile(self.read(), by)
+
+
+def read_events(fn):
+    """ events of a json lines file written by JsonLinesSink
+
+    :return: list of FitEvent objects
+    """
+    with open(fn) as f:
+        return [FitEvent.from_dict(json.loads(line)) for line in f if line.strip()]
+
+
+def profile(events, by='word'):
+    """ timing profile of fit events grouped by one or more event fields
+
+    :param events: iterable of FitEvent objects
+    :param by: str field name, e.g. 'word' or 'selector', or tuple of field names
+    :return: dict keyed by field value (tuple of values for several fields), most expensive group first, of
+        dicts with fits, cached, failures, unconverged, iterations and wall_time totals and mean_wall_time
+    """
+    fields = (by,) if isinstance(by, str) else tuple(by)
+    groups = {}
+    for event in events:
+        key = getattr(event, fields[0]) if len(fields) == 1 else tuple(getattr(event, f) for f in fields)
+        group = groups.setdefault(key, {'fits': 0, 'cached': 0, 'failures': 0, 'unconverged': 0,
+                                        'iterations': 0, 'wall_time': 0.0})
+        group['fits'] += 1
+        group['cached'] += bool(event.cached)
+        group['failures'] += event.exception is not None
+        group['unconverged'] += event.converged is False
+        group['iterations'] += event.iterations or 0
+        group['wall_time'] += event.wall_time or 0.0
+    for group in groups.values():
+        group['mean_wall_time'] = group['wall_time'] / group['fits']
+    return OrderedDict(sorted(groups.items(), key=lambda item: item[1]['wall_time'], reverse=True))
+
+
+def _plain(value):
+    """ json serializable form of numpy scalars """
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
@@ -0,0 +1,192 @@
+""" grid runner for feature set x selector x state range experiments
+
+Every feature set of the grid is built once with build_training/build_test and handed to every worker
+process once, see asl_utils.run_in_pool.  The (cell, word) selection jobs of all cells are then scheduled
+together over one pool, most expensive first, so that the pool stays busy until the whole grid is done.
+Every cell is recognized on its test set and its WER and timings are written as one row of a csv results
+table.
+
+Results depend only on the grid and random_state, not on the number of workers or the order jobs finish in.
+
+For example, to compare every feature set with BIC and DIC over 2 to 15 states on 8 processes:
+    python asl_experiments.py --features ground norm polar delta custom --selectors BIC DIC --states 2-15 -j 8
+"""
+import argparse
+import itertools
+import logging
+import os
+import time
+import warnings
+
+import pandas as pd
+
+from asl_data import AslDb, FEATURE_SETS
+from asl_fit_cache import FitCache
+from asl_utils import estimate_training_cost, run_in_pool
+from my_model_selectors import SelectorConstant, SelectorBIC, SelectorDIC, SelectorCV
+from my_recognizer import recognize
+
+SELECTORS = {'Constant': SelectorConstant, 'BIC': SelectorBIC, 'DIC': SelectorDIC, 'CV': SelectorCV}
+RESULTS_FN = os.path.join('data', 'experiments', 'results.csv')
+RESULT_COLUMNS = ['features', 'selector', 'min_states', 'max_states', 'words', 'failed_words', 'test_items',
+                  'correct', 'wer', 'train_time', 'train_wall_time', 'recognize_time']
+
+
+class Cell(object):
+    """ one experiment of the grid: a feature set, a selector and a state range """
+
+    def __init__(self, features, selector, min_states, max_states):
+        """
+        :param features: str key of FEATURE_SETS
+        :param selector: str key of SELECTORS
+        :param min_states: int
+        :param max_states: int
+        """
+        self.features = features
+        self.selector = selector
+        self.min_states = min_states
+        self.max_states = max_states
+
+    def selector_kwargs(self):
+        return dict(n_constant=3, min_n_components=self.min_states, max_n_components=self.max_states)
+
+    def __repr__(self):
+        return 'Cell({}, {}, {}-{})'.format(self.features, self.selector, self.min_states, self.max_states)
+
+
+def make_grid(features, selectors, state_ranges):
+    """ every combination of the given feature sets, selectors and (min_states, max_states) ranges
+
+    :return: list of Cell objects
+    """
+    return [Cell(f, s, lo, hi) for f, s, (lo, hi) in itertools.product(features, selectors, state_ranges)]
+
+
+def run_grid(cells, n_jobs=None, random_state=14, fit_cache_dir=None, results_fn=RESULTS_FN, asl=None,
+             verbose=True):
+    """ trains and recognizes every cell of the grid
+
+    :param cells: list of Cell objects, e.g. from make_grid
+    :param n_jobs: int or None
+        number of worker processes; 1 runs in this process and None uses one worker per cpu
+    :param random_state: int seed of every GaussianHMM fit
+    :param fit_cache_dir: str or None
+        directory of an on-disk fit cache shared by the workers and later runs; None caches in memory only
+    :param results_fn: str csv filename of the results table, or None to not write it
+    :param asl: AslDb object or None to load the default database
+    :param verbose: bool, prints each cell as it finishes
+    :return: pandas dataframe with one row of RESULT_COLUMNS per cell
+    """
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    logging.getLogger('hmmlearn').setLevel(logging.ERROR)
+    asl = AslDb() if asl is None else asl
+    datasets = {}
+    for name in dict.fromkeys(cell.features for cell in cells):
+        training = asl.build_training(FEATURE_SETS[name])
+        datasets[name] = (training.get_all_sequences(), training.get_all_Xlengths(), training.words)
+    test_sets = {name: asl.build_test(FEATURE_SETS[name]) for name in datasets}
+
+    jobs = []
+    for c, cell in enumerate(cells):
+        sequences, Xlengths, words = datasets[cell.features]
+        selector = SELECTORS[cell.selector]
+        for word in words:
+            probe = selector(sequences, Xlengths, word, fit_cache=None, **cell.selector_kwargs())
+            jobs.append((estimate_training_cost(Xlengths, word, probe), c, word))
+    # most expensive first, ties in grid order, so that one large word does not start last
+    jobs = [(c, word) for _, c, word in sorted(jobs, key=lambda job: (-job[0], job[1], job[2]))]
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    initargs = (cells, datasets, random_state, fit_cache_dir)
+    start = time.perf_counter()
+    results = {}
+    if n_jobs > 1 and len(jobs) > 1:
+        trained = run_in_pool(_train_job, jobs, n_jobs, _init_grid_worker, initargs)
+    else:
+        _init_grid_worker(*initargs)
+        trained = [_train_job(job) for job in jobs]
+    for c, word, model, seconds in trained:
+        results[(c, word)] = model, seconds
+    train_wall_time = time.perf_counter() - start
+
+    rows = []
+    for c, cell in enumerate(cells):
+        words = datasets[cell.features][2]
+        models = {word: results[(c, word)][0] for word in words}
+        test_set = test_sets[cell.features]
+        start = time.perf_counter()
+        _, guesses = recognize(models, test_set)
+        recognize_time = time.perf_counter() - start
+        correct = sum(guess == word for guess, word in zip(guesses, test_set.wordlist))
+        rows.append({
+            'features': cell.features, 'selector': cell.selector,
+            'min_states': cell.min_states, 'max_states': cell.max_states,
+            'words': len(words), 'failed_words': sum(model is None for model in models.values()),
+            'test_items': test_set.num_items, 'correct': correct,
+            'wer': 1 - correct / test_set.num_items if test_set.num_items else None,
+            # summed over the workers, and the wall time of the whole grid's training
+            'train_time': sum(results[(c, word)][1] for word in words),
+            'train_wall_time': train_wall_time,
+            'recognize_time': recognize_time,
+        })
+        if verbose:
+            wer = 'n/a' if rows[-1]['wer'] is None else '{:.4f}'.format(rows[-1]['wer'])
+            print("{:40} WER {:>6}  train {:8.1f}s  recognize {:6.2f}s".format(
+                repr(cell), wer, rows[-1]['train_time'], recognize_time))
+    table = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+    if results_fn is not None:
+        dirname = os.path.dirname(results_fn)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        table.to_csv(results_fn, index=False)
+    return table
+
+
+# grid and training data of the current worker process, set once per worker by _init_grid_worker
+_worker_grid = None
+
+
+def _init_grid_worker(cells, datasets, random_state, fit_cache_dir):
+    global _worker_grid
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+    logging.getLogger('hmmlearn').setLevel(logging.ERROR)
+    fit_cache = FitCache(fit_cache_dir)
+    _worker_grid = cells, datasets, random_state, fit_cache
+
+
+def _train_job(job):
+    cells, datasets, random_state, fit_cache = _worker_grid
+    c, word = job
+    cell = cells[c]
+    sequences, Xlengths, _ = datasets[cell.features]
+    start = time.perf_counter()
+    model = SELECTORS[cell.selector](sequences, Xlengths, word, random_state=random_state, fit_cache=fit_cache,
+                                     **cell.selector_kwargs()).select()
+    return c, word, model, time.perf_counter() - start
+
+
+def _state_range(text):
+    lo, _, hi = text.partition('-')
+    return int(lo), int(hi or lo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--features', nargs='+', choices=sorted(FEATURE_SETS), default=sorted(FEATURE_SETS))
+    parser.add_argument('--selectors', nargs='+', choices=sorted(SELECTORS), default=sorted(SELECTORS))
+    parser.add_argument('--states', nargs='+', type=_state_range, default=[(2, 10)],
+                        help='state ranges as min-max, e.g. 2-10 2-15')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes; one per cpu by default')
+    parser.add_argument('--random-state', type=int, default=14)
+    parser.add_argument('--fit-cache', default=None, help='directory of an on-disk fit cache')
+    parser.add_argument('--out', default=RESULTS_FN)
+    args = parser.parse_args(argv)
+
+    cells = make_grid(args.features, args.selectors, args.states)
+    run_grid(cells, n_jobs=args.jobs, random_state=args.random_state, fit_cache_dir=args.fit_cache,
+             results_fn=args.out)
+
+
+if __name__ == '__main__':
+    main()
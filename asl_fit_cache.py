@@ -0,0 +1,206 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import hmmlearn
+import numpy as np
+from hmmlearn.hmm import GaussianHMM
+
+
+class FitCache(object):
+    """ cache of fitted GaussianHMM parameters keyed by training data and hyperparameters
+
+    Entries are kept in memory and, when a cache directory is given, as one .npz file per fit on disk so that
+    they survive between runs.  Both levels are bounded and evict the least recently used entries.  Only
+    parameters are stored, as copies taken on put and handed out again on every get, so models built from an
+    entry can be modified freely.  Entries stored with model_params(model, monitor=True) also restore the
+    monitor_ of the original fit.  Keys include the hmmlearn version, so that an upgrade does not reuse fits of
+    the old version.
+
+    Selectors cache nothing unless given a cache.
+
+    For example, to reuse fits across selector runs and processes:
+        cache = FitCache(os.path.join('data', 'fit_cache'))
+        model = SelectorBIC(sequences, Xlengths, 'FISH', fit_cache=cache).select()
+    """
+
+    def __init__(self, cache_dir=None, max_memory_entries=1024, max_disk_entries=20000):
+        """
+        :param cache_dir: str or None
+            directory for the on-disk level; None keeps the cache in memory only
+        :param max_memory_entries: int
+        :param max_disk_entries: int
+        """
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(X, lengths, **hyperparameters):
+        """ hash of the training data and GaussianHMM hyperparameters of a fit
+
+        :param X: array of stacked sequences
+        :param lengths: list of sequence lengths within X
+        :param hyperparameters: GaussianHMM constructor arguments
+        :return: str
+        """
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        sha = hashlib.sha1()
+        sha.update(hmmlearn.__version__.encode('utf-8'))
+        sha.update(repr(X.shape).encode('utf-8'))
+        sha.update(X.tobytes())
+        sha.update(np.asarray(lengths, dtype=np.int64).tobytes())
+        sha.update(repr(sorted(hyperparameters.items())).encode('utf-8'))
+        return sha.hexdigest()
+
+    def get(self, key):
+        """ cached parameters for key, or None
+
+        :param key: str as returned by FitCache.key
+        :return: dict of numpy arrays, a copy of the entry
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return _copy_params(self._memory[key])
+        params = self._read(key)
+        if params is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, params)
+        return _copy_params(params)
+
+    def put(self, key, params):
+        """ stores the parameters of a fit
+
+        :param key: str as returned by FitCache.key
+        :param params: dict of numpy arrays as returned by model_params; the cache keeps a copy
+        """
+        params = _copy_params(params)
+        self._remember(key, params)
+        if self.cache_dir is not None:
+            self._write(key, params)
+
+    def clear(self):
+        """ drops every entry, in memory and on disk """
+        self._memory.clear()
+        for fn in self._disk_files():
+            os.remove(fn)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _remember(self, key, params):
+        self._memory[key] = params
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _disk_files(self):
+        if self.cache_dir is None:
+            return []
+        return [os.path.join(self.cache_dir, fn) for fn in os.listdir(self.cache_dir) if fn.endswith('.npz')]
+
+    def _read(self, key):
+        if self.cache_dir is None:
+            return None
+        fn = self._path(key)
+        try:
+            with np.load(fn) as data:
+                params = {name: data[name] for name in data.files}
+            # the mtime of a file marks its last use for eviction
+            os.utime(fn)
+        except (OSError, ValueError):
+            return None
+        return params
+
+    def _write(self, key, params):
+        fn = self._path(key)
+        tmp_fn = fn + '.tmp'
+        try:
+            with open(tmp_fn, 'wb') as f:
+                np.savez(f, **params)
+            os.replace(tmp_fn, fn)
+        except OSError:
+            return
+        files = self._disk_files()
+        if len(files) > self.max_disk_entries:
+            files.sort(key=os.path.getmtime)
+            for stale in files[:len(files) - self.max_disk_entries]:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+
+def model_params(model: GaussianHMM, monitor=False):
+    """ fitted parameters of a diagonal GaussianHMM as a dict of arrays
+
+    :param model: GaussianHMM object
+    :param monitor: bool, also returns the state of the model's convergence monitor, for model_from_params to
+        restore
+    :return: dict of copies of the model's arrays
+    """
+    covars = np.asarray(model.covars_)
+    if covars.ndim == 3:
+        covars = np.diagonal(covars, axis1=1, axis2=2)
+    params = {
+        'startprob': np.array(model.startprob_),
+        'transmat': np.array(model.transmat_),
+        'means': np.array(model.means_),
+        'covars': np.array(covars),
+    }
+    if monitor:
+        params['monitor_history'] = np.array(list(model.monitor_.history), dtype=np.float64)
+        params['monitor_iter'] = np.array(model.monitor_.iter)
+    return params
+
+
+def _copy_params(params):
+    return {name: np.array(value) for name, value in params.items()}
+
+
+def params_digest(params):
+    """ hash of a parameter dict, e.g. to key a warm-started fit by its initial parameters; None for None
+
+    :param params: dict as returned by model_params, or None
+    :return: str or None
+    """
+    if params is None:
+        return None
+    sha = hashlib.sha1()
+    for name in sorted(params):
+        sha.update(name.encode('utf-8'))
+        sha.update(np.ascontiguousarray(params[name], dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def model_from_params(params: dict, **hyperparameters):
+    """ builds a GaussianHMM with fitted parameters without running EM; the model shares the arrays of params,
+    and its monitor_ is that of the original fit if params carry one
+
+    :param params: dict as returned by model_params
+    :param hyperparameters: GaussianHMM constructor arguments
+    :return: GaussianHMM object
+    """
+    hyperparameters.setdefault('covariance_type', 'diag')
+    hyperparameters['n_components'] = len(params['startprob'])
+    model = GaussianHMM(**hyperparameters)
+    model.n_features = params['means'].shape[1]
+    model.startprob_ = params['startprob']
+    model.transmat_ = params['transmat']
+    model.means_ = params['means']
+    model.covars_ = params['covars']
+    if 'monitor_history' in params:
+        model.monitor_.history.extend(float(logL) for logL in params['monitor_history'])
+        model.monitor_.iter = int(params['monitor_iter'])
+    return model
@@ -0,0 +1,232 @@
+""" n-gram language model over sign words and beam-pruned Viterbi decoding of whole sentences
+
+The model is held as one dense array of natural-log probabilities, log_probs[h1, ..., w] = log P(w | h1 ...),
+with backoff and interpolation already resolved.  Decoding a sentence then only indexes into this array, so
+every test sentence can be decoded again for each language model weight of a sweep.
+
+For example, to decode the test sentences with a bigram model of the training sentences:
+    lm = NgramLM.from_words_csv(os.path.join('data', 'train_words.csv'), order=2)
+    guesses = recognize_sentences(probabilities, test_set, lm, lm_weight=10)
+"""
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+BOS = '<s>'
+EOS = '</s>'
+UNK = '<unk>'
+# ARPA files use log10 probabilities and -99 for zero probability
+_LN10 = math.log(10)
+_ARPA_ZERO = -99.0
+
+
+class NgramLM(object):
+    """ n-gram language model stored as a dense log-probability table """
+
+    def __init__(self, words: list, log_probs):
+        """
+        :param words: list of str, the table's index labels; includes BOS, EOS and UNK
+        :param log_probs: float array with order axes of len(words), natural log probabilities
+        """
+        self.words = list(words)
+        self.log_probs = np.asarray(log_probs, dtype=np.float64)
+        self.order = self.log_probs.ndim
+        self.index = {word: i for i, word in enumerate(self.words)}
+        self._tables = {}
+
+    @classmethod
+    def train(cls, sentences, order=2, discount=0.75):
+        """ interpolated absolute discounting estimate from word sequences
+
+        :param sentences: iterable of lists of str words
+        :param order: int, 1 for unigrams, 2 for bigrams, ...
+        :param discount: float in (0, 1], subtracted from every seen n-gram count
+        :return: NgramLM object
+        """
+        sentences = [list(sentence) for sentence in sentences]
+        words = [BOS, EOS, UNK] + sorted({word for sentence in sentences for word in sentence} - {BOS, EOS, UNK})
+        index = {word: i for i, word in enumerate(words)}
+        V = len(words)
+
+        # every n-gram of every order, with sentences padded by BOS on the left and closed by EOS
+        grams = [[] for _ in range(order)]
+        for sentence in sentences:
+            ids = [index[BOS]] * (order - 1) + [index[word] for word in sentence] + [index[EOS]]
+            for t in range(order - 1, len(ids)):
+                for k in range(1, order + 1):
+                    grams[k - 1].append(ids[t - k + 1:t + 1])
+
+        # uniform over every word that can be predicted, i.e. all but BOS
+        probs = np.full(V, 1.0 / (V - 1))
+        probs[index[BOS]] = 0.0
+        for k in range(1, order + 1):
+            counts = np.zeros((V,) * k)
+            if grams[k - 1]:
+                np.add.at(counts, tuple(np.array(grams[k - 1]).T), 1)
+            history_counts = counts.sum(axis=-1, keepdims=True)
+            history_types = (counts > 0).sum(axis=-1, keepdims=True)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                seen = np.maximum(counts - discount, 0) / history_counts
+                backoff = discount * history_types / history_counts
+            lower = probs[None] if k > 1 else probs
+            probs = np.where(history_counts > 0, seen + backoff * lower, np.broadcast_to(lower, counts.shape))
+        with np.errstate(divide='ignore'):
+            return cls(words, np.log(probs))
+
+    @classmethod
+    def from_words_csv(cls, csvfile=os.path.join('data', 'train_words.csv'), order=2, discount=0.75):
+        """ trains on the sentences of a words csv file, one per video in startframe order
+
+        :param csvfile: str filename with the format of train_words.csv
+        :return: NgramLM object
+        """
+        df = pd.read_csv(csvfile).sort_values(['video', 'startframe'], kind='stable')
+        return cls.train(df.groupby('video', sort=False)['word'].apply(list), order, discount)
+
+    @classmethod
+    def from_arpa(cls, fn, vocabulary=None, order=None):
+        """ loads a backoff model in ARPA format and resolves it into a dense table
+
+        :param fn: str filename
+        :param vocabulary: list of str words to keep, e.g. the recognizer's words, or None for every unigram
+            of the file; the table has len(vocabulary)**order entries, so large vocabularies should be
+            restricted.  Words missing from the file get the probability of <unk>
+        :param order: int or None to use the highest order of the file
+        :return: NgramLM object
+        """
+        sections = _read_arpa(fn)
+        order = order or max(sections)
+        unigrams = sections[1]
+        if vocabulary is None:
+            vocabulary = [gram[0] for gram in unigrams]
+        words = [BOS, EOS, UNK] + [word for word in dict.fromkeys(vocabulary) if word not in (BOS, EOS, UNK)]
+        index = {word: i for i, word in enumerate(words)}
+        V = len(words)
+
+        unk = unigrams.get((UNK,), (_ARPA_ZERO, 0.0))
+        log_probs = np.full(V, unk[0])
+        log_backoff = np.full(V, 0.0)
+        for (word,), (log_prob, backoff) in unigrams.items():
+            if word in index:
+                log_probs[index[word]], log_backoff[index[word]] = log_prob, backoff
+        log_probs[index[BOS]] = -np.inf
+        for k in range(2, order + 1):
+            # P(w | h) = P(w | h[1:]) * backoff(h) unless the n-gram is listed
+            log_probs = log_backoff[..., None] + log_probs[None]
+            log_backoff = np.zeros((V,) * k)
+            for gram, (log_prob, backoff) in sections.get(k, {}).items():
+                if all(word in index for word in gram):
+                    ids = tuple(index[word] for word in gram)
+                    log_probs[ids], log_backoff[ids] = log_prob, backoff
+        log_probs = np.where(log_probs <= _ARPA_ZERO, -np.inf, log_probs * _LN10)
+        return cls(words, log_probs)
+
+    def log_prob(self, word, history=()):
+        """ natural log probability of word after the words of history; unknown words count as UNK """
+        history = [BOS] * (self.order - 1) + list(history)
+        ids = [self._id(w) for w in history[len(history) - self.order + 1:]] if self.order > 1 else []
+        return float(self.log_probs[tuple(ids + [self._id(word)])])
+
+    def sentence_log_prob(self, sentence):
+        """ natural log probability of a whole sentence, closing EOS included """
+        sentence = list(sentence)
+        return sum(self.log_prob(word, sentence[:t]) for t, word in enumerate(sentence + [EOS]))
+
+    def table(self, words):
+        """ dense log-probability table reindexed to a recognizer's words, followed by BOS and EOS
+
+        :param words: list of str, e.g. ModelBank.words
+        :return: float array with order axes of len(words) + 2; index len(words) is BOS, len(words) + 1 EOS
+        """
+        key = tuple(words)
+        if key not in self._tables:
+            ids = np.array([self._id(word) for word in words] + [self.index[BOS], self.index[EOS]])
+            self._tables[key] = self.log_probs[np.ix_(*[ids] * self.order)]
+        return self._tables[key]
+
+    def _id(self, word):
+        return self.index.get(word, self.index[UNK])
+
+
+def decode_sentence(scores, log_probs, lm_weight=1.0, beam=None, max_hypotheses=None):
+    """ Viterbi search for the best word sequence of a sentence's items under the acoustic scores and an LM
+
+    Hypotheses are recombined by their language model state, the last order - 1 words, and then pruned to
+    those within beam of the best one and to the max_hypotheses best.
+
+    :param scores: float array (T, W), log-likelihood of each of the sentence's T items under each word model
+    :param log_probs: float array as returned by NgramLM.table for the W words
+    :param lm_weight: float scale of the language model log probabilities
+    :param beam: float or None
+    :param max_hypotheses: int or None
+    :return: (list of int word indices, float total score)
+    """
+    num_items, W = scores.shape
+    order = log_probs.ndim
+    if lm_weight == 0:
+        # 0 * -inf would be nan for word sequences the language model rules out
+        log_probs = np.zeros_like(log_probs)
+    bos, eos = W, W + 1
+    histories = np.full((1, order - 1), bos, dtype=np.int64)
+    totals = np.zeros(1)
+    words = np.arange(W)
+    backpointers = []
+    for t in range(num_items):
+        lm = log_probs[tuple(histories[:, j, None] for j in range(order - 1)) + (words[None, :],)]
+        candidates = (totals[:, None] + lm_weight * lm + scores[t][None, :]).ravel()
+        parents = np.repeat(np.arange(len(histories)), W)
+        new_words = np.tile(words, len(histories))
+        if order > 1:
+            new_histories = np.column_stack([histories[parents, 1:], new_words])
+        else:
+            new_histories = histories[parents]
+
+        # recombination: only the best hypothesis of each LM state can be part of the best path
+        keys = np.zeros(len(candidates), dtype=np.int64)
+        for j in range(order - 1):
+            keys = keys * (W + 2) + new_histories[:, j]
+        ranked = np.lexsort((-candidates, keys))
+        keep = ranked[np.r_[True, keys[ranked][1:] != keys[ranked][:-1]]]
+        if beam is not None:
+            keep = keep[candidates[keep] >= candidates[keep].max() - beam]
+        if max_hypotheses is not None and len(keep) > max_hypotheses:
+            keep = keep[np.argsort(-candidates[keep], kind='stable')[:max_hypotheses]]
+
+        histories, totals = new_histories[keep], candidates[keep]
+        backpointers.append((parents[keep], new_words[keep]))
+
+    if num_items == 0:
+        return [], 0.0
+    final = totals + lm_weight * log_probs[tuple(histories[:, j] for j in range(order - 1)) + (eos,)]
+    best = int(np.argmax(final))
+    path = []
+    for parents, new_words in reversed(backpointers):
+        path.append(int(new_words[best]))
+        best = parents[best]
+    return path[::-1], float(final.max())
+
+
+def _read_arpa(fn):
+    """ {order: {tuple of words: (log10 probability, log10 backoff)}} """
+    sections = {}
+    current = None
+    with open(fn) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('ngram ') or line == '\\data\\':
+                continue
+            if line == '\\end\\':
+                break
+            if line.startswith('\\') and line.endswith('-grams:'):
+                current = int(line[1:line.index('-')])
+                sections[current] = {}
+                continue
+            if current is None:
+                continue
+            fields = line.split()
+            gram = tuple(fields[1:1 + current])
+            backoff = float(fields[1 + current]) if len(fields) > 1 + current else 0.0
+            sections[current][gram] = (float(fields[0]), backoff)
+    return sections
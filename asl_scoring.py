@@ -0,0 +1,404 @@
+import json
+import math
+import os
+
+import numpy as np
+
+from asl_fit_cache import model_from_params
+
+# model bank file layout: magic, little-endian uint64 header size, json header, then 64-byte aligned raw arrays
+BANK_MAGIC = b'ASLBANK1'
+_BANK_ALIGN = 64
+# parameter arrays of a bank, followed by the scoring arrays derived from them; all are stored in bank files
+_BANK_PARAMS = ('n_states', 'startprob', 'transmat', 'means', 'variances')
+_BANK_DERIVED = ('_inv_var', '_mean_inv_var', '_log_norm', '_log_startprob', '_log_transmat')
+# documented relative tolerance of float32 bank log-likelihoods against float64 ones
+FLOAT32_RTOL = 1e-4
+
+
+class ModelBank(object):
+    """ word models packed into padded arrays for batched log-likelihood scoring
+
+    Every diagonal-covariance GaussianHMM is padded to the largest state count.  Padded states have zero start
+    and transition probability, so they never carry forward mass and do not change any score.  A single forward
+    pass then scores one sequence against every word model at once.
+
+    For example, to score every test item against every trained word model:
+        bank = ModelBank.from_models(models)
+        scores = bank.score_matrix(test_set)   # shape (num_items, num_words)
+
+    A bank packed as np.float32 holds its arrays in half the memory, which matters for large vocabularies and
+    memory-mapped bank files; it does not score faster.  Its emissions are summed over the squared differences
+    to the state means rather than expanded into matrix products, whose terms cancel badly in single precision
+    when features are large compared with the state standard deviations, so its log-likelihoods agree with a
+    float64 bank to within FLOAT32_RTOL relative difference.
+    """
+
+    def __init__(self, words: list, n_states, startprob, transmat, means, variances):
+        """ packs already padded parameter arrays
+
+        :param words: list of str, one per model
+        :param n_states: int array (W,) of real state counts; 0 marks a missing model that always scores -inf
+        :param startprob: float array (W, S)
+        :param transmat: float array (W, S, S)
+        :param means: float array (W, S, D)
+        :param variances: float array (W, S, D) of diagonal covariances, padded with ones
+        the float arrays all have the scoring dtype, np.float64 or np.float32
+        """
+        self.words = list(words)
+        self.n_states = np.asarray(n_states)
+        self.startprob = np.asarray(startprob)
+        self.transmat = np.asarray(transmat)
+        self.means = np.asarray(means)
+        self.variances = np.asarray(variances)
+        self._set_shape()
+
+        # emission terms precomputed so that log N(x | mean, var) for all states is one matrix product in x
+        inv_var = 1.0 / self.variances
+        self._inv_var = inv_var.reshape(self.num_words * self.max_states, self.num_features).T
+        self._mean_inv_var = (self.means * inv_var).reshape(self.num_words * self.max_states, self.num_features).T
+        self._log_norm = (-0.5 * (self.num_features * math.log(2 * math.pi)
+                                  + np.log(self.variances).sum(axis=2)
+                                  + (self.means ** 2 * inv_var).sum(axis=2))).astype(self.means.dtype)
+        with np.errstate(divide='ignore'):
+            self._log_startprob = np.log(self.startprob)
+            self._log_transmat = np.log(self.transmat)
+
+    def _set_shape(self):
+        self.num_words, self.max_states, self.num_features = self.means.shape
+        self._usable = self.n_states > 0
+
+    @property
+    def dtype(self):
+        """ numpy dtype of the scoring arithmetic """
+        return self.means.dtype
+
+    def astype(self, dtype):
+        """ the same models packed with another scoring dtype
+
+        :param dtype: numpy float dtype
+        :return: ModelBank object, self when it already has dtype
+        """
+        if np.dtype(dtype) == self.dtype:
+            return self
+        return ModelBank(self.words, self.n_states, *(np.asarray(getattr(self, name), dtype=dtype)
+                                                      for name in _BANK_PARAMS[1:]))
+
+    @classmethod
+    def from_models(cls, models: dict, dtype=np.float64):
+        """ packs a dict of trained models as returned by train_all_words
+
+        :param models: dict of GaussianHMM objects (diag covariance) or None, keyed by word
+        :param dtype: numpy float dtype of the scoring arithmetic
+        :return: ModelBank object; without any usable model it has no features and scores every sequence -inf
+        """
+        words = list(models.keys())
+        params = [_diag_params(models[word]) for word in words]
+        sizes = [len(p[0]) if p is not None else 0 for p in params]
+        num_features = max([p[2].shape[1] for p in params if p is not None] + [0])
+        num_words, max_states = len(words), max(sizes + [1])
+
+        n_states = np.array(sizes, dtype=np.int64)
+        startprob = np.zeros((num_words, max_states), dtype=dtype)
+        transmat = np.zeros((num_words, max_states, max_states), dtype=dtype)
+        means = np.zeros((num_words, max_states, num_features), dtype=dtype)
+        variances = np.ones((num_words, max_states, num_features), dtype=dtype)
+        for w, p in enumerate(params):
+            if p is None:
+                continue
+            n = sizes[w]
+            startprob[w, :n], transmat[w, :n, :n], means[w, :n], variances[w, :n] = p
+        return cls(words, n_states, startprob, transmat, means, variances)
+
+    def to_models(self):
+        """ rebuilds hmmlearn models from the packed parameters
+
+        :return: dict of GaussianHMM objects keyed by word, None for missing models
+        """
+        models = {}
+        for w, word in enumerate(self.words):
+            n = int(self.n_states[w])
+            if n == 0:
+                models[word] = None
+                continue
+            params = {'startprob': np.array(self.startprob[w, :n], dtype=np.float64),
+                      'transmat': np.array(self.transmat[w, :n, :n], dtype=np.float64),
+                      'means': np.array(self.means[w, :n], dtype=np.float64),
+                      'covars': np.array(self.variances[w, :n], dtype=np.float64)}
+            models[word] = model_from_params(params, covariance_type='diag')
+        return models
+
+    def save(self, fn):
+        """ writes the bank to a single file that load() can memory-map
+
+        The file holds the packed parameters and the scoring arrays derived from them, so loading needs no
+        computation and every process mapping the file shares the same pages.
+
+        :param fn: str
+        """
+        arrays = [(name, np.ascontiguousarray(getattr(self, name))) for name in _BANK_PARAMS + _BANK_DERIVED]
+        header = {'words': self.words, 'arrays': []}
+        offset = 0
+        for name, values in arrays:
+            offset = -(-offset // _BANK_ALIGN) * _BANK_ALIGN
+            header['arrays'].append({'name': name, 'dtype': values.dtype.str, 'shape': list(values.shape),
+                                     'offset': offset})
+            offset += values.nbytes
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = -(-(len(BANK_MAGIC) + 8 + len(header_bytes)) // _BANK_ALIGN) * _BANK_ALIGN
+
+        tmp_fn = fn + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            f.write(BANK_MAGIC)
+            f.write(np.uint64(len(header_bytes)).astype('<u8').tobytes())
+            f.write(header_bytes)
+            for (name, values), spec in zip(arrays, header['arrays']):
+                f.seek(data_start + spec['offset'])
+                f.write(values.tobytes())
+        os.replace(tmp_fn, fn)
+
+    @classmethod
+    def load(cls, fn, mmap=True):
+        """ reads a bank written by save()
+
+        :param fn: str
+        :param mmap: bool
+            memory-map the arrays read-only instead of reading them into memory
+        :return: ModelBank object
+        """
+        with open(fn, 'rb') as f:
+            if f.read(len(BANK_MAGIC)) != BANK_MAGIC:
+                raise ValueError("{} is not a model bank file".format(fn))
+            header_size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            header = json.loads(f.read(header_size).decode('utf-8'))
+        data_start = -(-(len(BANK_MAGIC) + 8 + header_size) // _BANK_ALIGN) * _BANK_ALIGN
+
+        bank = cls.__new__(cls)
+        bank.words = header['words']
+        for spec in header['arrays']:
+            dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+            if mmap and int(np.prod(shape)) > 0:
+                values = np.memmap(fn, dtype=dtype, mode='r', offset=data_start + spec['offset'], shape=shape)
+            else:
+                values = np.fromfile(fn, dtype=dtype, count=int(np.prod(shape)),
+                                     offset=data_start + spec['offset']).reshape(shape)
+            setattr(bank, spec['name'], values)
+        bank._set_shape()
+        return bank
+
+    def log_emissions(self, X):
+        """ log density of every frame under every state of every model
+
+        :param X: float array (T, D)
+        :return: float array (T, W, S)
+        """
+        return self._emissions(np.asarray(X, dtype=self.means.dtype))
+
+    def _emissions(self, X, words=None):
+        """ log emissions (T, len(words), S) of X under the states of the given model indices, all by default """
+        if not self._usable.any():
+            # a bank without any scorable model has no feature count to check X against, and scores -inf
+            num_words = self.num_words if words is None else len(words)
+            return np.full((len(X), num_words, self.max_states), float('-inf'), dtype=self.means.dtype)
+        if self.means.dtype == np.float64:
+            if words is None:
+                log_b = -0.5 * (X ** 2).dot(self._inv_var) + X.dot(self._mean_inv_var)
+                return log_b.reshape(len(X), self.num_words, self.max_states) + self._log_norm
+            columns = (words[:, None] * self.max_states + np.arange(self.max_states)).ravel()
+            log_b = -0.5 * (X ** 2).dot(self._inv_var[:, columns]) + X.dot(self._mean_inv_var[:, columns])
+            return log_b.reshape(len(X), len(words), self.max_states) + self._log_norm[words]
+        words = slice(None) if words is None else words
+        inv_var = self._inv_var.T.reshape(self.num_words, self.max_states, self.num_features)[words]
+        diff = X[:, None, None, :] - self.means[words][None]
+        return -0.5 * (diff ** 2 * inv_var).sum(axis=3) + self._log_det_norm()[words]
+
+    def _log_det_norm(self):
+        """ (W, S) normalizing constant of every state's density, without the mean terms of _log_norm """
+        if getattr(self, '_log_det', None) is None:
+            self._log_det = (-0.5 * (self.num_features * math.log(2 * math.pi)
+                                     + np.log(np.asarray(self.variances, dtype=np.float64)).sum(axis=2))
+                             ).astype(self.means.dtype)
+        return self._log_det
+
+    def score_sequence(self, X):
+        """ log-likelihood of a single sequence under every model
+
+        :param X: float array (T, D)
+        :return: float array (W,), -inf for missing models or models that cannot score the sequence
+        """
+        log_b = self.log_emissions(X)
+        alpha = self.forward_start(log_b[0])
+        for t in range(1, len(log_b)):
+            alpha = self.forward_step(alpha, log_b[t])
+        return self.forward_total(alpha)
+
+    def score(self, X, lengths=None):
+        """ log-likelihood of (X, lengths) under every model; the same value GaussianHMM.score gives per model
+
+        :param X: float array (sum(lengths), D)
+        :param lengths: list of sequence lengths within X, or None for a single sequence
+        :return: float array (W,)
+        """
+        if lengths is None:
+            return self.score_sequence(X)
+        total = np.zeros(self.num_words)
+        start = 0
+        for length in lengths:
+            total += self.score_sequence(X[start:start + length])
+            start += length
+        return total
+
+    def score_matrix(self, Xlengths):
+        """ log-likelihood of every item under every model
+
+        :param Xlengths: SinglesData object, dict of (X, lengths) tuples keyed by item index, or list of tuples
+        :return: float array (N, W) ordered by item index and by self.words
+        """
+        if hasattr(Xlengths, 'get_all_Xlengths'):
+            Xlengths = Xlengths.get_all_Xlengths()
+        if isinstance(Xlengths, dict):
+            Xlengths = [Xlengths[i] for i in range(len(Xlengths))]
+        scores = np.empty((len(Xlengths), self.num_words))
+        for i, (X, lengths) in enumerate(Xlengths):
+            scores[i] = self.score(X, lengths)
+        return scores
+
+    def score_batch(self, sequences):
+        """ log-likelihood of several single sequences under every model with one stacked forward pass
+
+        The emissions of all frames are one matrix product, and the sequences are sorted longest first so that
+        every time step advances the sequences still running as one array operation.
+
+        :param sequences: list of float arrays (T_i, D)
+        :return: float array (N, W) ordered like sequences
+        """
+        scores = np.full((len(sequences), self.num_words), float('-inf'))
+        lengths = np.array([len(X) for X in sequences], dtype=np.int64)
+        if len(sequences) == 0 or lengths.max() == 0:
+            return scores
+        order = np.argsort(-lengths, kind='stable')
+        order = order[lengths[order] > 0]
+        log_b = self.log_emissions(np.concatenate([sequences[i] for i in order]))
+        starts = np.concatenate(([0], np.cumsum(lengths[order])[:-1]))
+        # number of sequences with more than t frames, for every t
+        running = np.searchsorted(-lengths[order], -np.arange(lengths.max()), side='left')
+        alpha = self.forward_start(log_b[starts])
+        for t in range(1, len(running)):
+            n = running[t]
+            alpha[:n] = _logsumexp(alpha[:n, :, :, None] + self._log_transmat, axis=2) + log_b[starts[:n] + t]
+        totals = _logsumexp(alpha, axis=2)
+        totals[:, ~self._usable] = float('-inf')
+        scores[order] = totals
+        return scores
+
+    def prefilter_scores(self, X, duration_stats=None):
+        """ cheap plausibility of each model for a sequence, used to shortlist candidates before a forward pass
+
+        The score is the best log density of the sequence's mean frame under any state of the model, plus,
+        when duration statistics are given, the log density of the sequence's log length under a Gaussian
+        fitted to the model's training lengths.
+
+        :param X: float array (T, D)
+        :param duration_stats: (mean, std) float arrays (W,) of log training lengths, or None
+        :return: float array (W,), -inf for missing models
+        """
+        scores = self.log_emissions(np.mean(X, axis=0, keepdims=True))[0].max(axis=1)
+        if duration_stats is not None:
+            mean, std = duration_stats
+            scores = scores - 0.5 * ((math.log(len(X)) - mean) / std) ** 2 - np.log(std)
+        scores[~self._usable] = float('-inf')
+        return scores
+
+    def score_sequence_pruned(self, X, candidates=None, beam=None):
+        """ log-likelihood of a single sequence under a subset of models, with beam pruning
+
+        After every frame the models whose log-likelihood so far is more than beam below the best model are
+        dropped from the forward pass.
+
+        :param X: float array (T, D)
+        :param candidates: int array of model indices to score, None for all models
+        :param beam: float or None
+        :return: (float array (W,), int, int)
+            log-likelihoods with -inf for models not scored to the end, the number of (model, frame) forward
+            steps computed, and the number of models dropped by the beam
+        """
+        X = np.asarray(X, dtype=self.means.dtype)
+        active = np.arange(self.num_words) if candidates is None else np.asarray(candidates, dtype=np.int64)
+        active = active[self._usable[active]]
+        scores = np.full(self.num_words, float('-inf'))
+        if len(active) == 0 or len(X) == 0:
+            return scores, 0, 0
+        log_b = self._emissions(X, active)
+        log_transmat = self._log_transmat[active]
+        alpha = self._log_startprob[active] + log_b[0]
+        steps = len(active)
+        num_candidates = len(active)
+        for t in range(1, len(X)):
+            if beam is not None:
+                totals = _logsumexp(alpha, axis=1)
+                keep = totals >= totals.max() - beam
+                if not keep.all() and keep.any():
+                    active, alpha, log_b, log_transmat = active[keep], alpha[keep], log_b[:, keep], log_transmat[keep]
+            alpha = _logsumexp(alpha[:, :, None] + log_transmat, axis=1) + log_b[t]
+            steps += len(active)
+        scores[active] = _logsumexp(alpha, axis=1)
+        return scores, steps, num_candidates - len(active)
+
+    def forward_start(self, log_b):
+        """ log forward variables after the first frame
+
+        :param log_b: float array (W, S) of log emissions of the first frame
+        :return: float array (W, S)
+        """
+        return self._log_startprob + log_b
+
+    def forward_step(self, alpha, log_b):
+        """ log-space forward recursion logsumexp_i(alpha_i + log a_ij) + log b_j for every model at once
+
+        :param alpha: float array (W, S) of log forward variables of the previous frame
+        :param log_b: float array (W, S) of log emissions of the current frame
+        :return: float array (W, S)
+        """
+        return _logsumexp(alpha[:, :, None] + self._log_transmat, axis=1) + log_b
+
+    def forward_total(self, alpha):
+        """ log-likelihood of the frames seen so far under every model
+
+        :param alpha: float array (W, S) of log forward variables
+        :return: float array (W,)
+        """
+        total = _logsumexp(alpha, axis=1)
+        total[~self._usable] = float('-inf')
+        return total
+
+
+def _logsumexp(a, axis):
+    """ log(sum(exp(a))) along axis, -inf where every term is -inf """
+    shift = a.max(axis=axis, keepdims=True)
+    shift[~np.isfinite(shift)] = 0.0
+    with np.errstate(divide='ignore'):
+        out = np.log(np.exp(a - shift).sum(axis=axis, keepdims=True)) + shift
+    return np.squeeze(out, axis=axis)
+
+
+def _diag_params(model):
+    """ (startprob, transmat, means, variances) of a diagonal GaussianHMM, or None if it cannot be scored """
+    if model is None:
+        return None
+    try:
+        if model.covariance_type != 'diag':
+            raise ValueError("only diagonal covariance models can be packed, got {}".format(model.covariance_type))
+        variances = np.asarray(model.covars_, dtype=np.float64)
+        if variances.ndim == 3:
+            variances = np.diagonal(variances, axis1=1, axis2=2)
+        params = (np.asarray(model.startprob_, dtype=np.float64), np.asarray(model.transmat_, dtype=np.float64),
+                  np.asarray(model.means_, dtype=np.float64), variances)
+    except AttributeError:
+        # not fitted
+        return None
+    if not all(np.all(np.isfinite(p)) for p in params) or np.any(params[3] <= 0):
+        return None
+    # GaussianHMM.score refuses models whose probabilities do not sum to one, e.g. a state never visited in training
+    if not np.allclose(params[0].sum(), 1.0) or not np.allclose(params[1].sum(axis=1), 1.0):
+        return None
+    return params
@@ -0,0 +1,234 @@
+""" local recognition service: scores segmented sign sequences sent by other processes in micro-batches
+
+The server loads a model bank once.  Concurrent requests are queued and collected into micro-batches of at
+most max_batch_size sequences, waiting at most max_wait seconds after the first request of a batch for more
+to arrive.  Each batch is scored with one ModelBank.score_batch call on a worker thread, so the event loop keeps
+accepting requests meanwhile.  Larger batches and longer waits raise throughput at the cost of tail latency;
+the /stats endpoint reports the queue depth and the batch size and latency percentiles to tune them by.
+
+The front end speaks a minimal HTTP/1.1 over TCP or a unix socket:
+    POST /recognize  {"frames": [[f0, f1, ...], ...], "top_k": 5}  ->  {"words": [["JOHN", -412.3], ...]}
+    GET  /stats  ->  {"queue_depth": 0, "requests": 120, "batches": 31, "batch_size": {...}, "latency_ms": {...}}
+
+For example, to serve a bank saved with ModelBank.save:
+    python asl_server.py data/models.bank --port 8765 --max-batch-size 32 --max-wait-ms 5
+"""
+import argparse
+import asyncio
+import collections
+import json
+import time
+
+import numpy as np
+
+from asl_scoring import ModelBank
+
+PERCENTILES = (50, 90, 99)
+# requests whose latency and batch sizes are kept for the percentiles
+STATS_WINDOW = 10000
+
+
+class RecognitionServer(object):
+    """ micro-batching recognizer around a ModelBank
+
+    For example, from a coroutine:
+        server = RecognitionServer(ModelBank.load('models.bank'))
+        await server.start()
+        words = await server.recognize(X, top_k=3)
+    """
+
+    def __init__(self, models, max_batch_size=32, max_wait=0.005, top_k=5):
+        """
+        :param models: ModelBank object, str filename of a saved bank, or dict of trained models
+        :param max_batch_size: int largest number of sequences scored together
+        :param max_wait: float seconds a batch waits for more requests after its first one
+        :param top_k: int default number of words returned per request
+        """
+        if isinstance(models, str):
+            models = ModelBank.load(models)
+        self.bank = models if isinstance(models, ModelBank) else ModelBank.from_models(models)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.top_k = top_k
+        self.num_requests = 0
+        self.num_batches = 0
+        self._batch_sizes = collections.deque(maxlen=STATS_WINDOW)
+        self._latencies = collections.deque(maxlen=STATS_WINDOW)
+        self._queue = None
+        self._batcher = None
+
+    async def start(self):
+        """ starts the batching task on the running event loop """
+        if self._batcher is None:
+            self._queue = asyncio.Queue()
+            self._batcher = asyncio.ensure_future(self._run_batches())
+
+    async def stop(self):
+        """ cancels the batching task; queued requests are cancelled with it """
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+            while not self._queue.empty():
+                self._queue.get_nowait()[1].cancel()
+
+    async def recognize(self, X, top_k=None):
+        """ best words of one segmented sequence
+
+        :param X: float array (T, D) of the sequence's feature frames
+        :param top_k: int or None for the server default
+        :return: list of (word, log-likelihood) tuples, best first
+        """
+        X = np.asarray(X, dtype=self.bank.dtype)
+        if X.ndim != 2 or X.shape[1] != self.bank.num_features or len(X) == 0:
+            raise ValueError("expected a non-empty (frames, {}) array, got shape {}".format(
+                self.bank.num_features, X.shape))
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((X, future, time.perf_counter()))
+        scores = await future
+        return top_words(self.bank.words, scores, self.top_k if top_k is None else top_k)
+
+    def stats(self):
+        """ queue depth, request and batch counts, and percentiles of the recent batch sizes and latencies
+
+        :return: dict
+        """
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'requests': self.num_requests,
+            'batches': self.num_batches,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'batch_size': _percentiles(self._batch_sizes),
+            'latency_ms': _percentiles([latency * 1000 for latency in self._latencies]),
+        }
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch = [request for request in batch if not request[1].cancelled()]
+            if not batch:
+                continue
+            try:
+                scores = await loop.run_in_executor(None, self.bank.score_batch, [X for X, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            self._batch_sizes.append(len(batch))
+            for (_, future, queued), row in zip(batch, scores):
+                self._latencies.append(done - queued)
+                if not future.done():
+                    future.set_result(row)
+
+    async def handle_connection(self, reader, writer):
+        """ serves the HTTP requests of one connection, see the module docstring """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self._route(method, path, body)
+                payload = json.dumps(response).encode('utf-8')
+                writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, len(payload)).encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return '200 OK', self.stats()
+        if method == 'POST' and path == '/recognize':
+            try:
+                request = json.loads(body.decode('utf-8'))
+                words = await self.recognize(request['frames'], request.get('top_k'))
+            except (ValueError, KeyError, TypeError) as e:
+                return '400 Bad Request', {'error': str(e)}
+            return '200 OK', {'words': [[word, logL] for word, logL in words]}
+        return '404 Not Found', {'error': 'unknown endpoint {} {}'.format(method, path)}
+
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        """ serves HTTP on host:port, or on the unix socket path if given, until cancelled """
+        await self.start()
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def top_words(words, scores, k):
+    """ the k best words of a score row
+
+    :param words: list of str
+    :param scores: float array (W,)
+    :param k: int
+    :return: list of (word, log-likelihood) tuples, best first
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    return [(words[i], float(scores[i])) for i in sorted(top, key=lambda i: -scores[i])]
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return {'p{}'.format(p): None for p in PERCENTILES}
+    points = np.percentile(np.asarray(values, dtype=np.float64), PERCENTILES)
+    return {'p{}'.format(p): float(v) for p, v in zip(PERCENTILES, points)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="serves word recognition of segmented sequences over HTTP")
+    parser.add_argument('bank', help='model bank file written by ModelBank.save')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix-socket', default=None, help='serve on this unix socket path instead of TCP')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--top-k', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    server = RecognitionServer(args.bank, args.max_batch_size, args.max_wait_ms / 1000, args.top_k)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
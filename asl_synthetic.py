@@ -0,0 +1,276 @@
+""" synthetic corpora in the schema of the bundled data, sampled from word models trained on it
+
+Every word of the training data gets a diagonal GaussianHMM on the six raw position columns, centered on the
+mean nose position of its speaker, and the frames between words get a model of their own.  Corpora of any
+number of videos, speakers, words and sentence lengths are then sampled from these models and written as
+hands_condensed.csv, speaker.csv, train_words.csv and test_words.csv, the same for the same seed.
+
+For example, to write a corpus ten times the size of the bundled data and load it:
+    generator = CorpusGenerator.from_asl(AslDb())
+    files = generator.generate(os.path.join('data', 'synthetic'), num_videos=2000, seed=0)
+    asl = AslDb(files['hands'], files['speakers'], cache_dir=None)
+    training = asl.build_training(features_ground, files['train'])
+"""
+import argparse
+import copy
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from asl_data import AslDb, load_frame_buffer, index_sequences
+from asl_scoring import ModelBank
+from my_model_selectors import SelectorConstant
+
+POSITION_COLUMNS = ['left-x', 'left-y', 'right-x', 'right-y', 'nose-x', 'nose-y']
+GAP = '<gap>'
+
+
+class CorpusGenerator(object):
+    """ samples videos of signed sentences from word models
+
+    The models describe positions relative to the speaker's mean nose position; each synthetic speaker gets
+    its own nose position, drawn around those of the real speakers, that is added back to every frame.
+    """
+
+    def __init__(self, bank: ModelBank, durations: dict, counts: dict, nose_mean, nose_std):
+        """
+        :param bank: ModelBank of the word models and the GAP model over POSITION_COLUMNS
+        :param durations: dict of int arrays of observed frame counts keyed by word and GAP
+        :param counts: dict of int training occurrences keyed by word
+        :param nose_mean: float array (2,) mean nose x, y of the speakers
+        :param nose_std: float array (2,) standard deviation of the speakers' nose x, y
+        """
+        self.bank = bank
+        self.durations = durations
+        self.counts = counts
+        self.nose_mean = np.asarray(nose_mean, dtype=np.float64)
+        self.nose_std = np.asarray(nose_std, dtype=np.float64)
+
+    @classmethod
+    def from_asl(cls, asl: AslDb, n_states=3, words=None,
+                 train_fn=os.path.join('data', 'train_words.csv'),
+                 test_fn=os.path.join('data', 'test_words.csv')):
+        """ trains the generator models on the raw positions of the training words
+
+        :param asl: AslDb object
+        :param n_states: int number of states of every word model
+        :param words: list of str words to model, or None for the whole training vocabulary
+        :param train_fn: str, word ranges the word models are trained on
+        :param test_fn: str, word ranges that, with train_fn, mark the frames that are not gaps
+        :return: CorpusGenerator object
+        """
+        asl = copy.copy(asl)
+        asl.features = dict(asl.features)
+        feature_list = []
+        for column in POSITION_COLUMNS:
+            name = 'centered-' + column
+            asl.register_feature(name, [column], _nose_centered(column[-1]))
+            feature_list.append(name)
+
+        train_df = pd.read_csv(train_fn)
+        if words is not None:
+            train_df = train_df[train_df['word'].isin(words)]
+        gaps_df = _gap_ranges(asl.df, pd.concat([pd.read_csv(train_fn), pd.read_csv(test_fn)]))
+        table = asl.feature_table(feature_list)
+
+        # one sequence dict over the words and the gaps, as the model selectors expect
+        ranges_df = pd.concat([train_df[['word', 'video', 'startframe', 'endframe']],
+                               gaps_df[gaps_df['endframe'] >= gaps_df['startframe']].assign(word=GAP)])
+        ranges_df = ranges_df.sort_values('word', kind='stable')
+        X, lengths = load_frame_buffer(table, ranges_df, feature_list)
+        sequences, Xlengths = index_sequences(X, lengths, list(ranges_df['word']))
+
+        models = {}
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=DeprecationWarning)
+            for word in sequences:
+                num_states = 2 if word == GAP else n_states
+                models[word] = SelectorConstant(sequences, Xlengths, word, n_constant=num_states).select()
+        models = {word: model for word, model in models.items() if model is not None}
+        bank = ModelBank.from_models(models)
+
+        durations = {word: np.array(Xlengths[word][1]) for word in models}
+        durations[GAP] = (gaps_df['endframe'] - gaps_df['startframe'] + 1).clip(lower=0).values
+        counts = train_df['word'].value_counts().to_dict()
+        nose = asl.df.groupby('speaker')[['nose-x', 'nose-y']].mean().values
+        nose_std = nose.std(axis=0, ddof=1) if len(nose) > 1 else np.zeros(2)
+        return cls(bank, durations, counts, nose.mean(axis=0), nose_std)
+
+    def generate(self, out_dir, num_videos=200, num_speakers=3, num_words=None, sentence_length=4.4,
+                 test_fraction=0.2, variant_spread=0.5, seed=0):
+        """ samples a corpus and writes it in the schema of the bundled csv files
+
+        :param out_dir: str directory for the csv files
+        :param num_videos: int number of videos, each one sentence
+        :param num_speakers: int
+        :param num_words: int vocabulary size, or None for the modelled vocabulary; beyond it, words are added
+            as variants of modelled words with means shifted by variant_spread standard deviations
+        :param sentence_length: float mean number of words per sentence
+        :param test_fraction: float share of the videos written to test_words.csv
+        :param variant_spread: float
+        :param seed: int
+        :return: dict of the 'hands', 'speakers', 'train' and 'test' filenames
+        """
+        rng = np.random.RandomState(seed)
+        bank, vocabulary, weights = self._vocabulary(num_words, variant_spread, rng)
+        gap = bank.words.index(GAP)
+        speakers = ['synthetic-{}'.format(i + 1) for i in range(num_speakers)]
+        noses = self.nose_mean + self.nose_std * rng.standard_normal((num_speakers, 2))
+
+        # lay out every video as gap, word, gap, ..., word, gap
+        videos = np.arange(1, num_videos + 1)
+        video_speakers = rng.randint(num_speakers, size=num_videos)
+        num_signs = 1 + rng.poisson(max(sentence_length - 1, 0), size=num_videos)
+        signs = rng.choice(len(vocabulary), size=num_signs.sum(), p=weights)
+        segment_models, segment_lengths, segment_videos = [], [], []
+        words_rows = []
+        first_sign = 0
+        for v, video in enumerate(videos):
+            frame = 0
+            for i in range(num_signs[v] + 1):
+                length = int(rng.choice(self.durations[GAP]))
+                if length > 0:
+                    segment_models.append(gap)
+                    segment_lengths.append(length)
+                    segment_videos.append(v)
+                    frame += length
+                if i == num_signs[v]:
+                    break
+                # the bank holds the vocabulary in order, followed by the gap model
+                sign = signs[first_sign + i]
+                word = vocabulary[sign]
+                length = int(rng.choice(self.durations[self._base_word(word)]))
+                segment_models.append(sign)
+                segment_lengths.append(length)
+                segment_videos.append(v)
+                words_rows.append((video, speakers[video_speakers[v]], word, frame, frame + length - 1))
+                frame += length
+            first_sign += num_signs[v]
+
+        segment_lengths = np.array(segment_lengths, dtype=np.int64)
+        X = sample_segments(bank, np.array(segment_models), segment_lengths, rng)
+        frame_videos = np.repeat(np.array(segment_videos), segment_lengths)
+        X += np.tile(noses[video_speakers[frame_videos]], 3)
+        frames = np.arange(len(X)) - np.repeat(_video_starts(frame_videos), np.bincount(frame_videos))
+
+        hands = pd.DataFrame(np.rint(X).astype(np.int64), columns=POSITION_COLUMNS)
+        hands.insert(0, 'frame', frames)
+        hands.insert(0, 'video', videos[frame_videos])
+        speaker_df = pd.DataFrame({'video': videos, 'speaker': [speakers[s] for s in video_speakers]})
+        words_df = pd.DataFrame(words_rows, columns=['video', 'speaker', 'word', 'startframe', 'endframe'])
+        test_videos = videos[rng.permutation(num_videos)[:int(round(test_fraction * num_videos))]]
+        is_test = words_df['video'].isin(test_videos)
+
+        os.makedirs(out_dir, exist_ok=True)
+        files = {name: os.path.join(out_dir, fn) for name, fn in (
+            ('hands', 'hands_condensed.csv'), ('speakers', 'speaker.csv'),
+            ('train', 'train_words.csv'), ('test', 'test_words.csv'))}
+        hands.to_csv(files['hands'], index=False)
+        speaker_df.to_csv(files['speakers'], index=False)
+        words_df[~is_test].to_csv(files['train'], index=False)
+        words_df[is_test].to_csv(files['test'], index=False)
+        return files
+
+    def _vocabulary(self, num_words, variant_spread, rng):
+        """ bank extended with word variants, the vocabulary and the sampling probability of each word """
+        base = [word for word in self.bank.words if word != GAP and self.bank.n_states[self.bank.words.index(word)]]
+        num_words = len(base) if num_words is None else num_words
+        vocabulary = base[:num_words]
+        num_base = len(vocabulary)
+        index = [self.bank.words.index(word) for word in vocabulary]
+        for i in range(num_words - len(vocabulary)):
+            word = base[i % len(base)]
+            vocabulary.append('{}_{}'.format(word, i // len(base) + 2))
+            index.append(self.bank.words.index(word))
+        index.append(self.bank.words.index(GAP))
+        index = np.array(index)
+
+        means = self.bank.means[index].copy()
+        shift = variant_spread * np.sqrt(self.bank.variances[index[num_base:-1]])
+        means[num_base:-1] += shift * rng.standard_normal(shift.shape)
+        bank = ModelBank(vocabulary + [GAP], self.bank.n_states[index], self.bank.startprob[index],
+                         self.bank.transmat[index], means, self.bank.variances[index])
+        weights = np.array([self.counts.get(self._base_word(word), 1) for word in vocabulary], dtype=np.float64)
+        return bank, vocabulary, weights / weights.sum()
+
+    def _base_word(self, word):
+        if word in self.durations:
+            return word
+        return word.rsplit('_', 1)[0]
+
+
+def sample_segments(bank: ModelBank, models, lengths, rng):
+    """ samples one frame sequence per segment, all segments advancing one frame at a time together
+
+    :param bank: ModelBank object
+    :param models: int array of bank model indices, one per segment
+    :param lengths: int array of frame counts, one per segment
+    :param rng: numpy RandomState
+    :return: float array (lengths.sum(), num_features) of the segments stacked in order
+    """
+    num_segments, max_length = len(models), int(lengths.max(initial=0))
+    last_state = np.maximum(bank.n_states[models] - 1, 0)
+    cum_start = np.cumsum(bank.startprob[models], axis=1)
+    cum_trans = np.cumsum(bank.transmat, axis=2)
+
+    states = np.zeros((num_segments, max(max_length, 1)), dtype=np.int64)
+    states[:, 0] = np.minimum((rng.random_sample((num_segments, 1)) > cum_start).sum(axis=1), last_state)
+    for t in range(1, max_length):
+        cum = cum_trans[models, states[:, t - 1]]
+        states[:, t] = np.minimum((rng.random_sample((num_segments, 1)) > cum).sum(axis=1), last_state)
+
+    in_segment = np.arange(states.shape[1]) < lengths[:, None]
+    frame_models, frame_states = np.repeat(models, lengths), states[in_segment]
+    noise = rng.standard_normal((len(frame_models), bank.num_features))
+    return bank.means[frame_models, frame_states] + np.sqrt(bank.variances[frame_models, frame_states]) * noise
+
+
+def _nose_centered(axis):
+    def compute(asl, values):
+        codes, speakers = asl.group_codes('speaker')
+        mean, _ = asl.speaker_stats.statistics(speakers, ['nose-' + axis])
+        return values - mean[codes, 0]
+    return compute
+
+
+def _gap_ranges(frames_df, words_df):
+    """ ranges of the frames before, between and after the words of each video; empty ranges are kept """
+    last_frames = frames_df.index.to_frame(index=False).groupby('video')['frame'].max()
+    words_df = words_df[words_df['video'].isin(last_frames.index)].sort_values(['video', 'startframe'])
+    rows = []
+    for video, ranges in words_df.groupby('video'):
+        starts = np.concatenate(([0], ranges['endframe'].values + 1))
+        ends = np.concatenate((ranges['startframe'].values - 1, [last_frames[video]]))
+        rows.extend((video, start, end) for start, end in zip(starts, ends))
+    return pd.DataFrame(rows, columns=['video', 'startframe', 'endframe'])
+
+
+def _video_starts(frame_videos):
+    counts = np.bincount(frame_videos)
+    return np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="writes a synthetic corpus sampled from models of the data")
+    parser.add_argument('out_dir')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the number of videos and speakers')
+    parser.add_argument('--videos', type=int, default=None)
+    parser.add_argument('--speakers', type=int, default=None)
+    parser.add_argument('--words', type=int, default=None, help='vocabulary size')
+    parser.add_argument('--sentence-length', type=float, default=4.4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    generator = CorpusGenerator.from_asl(AslDb())
+    files = generator.generate(args.out_dir,
+                               num_videos=args.videos or int(round(200 * args.scale)),
+                               num_speakers=args.speakers or max(int(round(3 * args.scale)), 1),
+                               num_words=args.words, sentence_length=args.sentence_length, seed=args.seed)
+    for name, fn in sorted(files.items()):
+        print("{:9} {}".format(name, fn))
+
+
+if __name__ == '__main__':
+    main()
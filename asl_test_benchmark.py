@@ -0,0 +1,23 @@
+from unittest import TestCase
+
+from asl_benchmark import compare, run_benchmarks
+
+
+class TestBenchmark(TestCase):
+    def test_run_benchmarks(self):
+        results = run_benchmarks(['features', 'select', 'recognize'], num_words=2, memory=False, repeat=1,
+                                 verbose=False)
+        self.assertIn('build_training/ground', results)
+        self.assertIn('select/SelectorBIC', results)
+        self.assertIn('recognize', results)
+        self.assertGreater(results['select/SelectorConstant']['fits'], 0)
+        self.assertTrue(all(stats['wall_time'] >= 0 for stats in results.values()))
+
+    def test_compare(self):
+        baseline = {'fast': {'wall_time': 1.0, 'peak_memory': 100}, 'slow': {'wall_time': 1.0, 'peak_memory': 100},
+                    'noise': {'wall_time': 0.001, 'peak_memory': None}}
+        results = {'fast': {'wall_time': 1.1, 'peak_memory': 100}, 'slow': {'wall_time': 2.0, 'peak_memory': 200},
+                   'noise': {'wall_time': 0.005, 'peak_memory': None}, 'new': {'wall_time': 5.0}}
+        regressions = compare(results, baseline, tolerance=0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(r.startswith('slow ') for r in regressions))
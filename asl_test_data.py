@@ -0,0 +1,174 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+
+from asl_data import AslDb, FEATURE_SETS, SpeakerStats, VideoStore
+from asl_synthetic import CorpusGenerator
+
+FEATURES = ['right-y', 'right-x']
+
+class TestAslDb(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_cached_frame_table(self):
+        parsed = AslDb(cache_dir=None)
+        AslDb(cache_dir=self.cache_dir.name)  # builds the cache
+        cached = AslDb(cache_dir=self.cache_dir.name)
+        self.assertListEqual(list(cached.df.columns), list(parsed.df.columns))
+        self.assertTrue(cached.df.index.equals(parsed.df.index))
+        self.assertTrue(cached.df.equals(parsed.df), "Cached frame table differs from the csv files")
+        self.assertEqual(cached.df.loc[(98, 1), 'speaker'], 'woman-1')
+
+    def test_cached_training_interface(self):
+        parsed = AslDb(cache_dir=None).build_training(FEATURES)
+        AslDb(cache_dir=self.cache_dir.name)
+        cached = AslDb(cache_dir=self.cache_dir.name).build_training(FEATURES)
+        X, lengths = cached.get_word_Xlengths('FRANK')
+        self.assertTrue(np.array_equal(X, parsed.get_word_Xlengths('FRANK')[0]))
+        self.assertListEqual(lengths, parsed.get_word_Xlengths('FRANK')[1])
+
+    def test_sequences_are_buffer_views(self):
+        training = AslDb(cache_dir=None).build_training(FEATURES)
+        X, lengths = training.get_word_Xlengths('FRANK')
+        sequences = training.get_word_sequences('FRANK')
+        self.assertEqual(len(sequences), len(lengths))
+        self.assertListEqual([len(s) for s in sequences], lengths)
+        self.assertTrue(np.shares_memory(X, sequences[0]))
+        self.assertFalse(np.shares_memory(X, training.get_word_Xlengths('BOOK')[0]))
+
+    def test_compact_dtypes(self):
+        asl = AslDb(cache_dir=self.cache_dir.name)
+        self.assertEqual(asl.df['right-x'].dtype, np.int32)
+        self.assertEqual(asl.feature_values('grnd-rx').dtype, np.float32)
+        compact = asl.build_training(FEATURES).get_word_Xlengths('FRANK')[0]
+        full = AslDb(cache_dir=self.cache_dir.name, dtype=np.float64).build_training(FEATURES)
+        X = full.get_word_Xlengths('FRANK')[0]
+        self.assertEqual(compact.dtype, np.float32)
+        self.assertEqual(compact.nbytes * 2, X.nbytes)
+        self.assertTrue(np.array_equal(compact, X))
+
+    def test_registered_features(self):
+        asl = AslDb(cache_dir=None)
+        self.assertListEqual(asl.feature_table(FEATURE_SETS['ground']).loc[(98, 1)].tolist(), [9, 113, -12, 119])
+        self.assertTrue(np.allclose(asl.feature_table(FEATURE_SETS['norm']).loc[(98, 1)],
+                                    [1.153, 1.663, -0.891, 0.742], atol=.001))
+        self.assertTrue(np.allclose(asl.feature_table(FEATURE_SETS['polar']).loc[(98, 1)],
+                                    [113.3578, 0.0794, 119.603, -0.1005], atol=.001))
+        self.assertListEqual(asl.feature_table(FEATURE_SETS['delta']).loc[(98, 0)].tolist(), [0, 0, 0, 0])
+        self.assertNotIn('grnd-rx', asl.df.columns)
+
+    def test_register_feature(self):
+        asl = AslDb(cache_dir=None)
+        asl.register_feature('grnd-rx2', ['grnd-rx'], lambda db, x: x * 2)
+        training = asl.build_training(['grnd-rx2', 'grnd-rx'])
+        X, _ = training.get_word_Xlengths('FRANK')
+        self.assertTrue(np.array_equal(X[:, 0], X[:, 1] * 2))
+
+    def test_reassigned_column_is_not_stale(self):
+        asl = AslDb(cache_dir=None)
+        before = asl.feature_values('right-x').copy()
+        asl.df['right-x'] = asl.df['right-x'] + 1
+        self.assertTrue(np.array_equal(asl.feature_values('right-x'), before + 1))
+
+    def test_derived_feature_follows_reassigned_input(self):
+        asl = AslDb(cache_dir=None)
+        before = asl.feature_values('grnd-rx').copy()
+        self.assertIs(asl.feature_values('grnd-rx'), asl.feature_values('grnd-rx'))
+        asl.df['right-x'] += 5
+        self.assertTrue(np.array_equal(asl.feature_values('grnd-rx'), before + 5))
+        self.assertTrue(np.array_equal(asl.feature_table(FEATURE_SETS['ground'])['grnd-rx'], before + 5))
+
+    def test_append_videos_updates_speaker_stats(self):
+        hands = pd.read_csv(os.path.join('data', 'hands_condensed.csv'))
+        speakers = pd.read_csv(os.path.join('data', 'speaker.csv'))
+        new_videos = hands['video'].unique()[-5:]
+        hands_fn = os.path.join(self.cache_dir.name, 'hands.csv')
+        hands[~hands['video'].isin(new_videos)].to_csv(hands_fn, index=False)
+        asl = AslDb(hands_fn, cache_dir=None)
+        asl.feature_table(FEATURE_SETS['norm'])
+        asl.append_videos(hands[hands['video'].isin(new_videos)], speakers)
+        full = AslDb(cache_dir=None)
+        appended = asl.feature_table(FEATURE_SETS['norm']).sort_index()
+        self.assertTrue(np.allclose(appended.values, full.feature_table(FEATURE_SETS['norm']).sort_index().values))
+
+        stats_fn = os.path.join(self.cache_dir.name, 'speaker_stats.npz')
+        asl.speaker_stats.save(stats_fn)
+        stats = SpeakerStats.load(stats_fn)
+        mean, std = stats.statistics(['man-1', 'unseen'])
+        self.assertTrue(np.allclose(mean[1], stats.pooled()[0]))
+        stats.update(['unseen'] * stats.min_frames, np.ones((stats.min_frames, len(stats.columns))))
+        self.assertTrue(np.allclose(stats.statistics(['unseen'])[0], 1))
+
+    def test_speaker_stats_few_frames(self):
+        rng = np.random.RandomState(14)
+        stats = SpeakerStats(['a', 'b'], min_frames=10)
+        stats.update(['man-1'] * 200, rng.normal(5, 2, (200, 2)))
+        pooled_mean, pooled_std = stats.pooled()
+        mean, std = stats.statistics(['unseen'])
+        self.assertTrue(np.allclose(mean[0], pooled_mean) and np.allclose(std[0], pooled_std))
+
+        stats.update(['woman-1'] * 5, np.column_stack([np.arange(5.0), np.full(5, 0.1)]))
+        mean, std = stats.statistics(['woman-1'])
+        self.assertTrue(np.allclose(mean[0], stats.pooled()[0]))
+
+        stats.update(['woman-1'] * 5, np.column_stack([np.arange(5.0), np.full(5, 0.1)]))
+        mean, std = stats.statistics(['woman-1'])
+        self.assertAlmostEqual(mean[0, 1], 0.1)
+        self.assertAlmostEqual(std[0, 1], stats.pooled()[1][1])
+        normalized = stats.normalize(['woman-1', 'unseen'], [[1.0, 0.1], [1.0, 0.1]])
+        self.assertTrue(np.isfinite(normalized).all())
+
+    def test_video_store(self):
+        store_dir = os.path.join(self.cache_dir.name, 'store')
+        store = VideoStore.build(store_dir, os.path.join('data', 'hands_condensed.csv'),
+                                 os.path.join('data', 'speaker.csv'), chunksize=5000)
+        full = AslDb(cache_dir=None)
+        self.assertTrue(store.frame_table([98]).equals(full.df.loc[[98]].sort_index()))
+
+        asl = AslDb.from_store(store_dir)
+        self.assertEqual(len(asl.df), 0)
+        for features in (FEATURE_SETS['ground'], FEATURE_SETS['norm']):
+            X, lengths = asl.build_training(features).get_word_Xlengths('FRANK')
+            expected = full.build_training(features).get_word_Xlengths('FRANK')
+            self.assertTrue(np.allclose(X, expected[0]))
+            self.assertListEqual(lengths, expected[1])
+        working_set = asl.working_set(pd.read_csv(os.path.join('data', 'test_words.csv'))['video'].unique())
+        self.assertLess(len(working_set.df), len(full.df))
+
+    def test_video_store_rebuild(self):
+        store_dir = os.path.join(self.cache_dir.name, 'store')
+        speakers_fn = os.path.join('data', 'speaker.csv')
+        VideoStore.build(store_dir, os.path.join('data', 'hands_condensed.csv'), speakers_fn)
+        before = AslDb.from_store(store_dir).speaker_stats
+        hands = pd.read_csv(os.path.join('data', 'hands_condensed.csv'))
+        hands[['left-x', 'right-x']] += 100
+        hands_fn = os.path.join(self.cache_dir.name, 'hands.csv')
+        hands.to_csv(hands_fn, index=False)
+        VideoStore.build(store_dir, hands_fn, speakers_fn)
+        after = AslDb.from_store(store_dir).speaker_stats
+        x = [before.columns.index('left-x'), before.columns.index('right-x')]
+        self.assertTrue(np.allclose(after.mean[:, x], before.mean[:, x] + 100))
+
+    def test_synthetic_corpus(self):
+        asl = AslDb(cache_dir=None)
+        generator = CorpusGenerator.from_asl(asl, words=['JOHN', 'FISH', 'BOOK', 'MARY'])
+        files = generator.generate(self.cache_dir.name, num_videos=20, num_speakers=2, num_words=6, seed=3)
+        with open(files['hands'], 'rb') as f:
+            hands = f.read()
+        generator.generate(self.cache_dir.name, num_videos=20, num_speakers=2, num_words=6, seed=3)
+        with open(files['hands'], 'rb') as f:
+            self.assertEqual(f.read(), hands, "Same seed produced a different corpus")
+
+        synthetic = AslDb(files['hands'], files['speakers'], cache_dir=None)
+        training = synthetic.build_training(FEATURE_SETS['ground'], files['train'])
+        test_set = synthetic.build_test(FEATURE_SETS['ground'], files['test'])
+        self.assertLessEqual(len(training.words), 6)
+        self.assertEqual(len(synthetic.df.index.get_level_values('video').unique()), 20)
+        self.assertEqual(test_set.num_items, len(pd.read_csv(files['test'])))
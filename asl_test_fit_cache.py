@@ -0,0 +1,94 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from asl_data import AslDb
+from asl_fit_cache import FitCache, model_from_params, model_params
+from my_model_selectors import SelectorConstant
+
+
+def make_params(num_states, num_features=2, offset=0.0):
+    return {
+        'startprob': np.full(num_states, 1.0 / num_states),
+        'transmat': np.full((num_states, num_states), 1.0 / num_states),
+        'means': np.arange(num_states * num_features, dtype=np.float64).reshape(num_states, num_features) + offset,
+        'covars': np.ones((num_states, num_features)),
+    }
+
+
+class TestFitCache(TestCase):
+    def setUp(self):
+        self.X = np.arange(20, dtype=np.float64).reshape(10, 2)
+        self.lengths = [4, 6]
+
+    def test_hit_and_miss(self):
+        cache = FitCache()
+        key = cache.key(self.X, self.lengths, n_components=3)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, make_params(3))
+        params = cache.get(key)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        np.testing.assert_array_equal(params['means'], make_params(3)['means'])
+
+    def test_entries_are_copied(self):
+        cache = FitCache()
+        key = cache.key(self.X, self.lengths, n_components=3)
+        params = make_params(3)
+        cache.put(key, params)
+        params['means'][:] = -1
+        model = model_from_params(cache.get(key))
+        model.means_[:] = -2
+        np.testing.assert_array_equal(cache.get(key)['means'], make_params(3)['means'])
+        self.assertFalse(np.shares_memory(model_params(model)['means'], model.means_))
+
+    def test_lru_bound(self):
+        cache = FitCache(max_memory_entries=2)
+        keys = [cache.key(self.X, self.lengths, n_components=n) for n in (2, 3, 4)]
+        cache.put(keys[0], make_params(2))
+        cache.put(keys[1], make_params(3))
+        cache.get(keys[0])
+        cache.put(keys[2], make_params(4))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+
+    def test_disk_round_trip(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            key = FitCache.key(self.X, self.lengths, n_components=3)
+            FitCache(cache_dir).put(key, make_params(3, offset=0.5))
+            params = FitCache(cache_dir).get(key)
+            for name, value in make_params(3, offset=0.5).items():
+                np.testing.assert_array_equal(params[name], value)
+            small = FitCache(cache_dir, max_disk_entries=1)
+            small.put(FitCache.key(self.X, self.lengths, n_components=4), make_params(4))
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_key_sensitivity(self):
+        key = FitCache.key(self.X, self.lengths, n_components=3, random_state=14)
+        self.assertEqual(key, FitCache.key(self.X.copy(), list(self.lengths), random_state=14, n_components=3))
+        changed = self.X.copy()
+        changed[0, 0] += 1e-9
+        others = [
+            FitCache.key(changed, self.lengths, n_components=3, random_state=14),
+            FitCache.key(self.X, [5, 5], n_components=3, random_state=14),
+            FitCache.key(self.X.reshape(5, 4), self.lengths, n_components=3, random_state=14),
+            FitCache.key(self.X, self.lengths, n_components=4, random_state=14),
+            FitCache.key(self.X, self.lengths, n_components=3, random_state=15),
+            FitCache.key(self.X, self.lengths, n_components=3, random_state=14, init='warm'),
+        ]
+        self.assertEqual(len(set(others + [key])), len(others) + 1)
+
+    def test_selector_reuses_fits(self):
+        training = AslDb().build_training(['right-y', 'right-x'])
+        sequences, xlengths = training.get_all_sequences(), training.get_all_Xlengths()
+        cache = FitCache()
+        first = SelectorConstant(sequences, xlengths, 'BOOK', fit_cache=cache).select()
+        second = SelectorConstant(sequences, xlengths, 'BOOK', fit_cache=cache).select()
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        np.testing.assert_array_equal(first.means_, second.means_)
+        self.assertFalse(np.shares_memory(first.means_, second.means_))
+        self.assertEqual(second.monitor_.iter, first.monitor_.iter)
+        self.assertEqual(list(second.monitor_.history), list(first.monitor_.history))
+        self.assertEqual(second.monitor_.converged, first.monitor_.converged)
@@ -1,8 +1,18 @@
+import os
+import tempfile
 from unittest import TestCase
 
+import numpy as np
+
+from asl_adaptation import AdaptiveModels
+from asl_batch_training import fit_batch
 from asl_data import AslDb
+from asl_events import EventCollector
+from asl_experiments import make_grid, run_grid
+from asl_fit_cache import model_params
+from asl_utils import train_all_words
 from my_model_selectors import (
-    SelectorConstant, SelectorBIC, SelectorDIC, SelectorCV,
+    SelectorConstant, SelectorBIC, SelectorDIC, SelectorCV, split_state,
 )
 
 FEATURES = ['right-y', 'right-x']
@@ -37,3 +47,133 @@ class TestSelectors(TestCase):
         self.assertGreaterEqual(model.n_components, 2)
         model = SelectorDIC(self.sequences, self.xlengths, 'TOY').select()
         self.assertGreaterEqual(model.n_components, 2)
+
+    def test_select_all_dic_matches_select(self):
+        words = ['MARY', 'TOY', 'FRANK', 'BOOK', 'JOHN']
+        sequences = {word: self.sequences[word] for word in words}
+        xlengths = {word: self.xlengths[word] for word in words}
+        models = SelectorDIC.select_all(sequences, xlengths, max_n_components=5)
+        self.assertListEqual(list(models), words)
+        for word in words:
+            model = SelectorDIC(sequences, xlengths, word, max_n_components=5).select()
+            self.assertEqual(models[word].n_components, model.n_components)
+            self.assertTrue(np.allclose(models[word].means_, model.means_))
+
+    def test_fit_events(self):
+        events = EventCollector()
+        SelectorBIC(self.sequences, self.xlengths, 'FRANK', max_n_components=4, fit_cache=None,
+                    events=events).select()
+        SelectorCV(self.sequences, self.xlengths, 'JOHN', max_n_components=3, fit_cache=None,
+                   events=events).select()
+        bic = [e for e in events.events if e.selector == 'SelectorBIC']
+        self.assertListEqual([e.n_states for e in bic], [2, 3, 4, bic[-1].n_states])
+        self.assertTrue(all(e.criterion == 'BIC' and e.iterations > 0 for e in bic[:3]))
+        folds = [e.fold for e in events.events if e.selector == 'SelectorCV' and e.criterion == 'CV']
+        self.assertListEqual(folds, [0, 1, 2, 0, 1, 2])
+        profile = events.profile('selector')
+        self.assertEqual(profile['SelectorBIC']['fits'], 4)
+        self.assertEqual(profile['SelectorCV']['fits'], 7)
+
+    def test_cv_folds(self):
+        # every frame of sequence i holds the value i, so folds can be mapped back to sequences
+        lengths = [i % 4 + 2 for i in range(12)]
+        sequences = [np.full((length, 2), i, dtype=np.float64) for i, length in enumerate(lengths)]
+        xlengths = {'W': (np.concatenate(sequences), lengths)}
+        for n_repeats, stratify in [(1, False), (2, False), (2, True)]:
+            selector = SelectorCV({'W': sequences}, xlengths, 'W', n_splits=3, n_repeats=n_repeats,
+                                  stratify=stratify)
+            folds = selector.cv_folds()
+            self.assertEqual(len(folds), 3 * n_repeats)
+            for repeat in range(n_repeats):
+                tested = []
+                for (X_train, _), (X_test, lengths_test) in folds[3 * repeat:3 * repeat + 3]:
+                    train_ids, test_ids = set(X_train[:, 0]), set(X_test[:, 0])
+                    self.assertFalse(train_ids & test_ids)
+                    self.assertEqual(len(train_ids | test_ids), 12)
+                    tested.extend(test_ids)
+                    if stratify:
+                        self.assertListEqual(sorted(lengths_test), [2, 3, 4, 5])
+                self.assertListEqual(sorted(tested), list(range(12)))
+
+    def test_cv_parallel_matches_serial(self):
+        serial = SelectorCV(self.sequences, self.xlengths, 'JOHN', max_n_components=4).select()
+        parallel = SelectorCV(self.sequences, self.xlengths, 'JOHN', max_n_components=4, n_jobs=2).select()
+        self.assertEqual(parallel.n_components, serial.n_components)
+        self.assertTrue(np.array_equal(parallel.means_, serial.means_))
+
+    def test_patience_stops_search(self):
+        events = EventCollector()
+        SelectorBIC(self.sequences, self.xlengths, 'FRANK', max_n_components=15, patience=2,
+                    events=events).select()
+        scores = [e.score for e in events.events if e.criterion == 'BIC']
+        self.assertLess(len(scores), 14)
+        self.assertEqual(len(scores) - 1 - int(np.argmin(scores)), 2)
+
+    def test_split_state(self):
+        params = model_params(SelectorConstant(self.sequences, self.xlengths, 'FRANK').select())
+        for num_states in (4, 5):
+            params = split_state(params)
+            self.assertEqual(params['startprob'].shape, (num_states,))
+            self.assertEqual(params['transmat'].shape, (num_states, num_states))
+            self.assertEqual(params['means'].shape, (num_states, len(FEATURES)))
+            self.assertAlmostEqual(params['startprob'].sum(), 1)
+            self.assertTrue(np.allclose(params['transmat'].sum(axis=1), 1))
+            self.assertTrue((params['transmat'] >= 0).all())
+            self.assertTrue((params['covars'] > 0).all())
+
+    def test_parallel_training_matches_serial(self):
+        serial = train_all_words(self.training, SelectorConstant)
+        parallel = train_all_words(self.training, SelectorConstant, n_jobs=2)
+        self.assertListEqual(list(parallel), list(serial))
+        for word, model in serial.items():
+            if model is None:
+                self.assertIsNone(parallel[word])
+                continue
+            self.assertEqual(parallel[word].n_components, model.n_components)
+            self.assertTrue(np.array_equal(parallel[word].means_, model.means_))
+            self.assertTrue(np.array_equal(parallel[word].transmat_, model.transmat_))
+
+    def test_batched_training_matches_selector(self):
+        words = ['FRANK', 'BOOK', 'CHICKEN', 'JOHN']
+        batched = fit_batch(self.xlengths, [(word, 3) for word in words] + [('FRANK', 5)], fit_cache=None)
+        for word, num_states in [(word, 3) for word in words] + [('FRANK', 5)]:
+            model = SelectorConstant(self.sequences, self.xlengths, word, n_constant=num_states,
+                                     fit_cache=None).select()
+            X, lengths = self.xlengths[word]
+            logL = model.score(X, lengths)
+            self.assertEqual(batched[(word, num_states)].n_components, num_states)
+            self.assertAlmostEqual(batched[(word, num_states)].score(X, lengths), logL, delta=1e-3 * abs(logL))
+
+    def test_experiment_grid(self):
+        cells = make_grid(['ground'], ['Constant'], [(2, 3), (2, 4)])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results_fn = os.path.join(tmp_dir, 'results.csv')
+            table = run_grid(cells, n_jobs=2, results_fn=results_fn, verbose=False)
+            self.assertTrue(os.path.exists(results_fn))
+        self.assertEqual(len(table), 2)
+        self.assertListEqual(list(table['max_states']), [3, 4])
+        # SelectorConstant ignores the state range, so both cells train the same models
+        self.assertEqual(table['wer'][0], table['wer'][1])
+        self.assertTrue(0 <= table['wer'][0] < 1)
+
+    def test_adaptive_models_update(self):
+        words = ['FRANK', 'BOOK', 'JOHN']
+        sequences = self.sequences['FRANK']
+        half = len(sequences) // 2
+        initial_sequences = dict(self.sequences, FRANK=sequences[:half])
+        initial_xlengths = dict(self.xlengths, FRANK=(np.concatenate(sequences[:half]),
+                                                      [len(s) for s in sequences[:half]]))
+        models = {word: SelectorConstant(initial_sequences, initial_xlengths, word).select() for word in words}
+        X, lengths = self.xlengths['FRANK']
+        before = models['FRANK'].score(X, lengths)
+
+        adaptive = AdaptiveModels(models, initial_sequences, initial_xlengths)
+        model = adaptive.update('FRANK', sequences[half:])
+        self.assertEqual(model.n_components, 3)
+        self.assertGreaterEqual(model.score(X, lengths), before)
+        self.assertListEqual(adaptive.Xlengths['FRANK'][1], lengths)
+        self.assertListEqual(adaptive.reselected, [])
+
+        map_model = AdaptiveModels(models, initial_sequences, initial_xlengths, method='map').update(
+            'FRANK', sequences[half:])
+        self.assertEqual(map_model.n_components, 3)
@@ -1,9 +1,19 @@
+import asyncio
+import os
+import tempfile
 from unittest import TestCase
 
-from asl_data import AslDb
+import numpy as np
+
+from asl_data import AslDb, FEATURE_SETS
+from asl_language_model import NgramLM
+from asl_scoring import FLOAT32_RTOL, ModelBank
+from asl_server import RecognitionServer
 from asl_utils import train_all_words
 from my_model_selectors import SelectorConstant
-from my_recognizer import recognize
+from my_recognizer import (
+    recognize, recognize_pruned, recognize_sentences, ContinuousRecognizer, StreamingRecognizer,
+)
 
 FEATURES = ['right-y', 'right-x']
 
@@ -26,3 +36,177 @@ class TestRecognize(TestCase):
         self.assertIsInstance(guesses[0], str, "The guesses are not strings")
         self.assertIsInstance(guesses[-1], str, "The guesses are not strings")
 
+
+    def test_recognize_batched_matches_model_scores(self):
+        batched_probs, batched_guesses = recognize(self.models, self.test_set, dtype=np.float64)
+        probs, guesses = recognize(self.models, self.test_set, batched=False)
+        self.assertListEqual(batched_guesses, guesses)
+        for word in ['FRANK', 'CHICKEN']:
+            self.assertAlmostEqual(batched_probs[0][word], probs[0][word], delta=1e-6 * abs(probs[0][word]))
+
+    def test_recognize_float32_tolerance(self):
+        probs, guesses = recognize(self.models, self.test_set, dtype=np.float64)
+        compact_probs, compact_guesses = recognize(self.models, self.test_set, dtype=np.float32)
+        self.assertEqual(self.test_set.dtype, np.float32)
+        for i, word in enumerate(guesses):
+            self.assertAlmostEqual(compact_probs[i][word], probs[i][word], delta=FLOAT32_RTOL * abs(probs[i][word]))
+        agreement = np.mean([a == b for a, b in zip(compact_guesses, guesses)])
+        self.assertGreaterEqual(agreement, 0.95)
+
+    def test_recognize_pruned_without_pruning_matches_recognize(self):
+        probs, guesses = recognize(self.models, self.test_set, dtype=np.float32)
+        for top_k in (None, len(self.models)):
+            pruned_probs, pruned_guesses, report = recognize_pruned(self.models, self.test_set, top_k=top_k,
+                                                                    dtype=np.float32)
+            self.assertListEqual(pruned_probs, probs)
+            self.assertListEqual(pruned_guesses, guesses)
+            self.assertEqual(report['skipped'], 0)
+            self.assertEqual(report['forward_steps'], report['full_forward_steps'])
+
+    def test_recognize_pruned_report_counts(self):
+        probs, _, report = recognize_pruned(self.models, self.test_set, top_k=10, beam=50.0)
+        scored = sum(np.isfinite(logL) for item in probs for logL in item.values())
+        self.assertEqual(report['skipped'], report['prefiltered'] + report['pruned'])
+        self.assertEqual(scored, report['items'] * report['scorable_words'] - report['skipped'])
+        self.assertEqual(report['prefiltered'], report['items'] * (report['scorable_words'] - 10))
+        self.assertLess(report['forward_steps'], report['full_forward_steps'])
+
+    def test_streaming_recognizer_matches_recognize(self):
+        probs, guesses = recognize(self.models, self.test_set, dtype=np.float64)
+        stream = StreamingRecognizer(self.models, FEATURES)
+        X, _ = self.test_set.get_item_Xlengths(0)
+        for frame in X:
+            stream.push(frame)
+        word, logL = stream.best(1)[0]
+        self.assertEqual(word, guesses[0])
+        self.assertAlmostEqual(logL, probs[0][word], delta=1e-6 * abs(logL))
+
+    def test_streaming_recognizer_from_feature_table(self):
+        features = FEATURE_SETS['ground']
+        training = self.asl.build_training(features)
+        words = ['JOHN', 'WRITE', 'HOMEWORK', 'FRANK']
+        models = {word: SelectorConstant(training.get_all_sequences(), training.get_all_Xlengths(), word).select()
+                  for word in words}
+        test_set = self.asl.build_test(features)
+        probs, _ = recognize(models, test_set, dtype=np.float64)
+        item = test_set.df.iloc[0]
+        stream = StreamingRecognizer(models, features)
+        rows = self.asl.feature_table(features).loc[item['video']].loc[item['startframe']:item['endframe']]
+        for frame, row in rows.iterrows():
+            stream.push(row)
+        self.assertEqual(stream.num_frames, test_set.get_item_Xlengths(0)[1][0])
+        for word, logL in zip(stream.bank.words, stream.log_likelihoods()):
+            self.assertAlmostEqual(logL, probs[0][word], delta=1e-6 * abs(logL))
+
+    def test_recognize_from_model_bank_file(self):
+        _, guesses = recognize(self.models, self.test_set)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fn = os.path.join(tmp_dir, 'models.bank')
+            ModelBank.from_models(self.models).save(fn)
+            bank = ModelBank.load(fn)
+            _, bank_guesses = recognize(bank, self.test_set)
+            del bank
+        self.assertListEqual(bank_guesses, guesses)
+
+    def test_recognize_keeps_model_bank_dtype(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fn = os.path.join(tmp_dir, 'models.bank')
+            ModelBank.from_models(self.models, np.float32).save(fn)
+            bank = ModelBank.load(fn)
+            self.assertIs(bank.astype(np.float32), bank)
+            probs, _ = recognize(bank, self.test_set)
+            scores = bank.score_matrix(self.test_set)
+            del bank
+        full_probs, _ = recognize(self.models, self.test_set)
+        self.assertNotEqual(probs[0], full_probs[0])
+        self.assertListEqual([probs[0][word] for word in self.models], scores[0].tolist())
+
+    def test_recognize_sentences_without_lm_weight(self):
+        probs, guesses = recognize(self.models, self.test_set)
+        lm = NgramLM.from_words_csv(order=2)
+        sentence_guesses = recognize_sentences(probs, self.test_set, lm, lm_weight=0)
+        self.assertListEqual(sentence_guesses, guesses)
+
+    def test_recognize_sentences_interface(self):
+        bank = ModelBank.from_models(self.models)
+        lm = NgramLM.from_words_csv(order=2)
+        guesses = recognize_sentences((bank.score_matrix(self.test_set), bank.words), self.test_set, lm,
+                                      lm_weight=10, beam=50)
+        self.assertEqual(len(guesses), self.test_set.num_items)
+        self.assertIsInstance(guesses[0], str, "The guesses are not strings")
+
+    def test_continuous_recognizer_segments_video(self):
+        decoder = ContinuousRecognizer(self.models, FEATURES, word_penalty=-20, beam=500)
+        video = next(iter(self.test_set.sentences_index))
+        segments = decoder.decode_video(self.asl, video)
+        frames = self.asl.df.loc[video].index.values
+        self.assertEqual(segments[0][1], frames[0])
+        self.assertEqual(segments[-1][2], frames[-1])
+        for (_, _, end), (word, start, _) in zip(segments, segments[1:]):
+            self.assertEqual(start, end + 1)
+            self.assertIn(word, self.models)
+
+    def test_continuous_recognizer_single_word(self):
+        bank = ModelBank.from_models(self.models)
+        X, _ = self.test_set.get_item_Xlengths(0)
+        segments = ContinuousRecognizer(bank, word_penalty=-1e6).decode(X)
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(segments[0][1:], (0, len(X) - 1))
+
+    def test_score_batch_matches_score_matrix(self):
+        bank = ModelBank.from_models(self.models)
+        items = [0, 5, 1, 17]
+        scores = bank.score_batch([self.test_set.get_item_Xlengths(i)[0] for i in items])
+        self.assertTrue(np.allclose(scores, bank.score_matrix(self.test_set)[items]))
+
+    def test_empty_model_bank_scores_minus_inf(self):
+        X, lengths = self.test_set.get_item_Xlengths(0)
+        for dtype in (np.float64, np.float32):
+            bank = ModelBank.from_models({'FRANK': None, 'CHICKEN': None}, dtype)
+            self.assertEqual(bank.num_features, 0)
+            self.assertTrue(np.all(bank.score(X, lengths) == -np.inf))
+            self.assertTrue(np.all(bank.score_matrix(self.test_set) == -np.inf))
+            self.assertTrue(np.all(bank.score_batch([X, X[:3]]) == -np.inf))
+            self.assertTrue(np.all(bank.score_sequence_pruned(X)[0] == -np.inf))
+            self.assertTrue(np.all(bank.prefilter_scores(X) == -np.inf))
+
+    def test_recognition_server_batches_requests(self):
+        probs, guesses = recognize(self.models, self.test_set, dtype=np.float64)
+        server = RecognitionServer(ModelBank.from_models(self.models), max_batch_size=8, max_wait=0.05, top_k=3)
+
+        async def run():
+            items = range(20)
+            results = await asyncio.gather(*[server.recognize(self.test_set.get_item_Xlengths(i)[0])
+                                             for i in items])
+            await server.stop()
+            return results
+
+        results = asyncio.run(run())
+        for i, words in enumerate(results):
+            self.assertEqual(len(words), 3)
+            self.assertEqual(words[0][0], guesses[i])
+        stats = server.stats()
+        self.assertEqual(stats['requests'], 20)
+        self.assertLess(stats['batches'], 20)
+        self.assertLessEqual(stats['batch_size']['p99'], 8)
+
+
+class TestNgramLM(TestCase):
+    def test_bigram_probabilities(self):
+        lm = NgramLM.train([['JOHN', 'LOVE', 'MARY'], ['MARY', 'LOVE', 'JOHN']], order=2)
+        for history in [(), ('JOHN',), ('LOVE',)]:
+            total = sum(np.exp(lm.log_prob(word, history)) for word in lm.words)
+            self.assertAlmostEqual(total, 1.0)
+        self.assertGreater(lm.log_prob('LOVE', ['JOHN']), lm.log_prob('MARY', ['JOHN']))
+
+    def test_from_arpa(self):
+        arpa = '\\data\\\nngram 1=4\nngram 2=2\n\n\\1-grams:\n-0.5\t</s>\n-99\t<s>\t-0.3\n' \
+               '-0.5\tJOHN\t-0.2\n-1.0\t<unk>\n\n\\2-grams:\n-0.1\t<s> JOHN\n-0.2\tJOHN </s>\n\n\\end\\\n'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fn = os.path.join(tmp_dir, 'lm.arpa')
+            with open(fn, 'w') as f:
+                f.write(arpa)
+            lm = NgramLM.from_arpa(fn)
+        self.assertAlmostEqual(lm.log_prob('JOHN'), -0.1 * np.log(10))
+        self.assertAlmostEqual(lm.log_prob('</s>', ['JOHN']), -0.2 * np.log(10))
+        self.assertAlmostEqual(lm.log_prob('</s>'), (-0.3 - 0.5) * np.log(10))
@@ -1,3 +1,7 @@
+import multiprocessing
+import os
+import warnings
+
 from asl_data import SinglesData, WordsData
 import numpy as np
 from IPython.core.display import display, HTML
@@ -42,15 +46,21 @@ def getKey(item):
     return item[1]
 
 
-def train_all_words(training: WordsData, model_selector):
+def train_all_words(training: WordsData, model_selector, n_jobs=1):
     """ train all words given a training set and selector
 
     :param training: WordsData object (training set)
     :param model_selector: class (subclassed from ModelSelector)
+    :param n_jobs: int or None
+        number of worker processes; 1 trains serially and None uses one worker per cpu
     :return: dict of models keyed by word
     """
     sequences = training.get_all_sequences()
     Xlengths = training.get_all_Xlengths()
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs > 1 and len(training.words) > 1:
+        return _train_all_words_parallel(training.words, sequences, Xlengths, model_selector, n_jobs)
     model_dict = {}
     for word in training.words:
         model = model_selector(sequences, Xlengths, word,
@@ -59,6 +69,71 @@ def train_all_words(training: WordsData, model_selector):
     return model_dict
 
 
+def run_in_pool(function, jobs, n_jobs, initializer, initargs):
+    """ function(job) for every job, computed on a pool of worker processes
+
+    The data shared by all jobs is handed to each worker once as the pool initializer's arguments, inherited
+    without pickling where processes are forked, rather than with every job.  Jobs are started in the order
+    given, one at a time per worker.  When no pool can be started, e.g. without process support or inside a
+    daemonic worker, which cannot start its own pool, the jobs run in this process after a warning.
+
+    :param function: picklable function of one job, reading the shared data set by initializer
+    :param jobs: list of picklable jobs
+    :param n_jobs: int number of worker processes, at most one per job
+    :param initializer: picklable function storing initargs for function in the worker process
+    :param initargs: tuple
+    :return: list of results in the order of jobs
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    try:
+        with context.Pool(min(n_jobs, len(jobs)), initializer=initializer, initargs=initargs) as pool:
+            return pool.map(function, jobs, chunksize=1)
+    except (OSError, AssertionError) as e:
+        warnings.warn("worker processes unavailable ({}), running serially".format(e))
+    initializer(*initargs)
+    return [function(job) for job in jobs]
+
+
+def estimate_training_cost(Xlengths: dict, word: str, selector):
+    """ relative cost of selecting a model for word: number of frames times number of candidate state counts
+
+    :param Xlengths: dict of (X, lengths) tuples keyed by word
+    :param word: str
+    :param selector: ModelSelector object for word
+    :return: int
+    """
+    num_frames = sum(Xlengths[word][1])
+    num_candidates = max(selector.max_n_components - selector.min_n_components + 1, 1)
+    return num_frames * num_candidates
+
+
+# training data of the current worker process, set once per worker by _init_training_worker
+_worker_training = None
+
+
+def _init_training_worker(sequences, Xlengths, model_selector):
+    global _worker_training
+    _worker_training = sequences, Xlengths, model_selector
+
+
+def _select_word(word):
+    sequences, Xlengths, model_selector = _worker_training
+    return word, model_selector(sequences, Xlengths, word, n_constant=3).select()
+
+
+def _train_all_words_parallel(words, sequences, Xlengths, model_selector, n_jobs):
+    """ runs ModelSelector.select() for every word with run_in_pool, most expensive word first so that a large
+    word does not start last and leave a single straggler running
+    """
+    costs = {word: estimate_training_cost(Xlengths, word, model_selector(sequences, Xlengths, word, n_constant=3))
+             for word in words}
+    jobs = sorted(words, key=costs.get, reverse=True)
+    results = dict(run_in_pool(_select_word, jobs, n_jobs, _init_training_worker,
+                               (sequences, Xlengths, model_selector)))
+    return {word: results[word] for word in words}
+
+
 def combine_sequences(split_index_list, sequences):
     '''
     concatenate sequences referenced in an index list and returns tuple of the new X,lengths
@@ -75,6 +150,26 @@ def combine_sequences(split_index_list, sequences):
     return X, lengths
 
 
+def combine_Xlengths(split_index_list, X, lengths):
+    '''
+    gather the sequences referenced in an index list from a contiguous X array and returns tuple of the new X,lengths
+
+    index array version of combine_sequences: the rows of the selected sequences are taken from X in one
+    operation instead of flattening the sequences item by item
+
+    :param split_index_list: a list of indices as created by KFold splitting
+    :param X: numpy array of stacked sequences
+    :param lengths: list of sequence lengths within X
+    :return: tuple of numpy array, list in format of X,lengths use in hmmlearn
+    '''
+    split_index_list = np.asarray(split_index_list, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[split_index_list]
+    fold_lengths = lengths[split_index_list]
+    positions = np.repeat(starts - np.cumsum(fold_lengths) + fold_lengths, fold_lengths) + np.arange(fold_lengths.sum())
+    return X[positions], [int(n) for n in fold_lengths]
+
+
 def putHTML(color, msg):
     source = """<font color={}>{}</font><br/>""".format(color, msg)
     return HTML(source)
@@ -1,12 +1,17 @@
 import math
+import os
 import statistics
+import time
 import warnings
 import copy # Used for deep copy
 
 import numpy as np
 from hmmlearn.hmm import GaussianHMM
-from sklearn.model_selection import KFold
-from asl_utils import combine_sequences
+from sklearn.model_selection import KFold, StratifiedKFold
+from asl_events import FitEvent
+from asl_fit_cache import model_from_params, model_params, params_digest
+from asl_scoring import ModelBank
+from asl_utils import combine_Xlengths, run_in_pool
 
 
 class ModelSelector(object):
@@ -17,7 +22,8 @@ class ModelSelector(object):
     def __init__(self, all_word_sequences: dict, all_word_Xlengths: dict, this_word: str,
                  n_constant=3,
                  min_n_components=2, max_n_components=10,
-                 random_state=14, verbose=False):
+                 random_state=14, verbose=False, fit_cache=None,
+                 warm_start=False, patience=None, tol=0.01, events=None):
         self.words = all_word_sequences
         self.hwords = all_word_Xlengths
         self.sequences = all_word_sequences[this_word]
@@ -28,21 +34,127 @@ class ModelSelector(object):
         self.max_n_components = max_n_components
         self.random_state = random_state
         self.verbose = verbose
+        self.fit_cache = fit_cache
+        # state-count search: warm_start grows each candidate from the previous one by splitting a state,
+        # patience stops the search after that many candidates without improvement, tol is the EM tolerance
+        self.warm_start = warm_start
+        self.patience = patience
+        self.tol = tol
+        # sink with a record(FitEvent) method, e.g. asl_events.EventCollector, or None to record nothing
+        self.events = events
+        self._pending_event = None
 
     def select(self):
         raise NotImplementedError
 
+    def fit_model(self, num_states, X=None, lengths=None, init_model=None, fold=None):
+        ''' fits a GaussianHMM on X, lengths (this word's data by default), reusing cached parameters of an
+        identical earlier fit when a fit cache is set
+
+        With an event sink, a fit that raises is recorded right away and a successful one once the selector
+        has scored it with record_fit (or when the next fit starts).
+
+        :param init_model: GaussianHMM object or None
+            fitted model with fewer states to warm start from; its highest variance states are split until
+            the model has num_states states
+        :param fold: int cross-validation fold of X, lengths, only used to label the fit event
+        :return: GaussianHMM object; exceptions raised by hmmlearn are passed on
+        '''
+        if X is None:
+            X, lengths = self.X, self.lengths
+        hyperparameters = self.hmm_hyperparameters(num_states)
+        init_params = self.initial_params(num_states, init_model)
+        if self.events is None:
+            return self._fit_cached_model(hyperparameters, X, lengths, init_params)[0]
+        self.record_fit()
+        start = time.perf_counter()
+        try:
+            hmm_model, cached = self._fit_cached_model(hyperparameters, X, lengths, init_params)
+        except Exception as e:
+            self.events.record(self._fit_event(num_states, fold, None, start, exception=e))
+            raise
+        self._pending_event = self._fit_event(num_states, fold, hmm_model, start, cached=cached)
+        return hmm_model
+
+    def record_fit(self, criterion=None, score=None, logL=None, exception=None):
+        ''' sends the event of the last fit_model call, if not sent yet, to the event sink
+
+        :param criterion: str name of the score the selector gave the fit, e.g. 'BIC'
+        :param score: float
+        :param logL: float log-likelihood the score was computed from
+        :param exception: exception raised while scoring the fit
+        '''
+        event, self._pending_event = self._pending_event, None
+        if event is None:
+            return
+        event.criterion = criterion
+        event.score = score
+        if logL is not None:
+            event.logL = logL
+        if exception is not None:
+            event.exception = type(exception).__name__
+        self.events.record(event)
+
+    def _fit_cached_model(self, hyperparameters, X, lengths, init_params):
+        ''' (GaussianHMM object, True if its parameters came from the fit cache) '''
+        if self.fit_cache is None:
+            return self._fit_new_model(hyperparameters, X, lengths, init_params), False
+        key = self.fit_cache.key(X, lengths, init=params_digest(init_params), **hyperparameters)
+        params = self.fit_cache.get(key)
+        if params is not None:
+            return model_from_params(params, **hyperparameters), True
+        hmm_model = self._fit_new_model(hyperparameters, X, lengths, init_params)
+        self.fit_cache.put(key, model_params(hmm_model, monitor=True))
+        return hmm_model, False
+
+    def _fit_event(self, num_states, fold, hmm_model, start, cached=False, exception=None):
+        details = {} if hmm_model is None or cached else _monitor_details(hmm_model)
+        return FitEvent(type(self).__name__, self.this_word, num_states, fold,
+                        wall_time=time.perf_counter() - start, cached=cached,
+                        exception=None if exception is None else type(exception).__name__, **details)
+
+    def hmm_hyperparameters(self, num_states):
+        ''' GaussianHMM constructor arguments of every fit made by this selector '''
+        return dict(n_components=num_states, covariance_type="diag", n_iter=1000,
+                    random_state=self.random_state, verbose=False, tol=self.tol)
+
+    @staticmethod
+    def initial_params(num_states, init_model):
+        ''' warm start parameters grown from init_model to num_states states, or None for a fresh fit '''
+        if init_model is None:
+            return None
+        init_params = model_params(init_model)
+        while len(init_params['startprob']) < num_states:
+            init_params = split_state(init_params)
+        return init_params
+
+    def candidate_model(self, num_states, previous_model=None, X=None, lengths=None):
+        ''' fits the candidate with num_states states, warm started from the previous candidate if enabled '''
+        init_model = previous_model if self.warm_start else None
+        return self.fit_model(num_states, X, lengths, init_model=init_model)
+
+    def stop_search(self, candidates_since_best):
+        ''' True once the state-count search has gone patience candidates without improving '''
+        return self.patience is not None and candidates_since_best >= self.patience
+
+    @staticmethod
+    def _fit_new_model(hyperparameters, X, lengths, init_params):
+        if init_params is None:
+            return GaussianHMM(**hyperparameters).fit(X, lengths)
+        return model_from_params(init_params, init_params='', **hyperparameters).fit(X, lengths)
+
     def base_model(self, num_states):
         # with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=DeprecationWarning)
         # warnings.filterwarnings("ignore", category=RuntimeWarning)
         try:
-            hmm_model = GaussianHMM(n_components=num_states, covariance_type="diag", n_iter=1000,
-                                    random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
+            hmm_model = self.fit_model(num_states)
+            self.record_fit()
             if self.verbose:
                 print("model created for {} with {} states".format(self.this_word, num_states))
             return hmm_model
-        except:
+        except Exception as e:
+            self.record_fit(exception=e)
             if self.verbose:
                 print("failure on {} with {} states".format(self.this_word, num_states))
             return None
@@ -80,9 +192,13 @@ class SelectorBIC(ModelSelector):
         # Initial values
         best_score = float("Inf")
         best_num_states = 2
+        best_hmm_model = None
+        previous_model = None
+        since_best = 0
         ## Iterate through a number of states to test which is the best representation
         for num_states in range(self.min_n_components, self.max_n_components + 1):
             BIC_score = 0
+            hmm_model = None
             
             try:
                 # Catch case if n_samples > n_states
@@ -97,8 +213,8 @@ class SelectorBIC(ModelSelector):
                     # print("Shape size X[0] {}".format(self.X.shape[0]))
                     # print("Number of states {}".format(num_states))
                     # HMM Model building - num_states is our parameter that is found using CV
-                    hmm_model = GaussianHMM(n_components=num_states, covariance_type="diag", n_iter=1000,
-                                random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
+                    hmm_model = self.candidate_model(num_states, previous_model)
+                    previous_model = hmm_model
                     if self.verbose:
                         print("model created for {} with {} states".format(self.this_word, num_states))
                     # Log-likelihood score
@@ -117,7 +233,9 @@ class SelectorBIC(ModelSelector):
 
                     # BIC score
                     BIC_score = (-2 * logL) + (n_params * math.log(n_samples))
-            except:
+                    self.record_fit('BIC', BIC_score, logL)
+            except Exception as e:
+                self.record_fit(exception=e)
                 if self.verbose:
                     print("failure on {} with {} states".format(self.this_word, num_states))
                     return None
@@ -125,11 +243,20 @@ class SelectorBIC(ModelSelector):
             if BIC_score < best_score:
                 best_score = BIC_score
                 best_num_states = num_states
+                best_hmm_model = hmm_model
+                since_best = 0
+            else:
+                since_best += 1
+                if self.stop_search(since_best):
+                    break
 
+        ## A warm started winner cannot be rebuilt from scratch, so it is kept as it is
+        if self.warm_start and best_hmm_model is not None:
+            return best_hmm_model
         ## Build the best hmm model using all data once parameter has been finalized
         # print("CURRENT WORD: {}".format(self.this_word))
-        best_hmm_model = GaussianHMM(n_components=best_num_states, covariance_type="diag", n_iter=1000,
-                        random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
+        best_hmm_model = self.fit_model(best_num_states)
+        self.record_fit()
         if self.verbose:
             print("Best model created for {} with {} states".format(self.this_word, best_num_states))
 
@@ -152,14 +279,18 @@ class SelectorDIC(ModelSelector):
         # Initial values
         best_score = float("-Inf")
         best_num_states = 2
+        best_hmm_model = None
+        previous_model = None
+        since_best = 0
         ## Iterate through a number of states to test which is the best representation
         for num_states in range(self.min_n_components, self.max_n_components + 1):
             DIC_score = 0
+            hmm_model = None
 
             try:
                 # HMM Model building - num_states is our parameter that is found using DIC
-                hmm_model = GaussianHMM(n_components=num_states, covariance_type="diag", n_iter=1000,
-                            random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
+                hmm_model = self.candidate_model(num_states, previous_model)
+                previous_model = hmm_model
                 if self.verbose:
                     print("model created for {} with {} states".format(self.this_word, num_states))                
                 # Log-likelihood of model in context of evidence
@@ -167,11 +298,14 @@ class SelectorDIC(ModelSelector):
                 # Remove current word from the list of all words 
                 anti_words = list(self.words.keys())
                 anti_words.remove(self.this_word)
-                # Log-likelihood of model in context of anti-evidence
-                anti_scores = sum([hmm_model.score(self.hwords[word][0], self.hwords[word][1]) for word in anti_words])
+                # Log-likelihood of model in context of anti-evidence, skipping words it cannot score
+                anti_scores = [hmm_model.score(self.hwords[word][0], self.hwords[word][1]) for word in anti_words]
+                anti_scores = [score for score in anti_scores if np.isfinite(score)]
                 # DIC Score
-                DIC_score = logL - (anti_scores / len(anti_words))
-            except:   
+                DIC_score = logL - (sum(anti_scores) / len(anti_scores))
+                self.record_fit('DIC', DIC_score, logL)
+            except Exception as e:
+                self.record_fit(exception=e)
                 if self.verbose:
                     print("failure on {} with {} states".format(self.this_word, num_states))
                     return None
@@ -180,81 +314,310 @@ class SelectorDIC(ModelSelector):
             if DIC_score > best_score:
                 best_score = DIC_score
                 best_num_states = num_states
+                best_hmm_model = hmm_model
+                since_best = 0
+            else:
+                since_best += 1
+                if self.stop_search(since_best):
+                    break
 
+        ## A warm started winner cannot be rebuilt from scratch, so it is kept as it is
+        if self.warm_start and best_hmm_model is not None:
+            return best_hmm_model
         # Build the best hmm model using all data once parameter has been finalized
-        best_hmm_model = GaussianHMM(n_components=best_num_states, covariance_type="diag", n_iter=1000,
-                        random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
+        best_hmm_model = self.fit_model(best_num_states)
+        self.record_fit()
         if self.verbose:
             print("Best model created for {} with {} states".format(self.this_word, best_num_states))
 
         return best_hmm_model
 
+    @classmethod
+    def select_all(cls, all_word_sequences: dict, all_word_Xlengths: dict, **kwargs):
+        ''' select the DIC model of every word in one pass over the whole vocabulary
+
+        Each (word, n_states) candidate is fit once and the full candidate x word log-likelihood matrix is
+        scored with one batched ModelBank pass per word, instead of every word's selector scoring each of its
+        candidates against all other words separately.  Every word's DIC choice is then read off the matrix.
+
+        Like select(), non-finite log-likelihoods of other words are left out of a candidate's anti-evidence.
+        A word whose candidates have no finite DIC score gets its smallest fitted candidate, and a word none of
+        whose candidates could be fitted is refit once with min_n_components states.  select() handles these
+        words differently: it scores a candidate that fails as 0, and refits 2 states when no candidate has a
+        finite score.
+
+        :param all_word_sequences: dict as returned by WordsData.get_all_sequences
+        :param all_word_Xlengths: dict as returned by WordsData.get_all_Xlengths
+        :param kwargs: ModelSelector arguments (min_n_components, max_n_components, random_state, ...)
+        :return: dict of GaussianHMM objects keyed by word; exceptions of that last refit are passed on
+        '''
+        warnings.filterwarnings("ignore", category=DeprecationWarning)
+        words = list(all_word_sequences.keys())
+        if len(words) == 0:
+            return {}
+        candidates = {}
+        fit_events = {}
+        selectors = {}
+        for word in words:
+            selector = selectors[word] = cls(all_word_sequences, all_word_Xlengths, word, **kwargs)
+            for num_states in range(selector.min_n_components, selector.max_n_components + 1):
+                try:
+                    candidates[(word, num_states)] = selector.fit_model(num_states)
+                    # sent once the candidate has its DIC score
+                    fit_events[(word, num_states)], selector._pending_event = selector._pending_event, None
+                except Exception:
+                    if selector.verbose:
+                        print("failure on {} with {} states".format(word, num_states))
+
+        # log_likelihoods[c, w] is the log-likelihood of word w's data under candidate model c
+        bank = ModelBank.from_models(candidates)
+        log_likelihoods = np.column_stack([bank.score(*all_word_Xlengths[word]) for word in words])
+        word_index = np.array([words.index(word) for word, _ in bank.words], dtype=np.int64)
+        logL = log_likelihoods[np.arange(bank.num_words), word_index]
+        anti_words = np.isfinite(log_likelihoods)
+        anti_words[np.arange(bank.num_words), word_index] = False
+        with np.errstate(invalid='ignore', divide='ignore'):
+            anti_scores = np.where(anti_words, log_likelihoods, 0).sum(axis=1) / anti_words.sum(axis=1)
+            DIC_scores = logL - anti_scores
+
+        best = {word: (float("-Inf"), None) for word in words}
+        for c, (word, num_states) in enumerate(bank.words):
+            event = fit_events.get((word, num_states))
+            if event is not None:
+                event.criterion, event.score, event.logL = 'DIC', float(DIC_scores[c]), float(logL[c])
+                kwargs['events'].record(event)
+            if np.isfinite(DIC_scores[c]) and DIC_scores[c] > best[word][0]:
+                best[word] = (DIC_scores[c], num_states)
+        models = {}
+        for word in words:
+            selector = selectors[word]
+            num_states = best[word][1]
+            if num_states is None:
+                fitted = [n for w, n in candidates if w == word]
+                if not fitted:
+                    models[word] = selector.fit_model(selector.min_n_components)
+                    selector.record_fit()
+                    continue
+                num_states = min(fitted)
+            models[word] = candidates[(word, num_states)]
+        return models
+
 class SelectorCV(ModelSelector):
     ''' select best model based on average log Likelihood of cross-validation folds
 
+    Folds are gathered from the word's contiguous X array with index arrays, once per split rather than once
+    per state count.  The split can be repeated and stratified by sequence length, and the (n_states, fold)
+    fits can run on a process pool with n_jobs > 1.
     '''
 
+    def __init__(self, all_word_sequences: dict, all_word_Xlengths: dict, this_word: str,
+                 n_splits=3, n_repeats=1, stratify=False, n_jobs=1, **kwargs):
+        super().__init__(all_word_sequences, all_word_Xlengths, this_word, **kwargs)
+        self.n_splits = n_splits
+        self.n_repeats = n_repeats
+        self.stratify = stratify
+        self.n_jobs = n_jobs
+
+    def cv_folds(self):
+        ''' list of ((X_train, lengths_train), (X_test, lengths_test)) tuples for every fold of every repeat
+
+        With fewer sequences than n_splits there is a single "fold" that trains and tests on all the data.
+        '''
+        num_sequences = len(self.lengths)
+        if num_sequences < self.n_splits:
+            return [((self.X, self.lengths), (self.X, self.lengths))]
+        folds = []
+        for repeat in range(self.n_repeats):
+            ## Create the split method & fix the seeding; a single unstratified split keeps the sequence order
+            if self.stratify:
+                # length classes of at least n_splits sequences each, ranked by length
+                num_classes = max(num_sequences // self.n_splits, 1)
+                ranks = np.argsort(np.argsort(self.lengths, kind='stable'), kind='stable')
+                labels = ranks * num_classes // num_sequences
+                split_method = StratifiedKFold(n_splits=self.n_splits, shuffle=True,
+                                               random_state=self.random_state + repeat)
+                splits = split_method.split(np.zeros(num_sequences), labels)
+            elif self.n_repeats > 1:
+                split_method = KFold(n_splits=self.n_splits, shuffle=True, random_state=self.random_state + repeat)
+                splits = split_method.split(np.zeros(num_sequences))
+            else:
+                split_method = KFold(n_splits=self.n_splits)
+                splits = split_method.split(np.zeros(num_sequences))
+            for cv_train_idx, cv_test_idx in splits:
+                folds.append((combine_Xlengths(cv_train_idx, self.X, self.lengths),
+                              combine_Xlengths(cv_test_idx, self.X, self.lengths)))
+        return folds
+
     def select(self):
         warnings.filterwarnings("ignore", category=DeprecationWarning)
 
         ## Implement model selection using CV
+        folds = self.cv_folds()
+        states = list(range(self.min_n_components, self.max_n_components + 1))
+        # candidates depend on each other when warm starting or stopping early, so these are fit state by state
+        sequential = self.warm_start or self.patience is not None
+        fold_results = {} if sequential else self.fit_folds(states, folds, {})
         # Initial values
         best_score = float("-Inf")
         best_num_states = 2
+        previous_models = {}
+        since_best = 0
         ## Iterate through a number of states to test which is the best representation
-        for num_states in range(self.min_n_components, self.max_n_components + 1):
+        for num_states in states:
+            if sequential:
+                fold_results.update(self.fit_folds([num_states], folds, previous_models))
             score = 0
-            ## Perform CV split
-            # Case if we have less data than samples (here we use KFold = 3 folds)
-            if len(self.sequences) < 3:
-                n_split = 1
-                DO_KFOLD = False
-            else:
-                n_split = 3
-                DO_KFOLD = True
-            ## Decide if need to do K-Fold as per the data       
-            if DO_KFOLD:
-            ## Create the split method & fix the seeding
-                split_method = KFold(n_splits = n_split, random_state = self.random_state)
-                ## KFold CV
-                for cv_train_idx, cv_test_idx in split_method.split(self.sequences):
-                    try:
-                        # Split the sequences accordingly using helper function to split the data correct
-                        sequence_split_train = combine_sequences(cv_train_idx, self.sequences)
-                        sequence_split_cv = combine_sequences(cv_test_idx, self.sequences)
-                        # HMM Model building - num_states is our parameter that is found using CV
-                        hmm_model = GaussianHMM(n_components=num_states, covariance_type="diag", n_iter=1000,
-                                    random_state=self.random_state, verbose=False).fit(sequence_split_train[0], sequence_split_train[1])
-                        if self.verbose:
-                            print("model created for {} with {} states".format(self.this_word, num_states))
-                        score += hmm_model.score(sequence_split_cv[0], sequence_split_cv[1])
-                    except:
-                        if self.verbose:
-                            print("failure on {} with {} states".format(self.this_word, num_states))
-                            return None
-            else:
-                try:
-                    # HMM Model building without CV
-                    hmm_model = GaussianHMM(n_components=num_states, covariance_type="diag", n_iter=1000,
-                                random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
-                    if self.verbose:
-                        print("model created for {} with {} states".format(self.this_word, num_states))
-                    score += hmm_model.score(self.X, self.lengths)
-                except:
+            for fold in range(len(folds)):
+                hmm_model, fold_score = fold_results[(num_states, fold)]
+                if hmm_model is None:
                     if self.verbose:
                         print("failure on {} with {} states".format(self.this_word, num_states))
                         return None
-            ## Average the score across all the folds - KFold is fixed to 3 at the moment, except if there's too little data
-            score /= n_split
+                    continue
+                if self.verbose:
+                    print("model created for {} with {} states".format(self.this_word, num_states))
+                previous_models[fold] = hmm_model
+                score += fold_score
+            ## Average the score across all the folds
+            score /= len(folds)
             ## Tracking best score and best number of states parameter
             if score > best_score:
                 best_score = score
                 best_num_states = num_states
+                since_best = 0
+            else:
+                since_best += 1
+                if self.stop_search(since_best):
+                    break
 
         ## Build the best hmm model using all data once parameter has been finalized
-        best_hmm_model = GaussianHMM(n_components=best_num_states, covariance_type="diag", n_iter=1000,
-                        random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
+        best_hmm_model = self.fit_model(best_num_states)
+        self.record_fit()
         if self.verbose:
             print("Best model created for {} with {} states".format(self.this_word, best_num_states))
 
         return best_hmm_model
+
+    def fit_folds(self, states, folds, previous_models):
+        ''' fits and scores every (n_states, fold) pair, reusing the fit cache and running the remaining fits
+        on a process pool when n_jobs > 1
+
+        :return: dict of (GaussianHMM object or None, test fold log-likelihood) keyed by (num_states, fold)
+        '''
+        results = {}
+        jobs = []
+        for num_states in states:
+            for fold, ((X_train, lengths_train), (X_test, lengths_test)) in enumerate(folds):
+                init_model = previous_models.get(fold) if self.warm_start else None
+                init_params = self.initial_params(num_states, init_model)
+                params = None
+                if self.fit_cache is not None:
+                    key = self.fit_cache.key(X_train, lengths_train, init=params_digest(init_params),
+                                             **self.hmm_hyperparameters(num_states))
+                    params = self.fit_cache.get(key)
+                if params is not None:
+                    start = time.perf_counter()
+                    hmm_model, fold_score, exception = _score_params(params, self.hmm_hyperparameters(num_states),
+                                                                     X_test, lengths_test)
+                    results[(num_states, fold)] = hmm_model, fold_score
+                    self._record_fold_fit(num_states, fold, fold_score, wall_time=time.perf_counter() - start,
+                                          exception=exception, cached=True)
+                else:
+                    jobs.append((num_states, fold, self.hmm_hyperparameters(num_states), init_params))
+
+        for (num_states, fold, hyperparameters, init_params), (params, fold_score, details) in zip(jobs, self._run_fold_jobs(jobs, folds)):
+            self._record_fold_fit(num_states, fold, fold_score, **details)
+            if params is None:
+                results[(num_states, fold)] = None, None
+                continue
+            if self.fit_cache is not None:
+                X_train, lengths_train = folds[fold][0]
+                self.fit_cache.put(self.fit_cache.key(X_train, lengths_train, init=params_digest(init_params),
+                                                      **hyperparameters), params)
+            results[(num_states, fold)] = model_from_params(params, **hyperparameters), fold_score
+        return results
+
+    def _record_fold_fit(self, num_states, fold, fold_score, **details):
+        if self.events is not None:
+            self.events.record(FitEvent(type(self).__name__, self.this_word, num_states, fold,
+                                        criterion='CV', score=fold_score, **details))
+
+    def _run_fold_jobs(self, jobs, folds):
+        if (self.n_jobs is not None and self.n_jobs <= 1) or len(jobs) <= 1:
+            return [_fit_fold_job(job, folds) for job in jobs]
+        n_jobs = self.n_jobs or os.cpu_count() or 1
+        return run_in_pool(_fit_fold_job, jobs, n_jobs, _init_fold_worker, (folds,))
+
+
+# cross-validation folds of the current worker process, set once per worker by _init_fold_worker
+_worker_folds = None
+
+
+def _init_fold_worker(folds):
+    global _worker_folds
+    _worker_folds = folds
+
+
+def _fit_fold_job(job, folds=None):
+    ''' fits one (n_states, fold) job and scores it on the test part of the fold
+
+    :return: (params dict, log-likelihood, dict of FitEvent details), with params and log-likelihood None
+        when hmmlearn fails
+    '''
+    num_states, fold, hyperparameters, init_params = job
+    (X_train, lengths_train), (X_test, lengths_test) = (folds or _worker_folds)[fold]
+    start = time.perf_counter()
+    details = {}
+    try:
+        hmm_model = ModelSelector._fit_new_model(hyperparameters, X_train, lengths_train, init_params)
+        details = _monitor_details(hmm_model)
+        result = model_params(hmm_model, monitor=True), hmm_model.score(X_test, lengths_test)
+    except Exception as e:
+        details['exception'] = type(e).__name__
+        result = None, None
+    details['wall_time'] = time.perf_counter() - start
+    return result + (details,)
+
+
+def _score_params(params, hyperparameters, X, lengths):
+    ''' (GaussianHMM object, log-likelihood, None), or (None, None, exception type name) when scoring fails '''
+    hmm_model = model_from_params(params, **hyperparameters)
+    try:
+        return hmm_model, hmm_model.score(X, lengths), None
+    except Exception as e:
+        return None, None, type(e).__name__
+
+
+def _monitor_details(hmm_model):
+    ''' EM iterations, convergence and final training log-likelihood of a fitted model as FitEvent details '''
+    monitor = hmm_model.monitor_
+    return {'iterations': monitor.iter, 'converged': bool(monitor.converged),
+            'logL': monitor.history[-1] if len(monitor.history) > 0 else None}
+
+
+def split_state(params: dict):
+    ''' grows a fitted model by one state, splitting the state with the highest total variance in two
+
+    The two halves share the original state's variances and transitions, and their means are moved apart by
+    half a standard deviation in opposite directions so that EM can pull them to different parts of the data.
+
+    :param params: dict as returned by asl_fit_cache.model_params
+    :return: dict with one more state
+    '''
+    startprob, transmat = params['startprob'], params['transmat']
+    means, covars = params['means'], params['covars']
+    k = int(np.argmax(covars.sum(axis=1)))
+    offset = 0.5 * np.sqrt(covars[k])
+
+    new_startprob = np.append(startprob, startprob[k] / 2)
+    new_startprob[k] /= 2
+    # incoming probability of state k is shared between the halves, outgoing transitions are copied
+    new_transmat = np.zeros((len(startprob) + 1, len(startprob) + 1))
+    new_transmat[:-1, :-1] = transmat
+    new_transmat[:-1, -1] = transmat[:, k] / 2
+    new_transmat[:-1, k] /= 2
+    new_transmat[-1] = new_transmat[k]
+    new_means = np.vstack([means, means[k] + offset])
+    new_means[k] = means[k] - offset
+    new_covars = np.vstack([covars, covars[k]])
+    return {'startprob': new_startprob, 'transmat': new_transmat, 'means': new_means, 'covars': new_covars}
@@ -1,13 +1,23 @@
 import warnings
-from asl_data import SinglesData
 
+import numpy as np
 
-def recognize(models: dict, test_set: SinglesData):
+from asl_data import SinglesData, WordsData
+from asl_language_model import NgramLM, decode_sentence
+from asl_scoring import ModelBank
+
+
+def recognize(models: dict, test_set: SinglesData, batched=True, dtype=None):
     """ Recognize test word sequences from word models set
 
-   :param models: dict of trained models
+   :param models: dict of trained models, or a ModelBank object e.g. loaded with ModelBank.load
        {'SOMEWORD': GaussianHMM model object, 'SOMEOTHERWORD': GaussianHMM model object, ...}
    :param test_set: SinglesData object
+   :param batched: bool
+       score each test item against all models at once with a ModelBank forward pass instead of calling
+       model.score once per (item, model) pair
+   :param dtype: numpy float dtype of the batched scoring arithmetic, or None to keep the dtype of a ModelBank
+       and pack a dict of models as np.float64; see ModelBank for what np.float32 scoring saves and costs
    :return: (list, list)  as probabilities, guesses
        both lists are ordered by the test set word_id
        probabilities is a list of dictionaries where each key a word and value is Log Liklihood
@@ -24,6 +34,16 @@ def recognize(models: dict, test_set: SinglesData):
     all_words = test_set.wordlist
     Xlengths = test_set.get_all_Xlengths()
 
+    if isinstance(models, ModelBank) and not batched:
+        models = models.to_models()
+    if batched:
+        bank = _scoring_bank(models, dtype)
+        scores = bank.score_matrix(test_set)
+        for i in range(test_set.num_items):
+            probabilities.append({word: float(logL) for word, logL in zip(bank.words, scores[i])})
+            guesses.append(bank.words[int(scores[i].argmax())])
+        return probabilities, guesses
+
     # Loop through all test set items
     for i in range(test_set.num_items):
         # Probability dictionary
@@ -42,3 +62,294 @@ def recognize(models: dict, test_set: SinglesData):
         guesses.append(best_guess)
 
     return probabilities, guesses
+
+
+def recognize_pruned(models: dict, test_set: SinglesData, top_k=10, beam=None, training: WordsData = None,
+                     dtype=None):
+    """ Recognize test word sequences in two stages: a cheap prefilter keeps the top_k candidate words of each
+    item, then a beam-pruned forward pass scores only those candidates
+
+    :param models: dict of trained models or ModelBank object
+    :param test_set: SinglesData object
+    :param top_k: int or None
+        number of candidate words kept by the prefilter; None scores every word
+    :param beam: float or None
+        log-likelihood distance behind the best candidate at which a word is dropped; None disables pruning
+    :param training: WordsData object or None
+        training set whose sequence lengths add a duration term to the prefilter
+    :param dtype: numpy float dtype of the scoring arithmetic, or None as in recognize
+    :return: (list, list, dict) as probabilities, guesses, report
+        probabilities and guesses as returned by recognize, with -inf for words that were not scored;
+        report counts the (item, word) scores skipped by the prefilter and the beam and the forward steps saved;
+        models that cannot be scored at all are left out of every count but 'words'
+    """
+    bank = _scoring_bank(models, dtype)
+    duration_stats = None
+    if training is not None:
+        Xlengths = training.get_all_Xlengths()
+        log_lengths = [np.log(Xlengths[word][1]) if word in Xlengths else np.zeros(1) for word in bank.words]
+        duration_stats = (np.array([l.mean() for l in log_lengths]),
+                          np.array([max(l.std(), 0.1) for l in log_lengths]))
+
+    probabilities = []
+    guesses = []
+    scorable = bank.n_states > 0
+    num_scorable = int(scorable.sum())
+    report = {'items': test_set.num_items, 'words': bank.num_words, 'scorable_words': num_scorable,
+              'prefiltered': 0, 'pruned': 0, 'forward_steps': 0, 'full_forward_steps': 0}
+    Xlengths = test_set.get_all_Xlengths()
+    for i in range(test_set.num_items):
+        X, lengths = Xlengths[i]
+        candidates = None
+        if top_k is not None and top_k < num_scorable:
+            candidates = np.argsort(-bank.prefilter_scores(X, duration_stats), kind='stable')[:top_k]
+            report['prefiltered'] += num_scorable - int(scorable[candidates].sum())
+        scores, steps, pruned = bank.score_sequence_pruned(X, candidates, beam)
+        report['pruned'] += pruned
+        report['forward_steps'] += steps
+        report['full_forward_steps'] += num_scorable * len(X)
+        probabilities.append({word: float(logL) for word, logL in zip(bank.words, scores)})
+        guesses.append(bank.words[int(scores.argmax())])
+    report['skipped'] = report['prefiltered'] + report['pruned']
+    return probabilities, guesses, report
+
+
+def _scoring_bank(models, dtype):
+    """ ModelBank of models, a dict or ModelBank, with the given scoring dtype; None keeps a bank's own dtype """
+    if isinstance(models, ModelBank):
+        return models if dtype is None else models.astype(dtype)
+    return ModelBank.from_models(models, dtype or np.float64)
+
+
+def recognize_sentences(probabilities, test_set: SinglesData, lm: NgramLM, lm_weight=1.0, beam=None,
+                        max_hypotheses=None):
+    """ Recognize test word sequences sentence by sentence, combining the word model scores of the items with
+    an n-gram language model in a beam-pruned Viterbi search over each sentence
+
+    :param probabilities: list of dicts as returned by recognize, or (score matrix, words) tuple of a float
+        array (num_items, num_words) and its column labels, e.g. (bank.score_matrix(test_set), bank.words)
+    :param test_set: SinglesData object
+    :param lm: NgramLM object
+    :param lm_weight: float scale of the language model log probabilities against the log-likelihoods
+    :param beam: float or None, see asl_language_model.decode_sentence
+    :param max_hypotheses: int or None, see asl_language_model.decode_sentence
+    :return: list of the best guess words ordered by the test set word_id
+    """
+    if isinstance(probabilities, tuple):
+        scores, words = probabilities
+    else:
+        words = list(probabilities[0].keys()) if probabilities else []
+        scores = np.array([[item[word] for word in words] for item in probabilities], dtype=np.float64)
+    log_probs = lm.table(words)
+    guesses = [None] * test_set.num_items
+    for video, items in test_set.sentences_index.items():
+        path, _ = decode_sentence(scores[items], log_probs, lm_weight, beam, max_hypotheses)
+        for item, w in zip(items, path):
+            guesses[item] = words[w]
+    return guesses
+
+
+class StreamingRecognizer(object):
+    """ recognizes a sign while its frames arrive, one frame at a time
+
+    One log-space forward vector is kept per word model and advanced with every frame, so the cost of a frame
+    and the memory held do not grow with the length of the sequence.
+
+    For example, to follow the hypotheses over a video from the AslDb feature table:
+        stream = StreamingRecognizer(models, features_ground)
+        for frame, row in asl.feature_table(features_ground).loc[98].iterrows():
+            stream.push(row)
+            print(frame, stream.best(3))
+    """
+
+    def __init__(self, models, feature_list: list = None):
+        """
+        :param models: dict of trained models as returned by train_all_words, or a ModelBank object
+        :param feature_list: list of str feature labels used to pick the features out of AslDb rows;
+            None if frames are pushed as feature arrays already
+        """
+        self.bank = models if isinstance(models, ModelBank) else ModelBank.from_models(models)
+        self.feature_list = feature_list
+        self.reset()
+
+    def reset(self):
+        """ forgets every frame pushed so far, e.g. at the start of a new sign """
+        self._alpha = None
+        self.num_frames = 0
+
+    def push(self, frame):
+        """ advances every word model by one frame
+
+        :param frame: AslDb row (pandas Series or dict) when a feature list was given, or a feature array
+        :return: float array (W,) of log-likelihoods of the frames so far, ordered by self.bank.words
+        """
+        if self.feature_list is not None and not isinstance(frame, np.ndarray):
+            frame = [frame[f] for f in self.feature_list]
+        log_b = self.bank.log_emissions(np.asarray(frame, dtype=np.float64).reshape(1, -1))[0]
+        if self._alpha is None:
+            self._alpha = self.bank.forward_start(log_b)
+        else:
+            self._alpha = self.bank.forward_step(self._alpha, log_b)
+        self.num_frames += 1
+        return self.log_likelihoods()
+
+    def log_likelihoods(self):
+        """ log-likelihood of the frames so far under every word model, -inf for all before the first frame
+
+        :return: float array (W,) ordered by self.bank.words
+        """
+        if self._alpha is None:
+            return np.full(self.bank.num_words, float('-inf'))
+        return self.bank.forward_total(self._alpha)
+
+    def best(self, k=1):
+        """ current best-k word hypotheses
+
+        :param k: int
+        :return: list of (word, log-likelihood) tuples, best first
+        """
+        scores = self.log_likelihoods()
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k > 0 else []
+        return [(self.bank.words[i], float(scores[i])) for i in sorted(top, key=lambda i: -scores[i])]
+
+
+class ContinuousRecognizer(object):
+    """ recognizes the word sequence of a whole unsegmented video, one frame at a time
+
+    The word models are chained into one network: a path may leave a word from any of its states after any
+    frame and enter the start states of every word at the next frame, paying word_penalty each time.  Viterbi
+    token passing keeps, per word state, the best path score and the word boundary it entered from; only the
+    best word exit of each frame is recorded as a boundary.  A frame therefore costs the same at any point of
+    the video, and memory grows by one boundary record per frame.
+
+    For example, to decode a video of the AslDb frame table:
+        decoder = ContinuousRecognizer(models, features_ground, word_penalty=-50, beam=200)
+        for word, startframe, endframe in decoder.decode_video(asl, 98):
+            print(word, startframe, endframe)
+    """
+
+    def __init__(self, models, feature_list: list = None, word_penalty=0.0, beam=None):
+        """
+        :param models: dict of trained models as returned by train_all_words, or a ModelBank object
+        :param feature_list: list of str feature labels used to pick the features out of AslDb rows;
+            None if frames are pushed as feature arrays already
+        :param word_penalty: float log score added at every word entry; lower values give fewer, longer words
+        :param beam: float or None
+            after every frame, word states scoring more than beam below the best state are dropped
+        """
+        self.bank = models if isinstance(models, ModelBank) else ModelBank.from_models(models)
+        self.feature_list = feature_list
+        self.word_penalty = word_penalty
+        self.beam = beam
+        self.reset()
+
+    def reset(self):
+        """ forgets every frame pushed so far, e.g. at the start of a new video """
+        self._delta = None   # (W, S) best log score of a path in state s of word w at the current frame
+        self._entry = None   # (W, S) boundary record that path entered word w from, -1 for the video start
+        # boundary records, one per frame: best word ending at the frame, its path score and previous record
+        self._exit_words = []
+        self._exit_scores = []
+        self._exit_entries = []
+        self.num_frames = 0
+
+    def push(self, frame):
+        """ advances the network by one frame
+
+        :param frame: AslDb row (pandas Series or dict) when a feature list was given, or a feature array
+        """
+        if self.feature_list is not None and not isinstance(frame, np.ndarray):
+            frame = [frame[f] for f in self.feature_list]
+        self._push_log_b(self.bank.log_emissions(np.asarray(frame, dtype=np.float64).reshape(1, -1))[0])
+
+    def _push_log_b(self, log_b):
+        bank = self.bank
+        if self._delta is None:
+            delta = self.word_penalty + bank._log_startprob + log_b
+            entry = np.full(delta.shape, -1, dtype=np.int64)
+        else:
+            # stay inside the word, only for words that still have a state within the beam
+            stay = np.full(self._delta.shape, float('-inf'))
+            stay_entry = np.zeros(self._delta.shape, dtype=np.int64)
+            active = np.flatnonzero(np.isfinite(self._delta).any(axis=1))
+            if len(active):
+                scores = self._delta[active, :, None] + bank._log_transmat[active]
+                prev = scores.argmax(axis=1)
+                stay[active] = np.take_along_axis(scores, prev[:, None, :], axis=1)[:, 0, :]
+                stay_entry[active] = np.take_along_axis(self._entry[active], prev, axis=1)
+            # or enter a word from the best word exit of the previous frame
+            last = len(self._exit_words) - 1
+            enter = self._exit_scores[last] + self.word_penalty + bank._log_startprob
+            use_enter = enter > stay
+            delta = np.where(use_enter, enter, stay) + log_b
+            entry = np.where(use_enter, last, stay_entry)
+        if self.beam is not None:
+            delta[delta < delta.max() - self.beam] = float('-inf')
+        self._delta, self._entry = delta, entry
+
+        ends = delta.max(axis=1)
+        ends[~bank._usable] = float('-inf')
+        w = int(ends.argmax())
+        self._exit_words.append(w)
+        self._exit_scores.append(float(ends[w]))
+        self._exit_entries.append(int(entry[w, delta[w].argmax()]))
+        self.num_frames += 1
+
+    def result(self):
+        """ best word sequence of the frames so far, ending with a word exit at the last frame
+
+        :return: list of (word, startframe, endframe) tuples, frames counted from 0 at the first pushed frame
+        """
+        segments = []
+        record = len(self._exit_words) - 1
+        while record >= 0:
+            previous = self._exit_entries[record]
+            segments.append((self.bank.words[self._exit_words[record]], previous + 1, record))
+            record = previous
+        return segments[::-1]
+
+    def score(self):
+        """ log score of the path returned by result(), word penalties included """
+        return self._exit_scores[-1] if self._exit_scores else float('-inf')
+
+    def decode(self, X, chunk_size=1024):
+        """ best word sequence of a whole sequence of frames
+
+        :param X: float array (T, D)
+        :param chunk_size: int number of frames whose emissions are computed together
+        :return: list of (word, startframe, endframe) tuples, see result()
+        """
+        self.reset()
+        X = np.asarray(X, dtype=np.float64)
+        for start in range(0, len(X), chunk_size):
+            for log_b in self.bank.log_emissions(X[start:start + chunk_size]):
+                self._push_log_b(log_b)
+        return self.result()
+
+    def decode_video(self, asl, video):
+        """ best word sequence of a video of the AslDb frame table
+
+        :param asl: AslDb object
+        :param video: int video number
+        :return: list of (word, startframe, endframe) tuples with the video's own frame numbers
+        """
+        frames = asl.working_set([video]).feature_table(self.feature_list).loc[video].sort_index()
+        labels = frames.index.values
+        return [(word, int(labels[start]), int(labels[end]))
+                for word, start, end in self.decode(frames.values)]
+
+
+def recognize_continuous(models, asl, feature_list: list, videos, word_penalty=0.0, beam=None):
+    """ Recognize the word sequences of whole videos without word segmentation
+
+    :param models: dict of trained models as returned by train_all_words, or a ModelBank object
+    :param asl: AslDb object
+    :param feature_list: list of str feature labels the models were trained on
+    :param videos: iterable of int video numbers, e.g. test_set.sentences_index
+    :param word_penalty: float, see ContinuousRecognizer
+    :param beam: float or None, see ContinuousRecognizer
+    :return: dict of lists of (word, startframe, endframe) tuples keyed by video
+    """
+    decoder = ContinuousRecognizer(models, feature_list, word_penalty, beam)
+    return {video: decoder.decode_video(asl, video) for video in videos}